@@ -0,0 +1,117 @@
+# FILE: bench_db.py
+"""
+Бенчмарк задержки апдейтов: синхронный database.py против database_async.
+
+Апдейты поступают с фиксированной частотой (open-loop), каждый проходит те же
+проверки, что и middlewares (бан, заморозка, техработы, роль). Каждый N-й апдейт
+дополнительно выполняет тяжёлый запрос — топ покупателей по всей истории.
+Задержка считается от планового момента поступления апдейта, поэтому остановка
+event loop видна в хвосте распределения.
+
+Запуск: python bench_db.py --rate 300 --duration 5 --heavy-every 50
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import database
+import database_async as adb
+
+
+def seed(path: str, users: int, purchases: int):
+    conn = sqlite3.connect(path)
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT INTO users (user_id, username, full_name) VALUES (?, ?, ?)",
+        [(uid, f"user{uid}", f"User {uid}") for uid in range(1, users + 1)]
+    )
+    cursor.executemany(
+        "INSERT INTO purchase_history (user_id, order_id, amount, total_price) VALUES (?, ?, ?, ?)",
+        [(random.randint(1, users), i, 50, random.uniform(50, 5000)) for i in range(purchases)]
+    )
+    cursor.executemany(
+        "INSERT INTO bans (user_id, reason, moderator_id) VALUES (?, ?, ?)",
+        [(uid, "bench", 0) for uid in random.sample(range(1, users + 1), users // 100)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_mode(mode: str, args) -> list:
+    latencies = []  # (задержка, был ли тяжёлый запрос)
+
+    async def handle(i: int, arrived: float):
+        user_id = random.randint(1, args.users)
+        if mode == 'sync':
+            database.is_user_banned(user_id)
+            database.is_user_frozen(user_id)
+            database.is_maintenance_mode()
+            database.get_user_role(user_id)
+            if i % args.heavy_every == 0:
+                database.get_top_buyers(10)
+        else:
+            await adb.is_user_banned(user_id)
+            await adb.is_user_frozen(user_id)
+            await adb.is_maintenance_mode()
+            await adb.get_user_role(user_id)
+            if i % args.heavy_every == 0:
+                await adb.get_top_buyers(10)
+        latencies.append((time.perf_counter() - arrived, i % args.heavy_every == 0))
+
+    total = int(args.rate * args.duration)
+    interval = 1 / args.rate
+    tasks = []
+    start = time.perf_counter()
+    for i in range(total):
+        arrived = start + i * interval
+        delay = arrived - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(handle(i, arrived)))
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=300, help="апдейтов в секунду")
+    parser.add_argument("--duration", type=float, default=5, help="длительность каждого прогона, сек")
+    parser.add_argument("--heavy-every", type=int, default=50, help="каждый N-й апдейт делает тяжёлый запрос")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--purchases", type=int, default=30000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_NAME = os.path.join(tmp, "bench.db")
+        database.init_db()
+        seed(database.DATABASE_NAME, args.users, args.purchases)
+
+        print(f"rate={args.rate}/s duration={args.duration}s heavy_every={args.heavy_every}")
+        # light — апдейты без тяжёлого запроса, то есть «все остальные пользователи»
+        print(f"{'mode':<6} {'updates':<6} {'count':>6} {'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9} {'max, ms':>9}")
+        for mode in ('sync', 'async'):
+            latencies = await run_mode(mode, args)
+            groups = {
+                'all': [x * 1000 for x, _ in latencies],
+                'light': [x * 1000 for x, heavy in latencies if not heavy],
+            }
+            for name, ms in groups.items():
+                print(
+                    f"{mode:<6} {name:<6} {len(ms):>6} {percentile(ms, 50):>9.2f} {percentile(ms, 95):>9.2f} "
+                    f"{percentile(ms, 99):>9.2f} {max(ms):>9.2f}"
+                )
+        await adb.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
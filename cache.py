@@ -0,0 +1,173 @@
+# FILE: cache.py
+"""
+Единый кэш в памяти: LRU с ограничением размера и TTL по пространствам имён.
+
+Ключ — пара (namespace, key). TTL задаётся для пространства имён в
+CACHE_NAMESPACE_TTLS (None — без срока, запись живёт до вытеснения или
+инвалидации). Записи можно помечать тегами и сбрасывать пачкой:
+    cache.set('top', 10, rows, tags=('purchases',))
+    cache.invalidate_tag('purchases')
+Потокобезопасен: синхронные функции БД выполняются и в пуле потоков.
+"""
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from config import CACHE_MAX_ENTRIES, CACHE_NAMESPACE_TTLS
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class Cache:
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttls: dict = None):
+        self.max_entries = max_entries
+        self.ttls = dict(ttls or {})
+        self._data = OrderedDict()      # (namespace, key) -> (value, expires_at, tags)
+        self._tags = defaultdict(set)   # tag -> {(namespace, key)}
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0})
+
+    # ---------- внутреннее (вызывается под блокировкой) ----------
+    def _unlink(self, full_key, entry):
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(full_key)
+                if not keys:
+                    del self._tags[tag]
+
+    def _remove(self, full_key):
+        entry = self._data.pop(full_key, None)
+        if entry is not None:
+            self._unlink(full_key, entry)
+        return entry
+
+    # ---------- чтение и запись ----------
+    def get(self, namespace: str, key, default=None):
+        full_key = (namespace, key)
+        with self._lock:
+            entry = self._data.get(full_key)
+            stats = self._stats[namespace]
+            if entry is None:
+                stats['misses'] += 1
+                return default
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                self._remove(full_key)
+                stats['expired'] += 1
+                stats['misses'] += 1
+                return default
+            self._data.move_to_end(full_key)
+            stats['hits'] += 1
+            return entry[0]
+
+    def _store(self, namespace: str, key, value, ttl, tags):
+        if ttl is None:
+            ttl = self.ttls.get(namespace)
+        expires_at = time.monotonic() + ttl if ttl else None
+        full_key = (namespace, key)
+        tags = frozenset(tags)
+        self._remove(full_key)
+        self._data[full_key] = (value, expires_at, tags)
+        for tag in tags:
+            self._tags[tag].add(full_key)
+        while len(self._data) > self.max_entries:
+            old_key, old_entry = self._data.popitem(last=False)
+            self._unlink(old_key, old_entry)
+            self._stats[old_key[0]]['evictions'] += 1
+
+    def set(self, namespace: str, key, value, ttl: float = None, tags=()):
+        with self._lock:
+            self._store(namespace, key, value, ttl, tags)
+
+    def add(self, namespace: str, key, value, ttl: float = None) -> bool:
+        """Атомарно записывает значение, только если ключа нет. True — записано."""
+        with self._lock:
+            entry = self._data.get((namespace, key))
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                return False
+            self._store(namespace, key, value, ttl, ())
+            return True
+
+    # ---------- инвалидация ----------
+    def delete(self, namespace: str, key):
+        with self._lock:
+            self._remove((namespace, key))
+
+    def invalidate_tag(self, tag: str) -> int:
+        with self._lock:
+            keys = self._tags.pop(tag, set())
+            for full_key in keys:
+                self._remove(full_key)
+        return len(keys)
+
+    def clear_namespace(self, namespace: str) -> int:
+        with self._lock:
+            keys = [full_key for full_key in self._data if full_key[0] == namespace]
+            for full_key in keys:
+                self._remove(full_key)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+        logger.info("Кэш очищен")
+
+    # ---------- статистика ----------
+    def stats(self) -> dict:
+        with self._lock:
+            sizes = defaultdict(int)
+            for namespace, _ in self._data:
+                sizes[namespace] += 1
+            result = {}
+            for namespace in set(self._stats) | set(sizes):
+                result[namespace] = dict(self._stats[namespace], size=sizes[namespace])
+        return result
+
+    def __len__(self):
+        return len(self._data)
+
+
+cache = Cache(ttls=CACHE_NAMESPACE_TTLS)
+
+
+def cached(namespace: str, key=None, tags=()):
+    """
+    Декоратор для синхронных и асинхронных функций.
+    key — функция от аргументов, по умолчанию ключом служат сами аргументы.
+    Результат None не кэшируется.
+    """
+    def decorator(func):
+        def make_key(args, kwargs):
+            if key is not None:
+                return key(*args, **kwargs)
+            return args + tuple(sorted(kwargs.items()))
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                cache_key = make_key(args, kwargs)
+                value = cache.get(namespace, cache_key, MISSING)
+                if value is MISSING:
+                    value = await func(*args, **kwargs)
+                    if value is not None:
+                        cache.set(namespace, cache_key, value, tags=tags)
+                return value
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_key = make_key(args, kwargs)
+            value = cache.get(namespace, cache_key, MISSING)
+            if value is MISSING:
+                value = func(*args, **kwargs)
+                if value is not None:
+                    cache.set(namespace, cache_key, value, tags=tags)
+            return value
+        return wrapper
+    return decorator
@@ -0,0 +1,409 @@
+# FILE: cluster.py
+"""
+Многопроцессный режим: приёмный процесс и CLUSTER_WORKERS обработчиков.
+
+Приёмный процесс получает обновления (polling или вебхук) и передаёт их по
+Unix-сокету CLUSTER_SOCKET обработчику с номером user_id % CLUSTER_WORKERS,
+поэтому все обновления одного пользователя попадают в один процесс и
+обрабатываются в нём строго по очереди, а разные пользователи — параллельно
+на всех ядрах. Фоновые задачи (рассылки, планировщик, снятие банов) остаются
+в приёмном процессе. События invalidation из любого процесса приёмный
+процесс применяет у себя и пересылает остальным обработчикам, а также в
+журнал БД для других экземпляров (журнал опрашивает только приёмный процесс).
+
+Протокол — JSON по строке в обе стороны:
+    {"hello": 2}                    обработчик → приёмный, после подключения
+    {"update": {...}}               приёмный → обработчик
+    {"event": ["access", 123]}      в обе стороны
+    {"call": [7, "scheduler.run_now", ["auto_backup"]]}  обработчик → приёмный
+    {"result": [7, true]}           приёмный → обработчик, ответ на call
+    {"stop": true}                  приёмный → обработчик, доработать и выйти
+Упавший обработчик перезапускается; обновления, переданные ему до падения,
+теряются. Рассылки и планировщик работают только в приёмном процессе,
+поэтому хендлеры обращаются к ним через call() — в обработчике вызов
+уходит по сокету.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from collections import deque
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiogram.types.update import UpdateTypeLookupError
+
+from config import (
+    CLUSTER_WORKERS, CLUSTER_SOCKET, CLUSTER_WORKER_CONCURRENCY, CLUSTER_WORKER_BACKLOG,
+    CLUSTER_POLL_TIMEOUT, CLUSTER_STOP_TIMEOUT, CLUSTER_CALL_TIMEOUT, BOT_MODE
+)
+import invalidation
+import outbox
+from invalidation import Event
+
+logger = logging.getLogger(__name__)
+
+WORKER_ENV = 'STARFLY_WORKER'
+
+
+def enabled() -> bool:
+    return CLUSTER_WORKERS > 1
+
+def worker_index():
+    """Номер обработчика или None в приёмном/одиночном процессе."""
+    value = os.environ.get(WORKER_ENV)
+    return int(value) if value is not None else None
+
+def _user_id(update: Update) -> int:
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        return 0
+    user = getattr(event, 'from_user', None) or getattr(event, 'user', None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, 'chat', None)
+    return chat.id if chat is not None else 0
+
+def _encode(message: dict) -> bytes:
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+
+async def _apply(event: Event):
+    import database_async as adb
+    try:
+        await adb.run_sync(invalidation.apply, event)
+    except Exception as e:
+        logger.error(f"Кластер: не удалось применить {event.kind}:{event.key}: {e}")
+
+def _parse_event(data):
+    try:
+        return Event.from_json(data)
+    except (ValueError, TypeError, IndexError) as e:
+        logger.warning(f"Кластер: пропущено событие {data!r}: {e}")
+        return None
+
+# ========== ВЫЗОВЫ ПРИЁМНОГО ПРОЦЕССА ==========
+def _front_functions() -> dict:
+    import mailer
+    import scheduler
+    return {
+        'mailer.enqueue': mailer.enqueue,
+        'scheduler.run_now': scheduler.run_now,
+        'scheduler.snapshot': scheduler.snapshot,
+    }
+
+_front = None  # соединение обработчика с приёмным процессом (_FrontLink)
+
+
+class _FrontLink:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.pending = {}  # номер вызова -> future
+        self.next_id = 0
+
+    def resolve(self, data):
+        future = self.pending.pop(data[0], None)
+        if future is not None and not future.done():
+            if len(data) > 2:
+                future.set_exception(RuntimeError(data[2]))
+            else:
+                future.set_result(data[1])
+
+    def fail_all(self):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Кластер: приёмный процесс недоступен"))
+        self.pending.clear()
+
+
+async def call(name: str, *args):
+    """
+    Вызывает функцию приёмного процесса (_front_functions): в обработчике — по
+    сокету с ожиданием ответа, в остальных процессах — напрямую. Ошибка
+    связи — ConnectionError или asyncio.TimeoutError.
+    """
+    if worker_index() is None:
+        return _front_functions()[name](*args)
+    if _front is None:
+        raise ConnectionError("Кластер: нет соединения с приёмным процессом")
+    _front.next_id += 1
+    call_id = _front.next_id
+    future = asyncio.get_running_loop().create_future()
+    _front.pending[call_id] = future
+    _front.writer.write(_encode({'call': [call_id, name, list(args)]}))
+    try:
+        return await asyncio.wait_for(future, CLUSTER_CALL_TIMEOUT)
+    finally:
+        _front.pending.pop(call_id, None)
+
+def _answer(data) -> dict:
+    call_id, name, args = data
+    function = _front_functions().get(name)
+    if function is None:
+        return {'result': [call_id, None, f"неизвестный вызов {name}"]}
+    try:
+        return {'result': [call_id, function(*args)]}
+    except Exception as e:
+        logger.error(f"Кластер: ошибка вызова {name}: {e}")
+        return {'result': [call_id, None, str(e)]}
+
+def _stop_signals(stop_event: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+
+# ========== ПРИЁМНЫЙ ПРОЦЕСС ==========
+class _WorkerLink:
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.routed = 0
+
+    def send_nowait(self, message: dict):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(_encode(message))
+
+    async def send(self, message: dict):
+        await self.connected.wait()
+        async with self.lock:
+            self.writer.write(_encode(message))
+            await self.writer.drain()  # обработчик не успевает — тормозим приём
+
+
+class Front:
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = CLUSTER_WORKERS):
+        self.dp = dp
+        self.bot = bot
+        self.links = [_WorkerLink(index) for index in range(workers)]
+        self._server = None
+        self._supervisors = []
+        self._stopping = False
+        self._loop = None
+
+    async def route(self, update: Update):
+        link = self.links[abs(_user_id(update)) % len(self.links)]
+        link.routed += 1
+        await link.send({'update': update.model_dump(mode='json', by_alias=True, exclude_none=True)})
+
+    def _broadcast(self, event: Event, exclude: _WorkerLink = None):
+        for link in self.links:
+            if link is not exclude:
+                link.send_nowait({'event': event.to_json()})
+
+    def _publish(self, event: Event):
+        # Вызывается из потоков пула БД — пишем в сокеты из event loop
+        self._loop.call_soon_threadsafe(self._broadcast, event)
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        link = None
+        try:
+            hello = json.loads(await reader.readline() or b'{}')
+            link = self.links[hello['hello']]
+            link.writer = writer
+            link.connected.set()
+            logger.info(f"Кластер: обработчик {link.index} подключён")
+            while line := await reader.readline():
+                message = json.loads(line)
+                if 'call' in message:
+                    link.send_nowait(_answer(message['call']))
+                    continue
+                event = _parse_event(message['event']) if 'event' in message else None
+                if event is not None:
+                    await _apply(event)
+                    self._broadcast(event, exclude=link)
+                    invalidation.forward(event, skip=self._publish)  # журнал в БД для других экземпляров
+        except (KeyError, IndexError, ValueError) as e:
+            logger.error(f"Кластер: неверное сообщение обработчика: {e}")
+        except ConnectionError:
+            pass
+        finally:
+            if link is not None and link.writer is writer:
+                link.connected.clear()
+                link.writer = None
+                logger.warning(f"Кластер: обработчик {link.index} отключился")
+            writer.close()
+
+    async def _supervise(self, link: _WorkerLink):
+        script = os.path.abspath(sys.argv[0])
+        while not self._stopping:
+            link.process = await asyncio.create_subprocess_exec(
+                sys.executable, script, env={**os.environ, WORKER_ENV: str(link.index)}
+            )
+            code = await link.process.wait()
+            if self._stopping:
+                break
+            logger.error(f"Кластер: обработчик {link.index} завершился с кодом {code}, перезапуск")
+            await asyncio.sleep(1)
+
+    async def _poll(self):
+        await self.bot.delete_webhook()
+        allowed = self.dp.resolve_used_update_types()
+        offset = None
+        failures = 0
+        while True:
+            try:
+                updates = await self.bot.get_updates(offset=offset, timeout=CLUSTER_POLL_TIMEOUT,
+                                                     allowed_updates=allowed)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.error(f"Кластер: ошибка getUpdates: {e}")
+                await asyncio.sleep(min(failures, 30))
+                continue
+            for update in updates:
+                await self.route(update)
+                offset = update.update_id + 1
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        if os.path.exists(CLUSTER_SOCKET):
+            os.unlink(CLUSTER_SOCKET)  # остался от прошлого запуска
+        self._server = await asyncio.start_unix_server(self._on_connect, CLUSTER_SOCKET)
+        invalidation.subscribe(self._publish)
+        self._supervisors = [asyncio.create_task(self._supervise(link)) for link in self.links]
+        logger.info(f"Кластер: запущено обработчиков {len(self.links)}")
+        try:
+            if BOT_MODE == 'webhook':
+                import webhook
+                await webhook.run(self.dp, self.bot, process=self.route)
+            else:
+                stop_event = asyncio.Event()
+                _stop_signals(stop_event)
+                poller = asyncio.create_task(self._poll())
+                await asyncio.wait({poller, asyncio.create_task(stop_event.wait())},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+                await self.bot.session.close()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        self._stopping = True
+        invalidation.unsubscribe(self._publish)
+        for link in self.links:
+            link.send_nowait({'stop': True})
+        processes = [link.process for link in self.links if link.process is not None]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in processes)), CLUSTER_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+        await asyncio.gather(*self._supervisors, return_exceptions=True)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if os.path.exists(CLUSTER_SOCKET):
+            os.unlink(CLUSTER_SOCKET)
+
+    def stats(self) -> list:
+        return [{'worker': link.index, 'connected': link.connected.is_set(), 'routed': link.routed}
+                for link in self.links]
+
+
+# ========== ОБРАБОТЧИК ==========
+class _UserQueues:
+    """Обновления одного пользователя — строго по очереди, разных — параллельно."""
+
+    def __init__(self, process, concurrency: int, backlog: int):
+        self._process = process
+        self._pending = {}  # user_id -> deque обновлений
+        self._running = asyncio.Semaphore(concurrency)
+        self._backlog = asyncio.Semaphore(backlog)
+        self._tasks = set()
+
+    async def put(self, user_id: int, update: Update):
+        await self._backlog.acquire()  # переполнено — перестаём читать сокет
+        queue = self._pending.get(user_id)
+        if queue is not None:
+            queue.append(update)
+            return
+        self._pending[user_id] = deque([update])
+        task = asyncio.create_task(self._drain(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, user_id: int):
+        queue = self._pending[user_id]
+        async with self._running:
+            while queue:
+                update = queue.popleft()
+                try:
+                    await self._process(update)
+                except Exception:
+                    logger.exception(f"Ошибка обработки обновления {update.update_id}")
+                finally:
+                    self._backlog.release()
+        del self._pending[user_id]
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+async def _connect(path: str):
+    for attempt in range(50):
+        try:
+            return await asyncio.open_unix_connection(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            await asyncio.sleep(0.2)
+    return await asyncio.open_unix_connection(path)
+
+async def run_worker(dp: Dispatcher, bot: Bot, index: int):
+    """Цикл процесса-обработчика: обновления из сокета в dp.feed_update до команды stop."""
+    global _front
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C получает вся группа — останавливает приёмный
+    loop = asyncio.get_running_loop()
+    reader, writer = await _connect(CLUSTER_SOCKET)
+    writer.write(_encode({'hello': index}))
+    _front = _FrontLink(writer)
+
+    def publish(event: Event):
+        loop.call_soon_threadsafe(writer.write, _encode({'event': event.to_json()}))
+    invalidation.subscribe(publish)
+
+    workflow_data = {'dispatcher': dp, 'bots': [bot], **dp.workflow_data}
+
+    async def process(update: Update):
+        await dp.feed_update(bot, update, **workflow_data)
+
+    queues = _UserQueues(process, CLUSTER_WORKER_CONCURRENCY, CLUSTER_WORKER_BACKLOG)
+    await dp.emit_startup(bot=bot, **workflow_data)
+    logger.info(f"Кластер: обработчик {index} запущен (pid {os.getpid()})")
+    try:
+        while line := await reader.readline():
+            message = json.loads(line)
+            if 'update' in message:
+                update = Update.model_validate(message['update'], context={'bot': bot})
+                await queues.put(abs(_user_id(update)), update)
+            elif 'result' in message:
+                _front.resolve(message['result'])
+            elif 'event' in message:
+                event = _parse_event(message['event'])
+                if event is not None:
+                    await _apply(event)
+            elif message.get('stop'):
+                break
+    finally:
+        invalidation.unsubscribe(publish)
+        _front.fail_all()  # ответы больше не читаются
+        _front = None
+        await queues.join()
+        await dp.emit_shutdown(bot=bot, **workflow_data)
+        writer.close()
+        await bot.session.close()
+        logger.info(f"Кластер: обработчик {index} остановлен")
+
+def share_limits():
+    """Лимит отправки на бота делится между приёмным процессом и обработчиками."""
+    outbox.outbox.share(CLUSTER_WORKERS + 1)
@@ -141,3 +141,108 @@ ITEMS_PER_PAGE = int(os.getenv("ITEMS_PER_PAGE", "10"))                 # эле
 # ========== Бекапы ==========
 AUTO_BACKUP_INTERVAL_HOURS = int(os.getenv("AUTO_BACKUP_INTERVAL_HOURS", "6"))  # авто-бекап каждые 6 часов
 BACKUP_KEEP_COUNT = int(os.getenv("BACKUP_KEEP_COUNT", "7"))                    # хранить последние 7 бекапов
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "4096"))         # страниц за шаг backup API (~16 МБ)
+BACKUP_COMPRESS_LEVEL = int(os.getenv("BACKUP_COMPRESS_LEVEL", "6"))            # уровень gzip, 1 — быстрее, 9 — меньше
+BACKUP_PART_SIZE = int(os.getenv("BACKUP_PART_SIZE", str(45 * 1024 * 1024)))    # часть для отправки, лимит Bot API 50 МБ
+
+# ========== Асинхронный доступ к БД ==========
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))  # потоков для синхронных запросов из database_async
+
+# ========== Пул соединений SQLite ==========
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", "4"))                # соединений только для чтения
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))             # секунд ожидания свободного соединения
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))       # PRAGMA busy_timeout
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")                  # NORMAL безопасен в режиме WAL
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))          # страничный кэш на соединение, КБ
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", "134217728"))              # 128 МБ memory-mapped I/O
+
+# ========== Троттлинг ==========
+# Бюджеты: (запросов, за секунд). Общий лимит на пользователя — MAX_REQUESTS_PER_MINUTE
+THROTTLE_ROUTER_BUDGETS = {
+    'games': (20, 60),      # игры дешевле всего заспамить
+    'shop': (15, 60),       # покупки и оплата
+}
+THROTTLE_CALLBACK_BUDGETS = {
+    'game': (20, 60),
+    'stars': (10, 60),
+    'order': (10, 60),
+    'withdrawal': (5, 60),
+    'exchange': (5, 60),
+}
+THROTTLE_MAX_BUCKETS = int(os.getenv("THROTTLE_MAX_BUCKETS", "100000"))  # после этого простаивающие корзины удаляются
+
+# ========== Единый кэш ==========
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "60"))               # окна «за N дней» сдвигаются со временем
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "50000"))        # всего записей, дальше вытесняются самые старые
+CACHE_NAMESPACE_TTLS = {                                                # секунд, None — до инвалидации
+    'balance': CACHE_TTL_BALANCE,
+    'roles': None,
+    'stats': STATS_CACHE_TTL,
+}
+
+# ========== Рассылки ==========
+MAILING_RATE = float(os.getenv("MAILING_RATE", "25"))                    # сообщений в секунду на весь бот (лимит Telegram ~30)
+MAILING_CONCURRENCY = int(os.getenv("MAILING_CONCURRENCY", "10"))        # одновременных запросов к API
+MAILING_BATCH_SIZE = int(os.getenv("MAILING_BATCH_SIZE", "200"))         # получателей между контрольными точками
+MAILING_AUDIENCE_BATCH = int(os.getenv("MAILING_AUDIENCE_BATCH", "1000"))  # user_id за один запрос при выборке аудитории
+MAILING_MAX_RETRIES = int(os.getenv("MAILING_MAX_RETRIES", "3"))         # повторов после RetryAfter на одного получателя
+MAILING_PROGRESS_INTERVAL = float(os.getenv("MAILING_PROGRESS_INTERVAL", "5"))  # секунд между обновлениями прогресса
+MAILING_POLL_INTERVAL = float(os.getenv("MAILING_POLL_INTERVAL", "30"))  # проверка отложенных рассылок планировщиком
+
+# ========== Планировщик ==========
+SCREENSHOTS_CLEANUP_CRON = os.getenv("SCREENSHOTS_CLEANUP_CRON", "30 4 * * *")  # очистка старых скриншотов
+SCREENSHOTS_KEEP_DAYS = int(os.getenv("SCREENSHOTS_KEEP_DAYS", "30"))
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", "60"))            # секунд случайного сдвига тяжёлых задач
+
+# ========== Хранилище FSM ==========
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")                         # sqlite — переживает перезапуск, memory — как раньше
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", "fsm.db")                         # отдельный файл, восстановление бекапа его не трогает
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))               # горячих ключей в памяти
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1"))         # секунд между пачками записи
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(24 * 3600)))          # брошенный сценарий сбрасывается через сутки
+
+# ========== Вебхук ==========
+BOT_MODE = os.getenv("BOT_MODE", "polling")                              # polling или webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                               # публичный https-адрес бота без пути
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")                         # пусто — новый секрет на каждый запуск
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))        # принятых, но не обработанных обновлений
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))                # одновременно обрабатываемых обновлений
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # параллельных запросов от Telegram (1–100)
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))  # секунд на дообработку очереди при остановке
+
+# ========== Исходящие сообщения ==========
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))        # сообщений в секунду на бота (лимит Bot API)
+OUTBOX_GLOBAL_BURST = float(os.getenv("OUTBOX_GLOBAL_BURST", "10"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))             # в секунду в один личный чат
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "3"))           # короткая серия ответов без ожидания
+OUTBOX_GROUP_PER_MINUTE = float(os.getenv("OUTBOX_GROUP_PER_MINUTE", "20"))  # в минуту в одну группу
+OUTBOX_GROUP_BURST = float(os.getenv("OUTBOX_GROUP_BURST", "3"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))           # повторов после RetryAfter
+OUTBOX_MAX_CHATS = int(os.getenv("OUTBOX_MAX_CHATS", "50000"))           # после этого простаивающие чаты забываются
+
+# ========== Кластер ==========
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "0"))                 # процессов-обработчиков, 0/1 — один процесс как раньше
+CLUSTER_SOCKET = os.getenv("CLUSTER_SOCKET", "cluster.sock")            # Unix-сокет между приёмным процессом и обработчиками
+CLUSTER_WORKER_CONCURRENCY = int(os.getenv("CLUSTER_WORKER_CONCURRENCY", "64"))  # пользователей одновременно в обработчике
+CLUSTER_WORKER_BACKLOG = int(os.getenv("CLUSTER_WORKER_BACKLOG", "1000"))  # принятых обновлений, дальше сокет не читается
+CLUSTER_POLL_TIMEOUT = int(os.getenv("CLUSTER_POLL_TIMEOUT", "30"))      # long polling getUpdates, секунд
+CLUSTER_STOP_TIMEOUT = float(os.getenv("CLUSTER_STOP_TIMEOUT", "30"))    # секунд на остановку обработчиков
+CLUSTER_CALL_TIMEOUT = float(os.getenv("CLUSTER_CALL_TIMEOUT", "10"))    # секунд на ответ приёмного процесса (/runjob, /jobs)
+
+# ========== Инвалидация между процессами ==========
+INVALIDATION_POLL_INTERVAL = float(os.getenv("INVALIDATION_POLL_INTERVAL", "0.5"))  # секунд между проверками PRAGMA data_version
+INVALIDATION_KEEP_SECONDS = int(os.getenv("INVALIDATION_KEEP_SECONDS", "3600"))     # сколько хранить журнал событий
+
+# ========== Метрики ==========
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")   # адрес /metrics для Prometheus, наружу не открывать
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))       # порт /metrics, 0 — выключено; обработчики кластера — порт + номер + 1
+
+# ========== Трассировка SQL ==========
+SQL_TRACE = os.getenv("SQL_TRACE", "0") == "1"                    # замер всех запросов к БД (/sqltop), по умолчанию выключен
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "50"))                  # порог медленного запроса, мс
+SQL_SLOW_LOG = os.getenv("SQL_SLOW_LOG", "slow_queries.log")         # файл лога медленных запросов, пусто — только общий лог
+SQL_TRACE_MAX_STATEMENTS = int(os.getenv("SQL_TRACE_MAX_STATEMENTS", "1000"))  # разных запросов в статистике
+SQL_PLAN_REFRESH = float(os.getenv("SQL_PLAN_REFRESH", "300"))        # через сколько секунд план медленного запроса снимается заново
@@ -7,49 +7,60 @@ import time
 import os
 import shutil
 import glob
+import gzip
+import hashlib
 import random
 import string
 from datetime import datetime, timedelta
 from contextlib import contextmanager
 from config import *
+import db_pool
+import registry
+import settings
+import leaderboard
+import invalidation
+from cache import cache, cached
 
 logger = logging.getLogger(__name__)
 
-# ========== IN-MEMORY CACHE ==========
-_cache = {}
-_cache_ttl = {}
+# ========== КЭШ ДОСТУПА ==========
+# Роль пользователя для мидлвари и has_access (пространство имён 'roles' единого
+# кэша). Баны и заморозки хранит registry. Запись сбрасывает set_user_role.
+ACCESS_QUERY = "SELECT role FROM users WHERE user_id = ?"
 
-def cache_get(key: str):
-    if key in _cache and key in _cache_ttl:
-        if time.time() < _cache_ttl[key]:
-            return _cache[key]
-        else:
-            del _cache[key]
-            del _cache_ttl[key]
-    return None
-
-def cache_set(key: str, value, ttl: int = 60):
-    _cache[key] = value
-    _cache_ttl[key] = time.time() + ttl
+def make_access_record(row) -> dict:
+    return {'role': (row[0] if row else None) or 'user'}
 
-def cache_delete(key: str):
-    if key in _cache:
-        del _cache[key]
-    if key in _cache_ttl:
-        del _cache_ttl[key]
+def invalidate_access(user_id: int):
+    cache.delete('roles', user_id)
 
-def cache_clear():
-    _cache.clear()
-    _cache_ttl.clear()
+def get_access_record(user_id: int) -> dict:
+    record = cache.get('roles', user_id)
+    if record is not None:
+        return record
+    conn = get_read_connection()
+    try:
+        row = conn.execute(ACCESS_QUERY, (user_id,)).fetchone()
+    finally:
+        conn.close()
+    record = make_access_record(row)
+    cache.set('roles', user_id, record)
+    return record
 
 def get_db_connection():
-    return sqlite3.connect(DATABASE_NAME)
+    """Соединение-писатель из пула. close() возвращает его в пул."""
+    return db_pool.get_pool(DATABASE_NAME).writer()
 
-# ========== ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ (ВСЕ ТАБЛИЦЫ) ==========
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def get_read_connection():
+    """Соединение только для чтения: не ждёт писателя благодаря WAL."""
+    return db_pool.get_pool(DATABASE_NAME).reader()
 
+# ========== ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ (ВСЕ ТАБЛИЦЫ) ==========
+# ========== МИГРАЦИИ СХЕМЫ ==========
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется один
+# раз, в своей транзакции; новые изменения схемы добавляются в конец MIGRATIONS.
+def _migrate_baseline(cursor):
+    """Базовая схема: все таблицы, индексы admin_logs, достижения и настройки."""
     # --- СУЩЕСТВУЮЩИЕ ТАБЛИЦЫ ---
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -487,14 +498,151 @@ def init_db():
             default_settings
         )
 
-    conn.commit()
-    conn.close()
-    logger.info("База данных инициализирована/обновлена")
+def _migrate_hot_indexes(cursor):
+    """Индексы для горячих запросов: рефералы, заказы, тикеты, игры, скидки."""
+    indexes = [
+        ('idx_users_referrer', 'users(referrer_id)'),
+        ('idx_users_username', 'users(username COLLATE NOCASE)'),
+        ('idx_orders_user_status', 'orders(user_id, status)'),
+        ('idx_orders_status_date', 'orders(status, created_at)'),
+        ('idx_purchase_history_user', 'purchase_history(user_id)'),
+        ('idx_purchase_history_date', 'purchase_history(purchase_date)'),
+        ('idx_tickets_status_date', 'tickets(status, created_at)'),
+        ('idx_tickets_topic', 'tickets(topic_id)'),
+        ('idx_ticket_messages_ticket', 'ticket_messages(ticket_id, created_at)'),
+        ('idx_games_user_type', 'games(user_id, game_type)'),
+        ('idx_referral_rewards_referrer', 'referral_rewards(referrer_id, paid)'),
+        ('idx_user_discounts_user', 'user_discounts(user_id, used)'),
+    ]
+    for name, target in indexes:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {target}')
+    cursor.execute('ANALYZE')
+
+def _rebuild_sales_daily(cursor):
+    """Пересчитывает sales_daily и sales_daily_buyers по purchase_history."""
+    cursor.execute("DELETE FROM sales_daily")
+    cursor.execute("DELETE FROM sales_daily_buyers")
+    cursor.execute('''
+        INSERT INTO sales_daily_buyers (day, user_id)
+        SELECT DISTINCT DATE(purchase_date), user_id FROM purchase_history
+    ''')
+    cursor.execute('''
+        INSERT INTO sales_daily (day, orders, revenue, discount, buyers)
+        SELECT DATE(h.purchase_date), COUNT(*), COALESCE(SUM(h.total_price), 0),
+               COALESCE(SUM(o.discount), 0), COUNT(DISTINCT h.user_id)
+        FROM purchase_history h
+        LEFT JOIN orders o ON o.id = h.order_id
+        GROUP BY DATE(h.purchase_date)
+    ''')
+
+def _migrate_sales_daily(cursor):
+    """Дневной свод продаж и его заполнение из истории покупок."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT PRIMARY KEY,
+            orders INTEGER DEFAULT 0,
+            revenue REAL DEFAULT 0,
+            discount REAL DEFAULT 0,
+            buyers INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sales_daily_buyers (
+            day TEXT,
+            user_id INTEGER,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    _rebuild_sales_daily(cursor)
+
+def _migrate_mailing_progress(cursor):
+    """Контрольная точка и сообщение прогресса для фоновых рассылок."""
+    columns = [
+        ('last_user_id', 'INTEGER DEFAULT 0'),
+        ('progress_chat_id', 'INTEGER'),
+        ('progress_message_id', 'INTEGER'),
+        ('started_at', 'TIMESTAMP'),
+        ('finished_at', 'TIMESTAMP'),
+    ]
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(mailings)")}
+    for name, definition in columns:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE mailings ADD COLUMN {name} {definition}")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mailings_status ON mailings(status, created_at)')
+
+def _migrate_delivery_status(cursor):
+    """Отметка о блокировке бота и счётчик неудачных доставок у пользователя."""
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(users)")}
+    if 'bot_blocked_at' not in existing:
+        cursor.execute("ALTER TABLE users ADD COLUMN bot_blocked_at TIMESTAMP")
+    if 'delivery_failures' not in existing:
+        cursor.execute("ALTER TABLE users ADD COLUMN delivery_failures INTEGER DEFAULT 0")
+    # Частичный индекс: аудитории рассылок идут только по достижимым пользователям
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_reachable ON users(user_id) WHERE bot_blocked_at IS NULL')
+
+def _migrate_scheduler(cursor):
+    """Последние запуски задач планировщика."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_jobs (
+            name TEXT PRIMARY KEY,
+            last_run_at TIMESTAMP,
+            last_duration REAL,
+            last_error TEXT,
+            run_count INTEGER DEFAULT 0,
+            fail_count INTEGER DEFAULT 0
+        )
+    ''')
+
+def _migrate_invalidations(cursor):
+    """Журнал событий инвалидации для других процессов (см. invalidation.py)."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS invalidations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            key TEXT,
+            origin TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_invalidations_created ON invalidations(created_at)')
+
+MIGRATIONS = [
+    (1, "базовая схема", _migrate_baseline),
+    (2, "индексы горячих запросов", _migrate_hot_indexes),
+    (3, "дневной свод продаж", _migrate_sales_daily),
+    (4, "прогресс рассылок", _migrate_mailing_progress),
+    (5, "статус доставки пользователям", _migrate_delivery_status),
+    (6, "планировщик задач", _migrate_scheduler),
+    (7, "журнал инвалидации", _migrate_invalidations),
+]
+
+def init_db():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        current = cursor.execute("PRAGMA user_version").fetchone()[0]
+        pending = [m for m in MIGRATIONS if m[0] > current]
+        if not pending:
+            logger.info(f"Схема БД актуальна (версия {current})")
+            return
+        for version, description, migrate in pending:
+            migrate(cursor)
+            # PRAGMA не принимает параметры, version — целое из MIGRATIONS
+            cursor.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+            logger.info(f"Миграция БД {version}: {description}")
+        logger.info(f"База данных обновлена до версии {pending[-1][0]}")
+    except Exception:
+        conn.rollback()
+        logger.exception("Ошибка миграции БД")
+        raise
+    finally:
+        conn.close()
 
 # ========== ОСНОВНЫЕ ФУНКЦИИ ==========
 
 def get_user(user_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
     user = cursor.fetchone()
@@ -510,6 +658,8 @@ def create_user(user_id: int, username: str, full_name: str):
             (user_id, username, full_name)
         )
         conn.commit()
+        cache.invalidate_tag('users')
+        invalidation.publish(invalidation.USER, user_id)
         logger.info(f"Создан пользователь: {user_id}, {username}, {full_name}")
     except sqlite3.IntegrityError:
         cursor.execute(
@@ -517,6 +667,8 @@ def create_user(user_id: int, username: str, full_name: str):
             (username, full_name, user_id)
         )
         conn.commit()
+        leaderboard.rename(user_id, username, full_name)
+        invalidation.publish(invalidation.USER, user_id)
         logger.info(f"Обновлен пользователь: {user_id}, {username}, {full_name}")
     except Exception as e:
         conn.rollback()
@@ -539,6 +691,10 @@ def set_user_role(user_id: int, role: str):
             (role, user_id)
         )
         conn.commit()
+        invalidate_access(user_id)
+        leaderboard.set_role(user_id, role)
+        cache.invalidate_tag('users')
+        invalidation.publish(invalidation.ROLE, user_id)
         logger.info(f"Пользователю {user_id} установлена роль: {role}")
     except Exception as e:
         conn.rollback()
@@ -547,7 +703,7 @@ def set_user_role(user_id: int, role: str):
         conn.close()
 
 def get_user_by_id_or_username(identifier: str):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     try:
         user_id = int(identifier)
@@ -559,13 +715,13 @@ def get_user_by_id_or_username(identifier: str):
     except ValueError:
         pass
     clean_identifier = identifier.lstrip('@')
-    cursor.execute("SELECT * FROM users WHERE username = ?", (clean_identifier,))
+    cursor.execute("SELECT * FROM users WHERE username = ? COLLATE NOCASE", (clean_identifier,))
     user = cursor.fetchone()
     conn.close()
     return user
 
 def get_user_by_referral_code(code: str):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM users WHERE referral_code = ?", (code.upper(),))
     user = cursor.fetchone()
@@ -626,7 +782,7 @@ def add_referral(referrer_id: int, referred_id: int):
         conn.close()
 
 def get_user_referrals(user_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         """SELECT u.user_id, u.username, u.full_name, u.created_at 
@@ -701,7 +857,7 @@ def update_ticket_topic(ticket_id: int, topic_id: int, topic_name: str = None):
         conn.close()
 
 def get_ticket(ticket_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM tickets WHERE id = ?", (ticket_id,))
     ticket = cursor.fetchone()
@@ -709,7 +865,7 @@ def get_ticket(ticket_id: int):
     return ticket
 
 def get_ticket_by_topic_id(topic_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM tickets WHERE topic_id = ?", (topic_id,))
     ticket = cursor.fetchone()
@@ -717,7 +873,7 @@ def get_ticket_by_topic_id(topic_id: int):
     return ticket
 
 def get_ticket_messages(ticket_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         """SELECT tm.*, u.username 
@@ -747,7 +903,7 @@ def add_ticket_message(ticket_id: int, user_id: int, message: str, is_from_suppo
         conn.close()
 
 def get_user_tickets(user_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         """SELECT t.*, 
@@ -762,7 +918,7 @@ def get_user_tickets(user_id: int):
     return tickets
 
 def get_all_tickets(status: str = None):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     if status:
         cursor.execute("SELECT * FROM tickets WHERE status = ? ORDER BY created_at DESC", (status,))
@@ -850,7 +1006,7 @@ def rate_ticket(ticket_id: int, user_id: int, agent_id: int, rating: int, commen
         conn.close()
 
 def get_agent_stats(agent_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT COUNT(DISTINCT t.id) 
@@ -892,7 +1048,7 @@ def get_top_agents(limit: int = 10):
     Возвращает список лучших агентов по среднему рейтингу.
     Каждый элемент кортежа: (username, full_name, avg_rating, votes)
     """
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT u.username, u.full_name, AVG(tr.rating) as avg_rating, COUNT(tr.id) as votes
@@ -924,7 +1080,7 @@ def create_promocode(code: str, discount_percent: int, max_uses: int = 1, expire
         conn.close()
 
 def get_promocode(code: str):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         "SELECT * FROM promocodes WHERE code = ?",
@@ -999,7 +1155,7 @@ def check_promocode_valid(code: str, user_id: int):
             return False, "Ошибка проверки срока действия промокода"
     if max_uses > 0 and used_count >= max_uses:
         return False, "Промокод уже использован максимальное количество раз"
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     try:
         cursor.execute(
@@ -1013,7 +1169,7 @@ def check_promocode_valid(code: str, user_id: int):
     return True, discount_percent
 
 def get_all_promocodes():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM promocodes ORDER BY created_at DESC")
     rows = cursor.fetchall()
@@ -1050,7 +1206,7 @@ def update_promocode(promocode_id: int, discount: int, max_uses: int, expires_at
         conn.close()
 
 def get_active_promocodes():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     cursor.execute("""
@@ -1086,7 +1242,7 @@ def create_order(user_id: int, amount: int, recipient_username: str, screenshot_
         conn.close()
 
 def get_order_status(order_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         "SELECT status FROM orders WHERE id = ?",
@@ -1096,9 +1252,28 @@ def get_order_status(order_id: int):
     conn.close()
     return result[0] if result else None
 
+def _record_daily_sale(cursor, user_id: int, revenue: float, discount: float):
+    """Обновляет sales_daily в транзакции вставки в purchase_history."""
+    cursor.execute(
+        "INSERT OR IGNORE INTO sales_daily_buyers (day, user_id) VALUES (DATE('now'), ?)",
+        (user_id,)
+    )
+    new_buyer = cursor.rowcount
+    cursor.execute(
+        """INSERT INTO sales_daily (day, orders, revenue, discount, buyers)
+           VALUES (DATE('now'), 1, ?, ?, ?)
+           ON CONFLICT(day) DO UPDATE SET
+               orders = orders + 1,
+               revenue = revenue + excluded.revenue,
+               discount = discount + excluded.discount,
+               buyers = buyers + excluded.buyers""",
+        (revenue, discount, new_buyer)
+    )
+
 def update_order_status(order_id: int, status: str):
     conn = get_db_connection()
     cursor = conn.cursor()
+    purchase = None
     try:
         cursor.execute(
             "UPDATE orders SET status = ? WHERE id = ?",
@@ -1119,14 +1294,22 @@ def update_order_status(order_id: int, status: str):
                     VALUES (?, ?, ?, ?)""",
                     (user_id, order_id, amount, final_price)
                 )
+                purchase_id = cursor.lastrowid
                 cursor.execute(
                     "UPDATE users SET total_spent = total_spent + ? WHERE user_id = ?",
                     (final_price, user_id)
                 )
+                _record_daily_sale(cursor, user_id, final_price, discount or 0)
                 user = get_user(user_id)
                 if user and user[9]:
                     create_referral_reward(user[9], user_id, order_id, final_price)
+                if user:
+                    purchase = (purchase_id, user_id, final_price, user[2], user[3], user[7])
         conn.commit()
+        if purchase:
+            leaderboard.record_purchase(*purchase)
+            cache.invalidate_tag('purchases')
+            invalidation.publish(invalidation.PURCHASES)
     except Exception as e:
         conn.rollback()
         logger.error(f"Ошибка обновления статуса заказа: {e}")
@@ -1134,7 +1317,7 @@ def update_order_status(order_id: int, status: str):
         conn.close()
 
 def get_user_orders(user_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         """SELECT o.id, o.amount, o.total_price - o.discount as final_price, o.status, o.created_at, 
@@ -1150,7 +1333,7 @@ def get_user_orders(user_id: int):
     return orders
 
 def get_pending_orders():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         """SELECT o.*, u.username as buyer_username 
@@ -1230,7 +1413,7 @@ def create_withdrawal(user_id: int, amount: int, screenshot_path: str, recipient
         conn.close()
 
 def get_pending_withdrawals():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         """SELECT w.*, u.username, u.user_id as buyer_id 
@@ -1290,7 +1473,7 @@ def create_exchange(user_id: int, from_currency: str, to_currency: str, amount:
         conn.close()
 
 def get_exchange(exchange_id: str):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM exchanges WHERE exchange_id = ?", (exchange_id,))
     row = cursor.fetchone()
@@ -1356,7 +1539,7 @@ def update_game_result(game_id: str, win_amount: int, result: str, dice_message_
         conn.close()
 
 def check_game_processed(game_id: str):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     try:
         cursor.execute(
@@ -1406,7 +1589,7 @@ def create_referral_reward(referrer_id: int, referred_id: int, purchase_id: int,
         conn.close()
 
 def get_referral_stats(user_id: int) -> dict:
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
 
     cursor.execute("SELECT COUNT(*) FROM users WHERE referrer_id = ?", (user_id,))
@@ -1471,7 +1654,7 @@ def add_warn(user_id: int, reason: str, moderator_id: int):
         conn.close()
 
 def get_warns(user_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         "SELECT * FROM warns WHERE user_id = ? ORDER BY created_at DESC",
@@ -1503,6 +1686,8 @@ def add_ban(user_id: int, reason: str, moderator_id: int, banned_until=None):
             (user_id, reason, moderator_id, banned_until)
         )
         conn.commit()
+        registry.set_ban(user_id, reason, banned_until)
+        invalidation.publish(invalidation.ACCESS, user_id)
     except Exception as e:
         conn.rollback()
         logger.error(f"Ошибка добавления бана: {e}")
@@ -1515,6 +1700,8 @@ def remove_ban(user_id: int):
     try:
         cursor.execute("DELETE FROM bans WHERE user_id = ?", (user_id,))
         conn.commit()
+        registry.drop_ban(user_id)
+        invalidation.publish(invalidation.ACCESS, user_id)
     except Exception as e:
         conn.rollback()
         logger.error(f"Ошибка удаления бана: {e}")
@@ -1522,42 +1709,44 @@ def remove_ban(user_id: int):
         conn.close()
 
 def get_ban(user_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM bans WHERE user_id = ?", (user_id,))
     ban = cursor.fetchone()
     conn.close()
     return ban
 
-def is_user_banned(user_id: int) -> bool:
-    ban = get_ban(user_id)
-    if not ban:
-        return False
-    banned_until = ban[4]
-    if banned_until:
+def parse_ban_until(banned_until):
+    """banned_until из таблицы bans -> datetime (None для бессрочного бана)."""
+    if not banned_until:
+        return None
+    if isinstance(banned_until, datetime):
+        return banned_until
+    date_formats = [
+        '%Y-%m-%d %H:%M:%S.%f',
+        '%Y-%m-%d %H:%M:%S',
+        '%Y-%m-%d %H:%M',
+        '%Y-%m-%d'
+    ]
+    for date_format in date_formats:
         try:
-            date_formats = [
-                '%Y-%m-%d %H:%M:%S.%f',
-                '%Y-%m-%d %H:%M:%S',
-                '%Y-%m-%d %H:%M',
-                '%Y-%m-%d'
-            ]
-            banned_until_datetime = None
-            for date_format in date_formats:
-                try:
-                    banned_until_datetime = datetime.strptime(banned_until, date_format)
-                    break
-                except ValueError:
-                    continue
-            if banned_until_datetime and banned_until_datetime < datetime.now():
-                remove_ban(user_id)
-                return False
-        except Exception as e:
-            logger.error(f"Ошибка парсинга даты бана {banned_until}: {e}")
-    return True
+            return datetime.strptime(banned_until, date_format)
+        except ValueError:
+            continue
+    logger.error(f"Ошибка парсинга даты бана {banned_until}")
+    return None
+
+def is_ban_expired(banned_until) -> bool:
+    """Истёк ли временный бан (banned_until из таблицы bans)."""
+    until = parse_ban_until(banned_until)
+    return bool(until and until < datetime.now())
+
+def is_user_banned(user_id: int) -> bool:
+    # Реестр в памяти; истёкшие баны снимает registry в срок
+    return registry.is_banned(user_id)
 
 def get_all_bans():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM bans ORDER BY banned_at DESC")
     bans = cursor.fetchall()
@@ -1573,7 +1762,11 @@ def freeze_user(user_id: int, reason: str, admin_id: int = None) -> bool:
             "INSERT OR REPLACE INTO freezes (user_id, reason, frozen_by) VALUES (?, ?, ?)",
             (user_id, reason, admin_id)
         )
+        cursor.execute("SELECT frozen_at FROM freezes WHERE user_id = ?", (user_id,))
+        frozen_at = cursor.fetchone()[0]
         conn.commit()
+        registry.set_freeze(user_id, reason, frozen_at)
+        invalidation.publish(invalidation.ACCESS, user_id)
         return True
     except Exception as e:
         logger.error(f"Ошибка заморозки: {e}")
@@ -1587,6 +1780,8 @@ def unfreeze_user(user_id: int) -> bool:
     try:
         cursor.execute("DELETE FROM freezes WHERE user_id = ?", (user_id,))
         conn.commit()
+        registry.drop_freeze(user_id)
+        invalidation.publish(invalidation.ACCESS, user_id)
         return cursor.rowcount > 0
     except Exception as e:
         logger.error(f"Ошибка разморозки: {e}")
@@ -1595,26 +1790,14 @@ def unfreeze_user(user_id: int) -> bool:
         conn.close()
 
 def is_user_frozen(user_id: int) -> bool:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM freezes WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+    return registry.is_frozen(user_id)
 
 def get_freeze_info(user_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT reason, frozen_at FROM freezes WHERE user_id = ?",
-        (user_id,)
-    )
-    result = cursor.fetchone()
-    conn.close()
-    return result if result else None
+    freeze = registry.get_freeze(user_id)
+    return (freeze['reason'], freeze['frozen_at']) if freeze else None
 
 def get_all_frozen_users():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT f.user_id, u.username, u.full_name, f.reason, f.frozen_at
@@ -1654,7 +1837,7 @@ def log_admin_action(admin_id: int, action_type: str, target_type: str = None, t
         conn.close()
 
 def get_admin_logs(admin_id: int = None, action_type: str = None, days: int = 7, limit: int = 50):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     query = "SELECT * FROM admin_logs WHERE created_at >= datetime('now', ?)"
     params = [f'-{days} days']
@@ -1672,22 +1855,10 @@ def get_admin_logs(admin_id: int = None, action_type: str = None, days: int = 7,
     return rows
 
 # ========== НАСТРОЙКИ ==========
-_settings_cache = {}
-
 def get_setting(key: str, default=None):
-    if key in _settings_cache:
-        return _settings_cache[key]
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-    row = cursor.fetchone()
-    conn.close()
-    value = row[0] if row else default
-    _settings_cache[key] = value
-    return value
+    return settings.current().get(key, default)
 
 def set_setting(key: str, value: str):
-    global _settings_cache
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
@@ -1696,7 +1867,8 @@ def set_setting(key: str, value: str):
             (key, value)
         )
         conn.commit()
-        _settings_cache[key] = value
+        settings.apply(key, value)
+        invalidation.publish(invalidation.SETTINGS, key)
         return True
     except Exception as e:
         logger.error(f"Ошибка установки настройки {key}: {e}")
@@ -1705,56 +1877,45 @@ def set_setting(key: str, value: str):
         conn.close()
 
 def clear_settings_cache():
-    global _settings_cache
-    _settings_cache = {}
+    settings.reload()
+    invalidation.publish(invalidation.SETTINGS)
 
+# Типизированные значения берутся из снимка settings, без разбора строк
 def get_star_rate():
-    return float(get_setting('star_rate', str(STAR_RATE)))
+    return settings.current().star_rate
 
 def get_min_stars():
-    return int(get_setting('min_stars', str(MIN_STARS)))
+    return settings.current().min_stars
 
 def get_withdraw_commission():
-    return float(get_setting('withdraw_commission', str(WITHDRAW_COMMISSION)))
+    return settings.current().withdraw_commission
 
 def get_exchange_commission():
-    return float(get_setting('exchange_commission', str(EXCHANGE_COMMISSION)))
+    return settings.current().exchange_commission
 
 def get_withdraw_min_real():
-    return int(get_setting('withdraw_min_real', str(WITHDRAW_MIN_REAL)))
+    return settings.current().withdraw_min_real
 
 def get_real_to_virtual_rate():
-    return float(get_setting('real_to_virtual_rate', str(REAL_TO_VIRTUAL_RATE)))
+    return settings.current().real_to_virtual_rate
 
 def get_virtual_to_real_rate():
-    return float(get_setting('virtual_to_real_rate', str(VIRTUAL_TO_REAL_RATE)))
+    return settings.current().virtual_to_real_rate
 
 def get_real_to_virtual_min():
-    return int(get_setting('real_to_virtual_min', str(REAL_TO_VIRTUAL_MIN)))
+    return settings.current().real_to_virtual_min
 
 def get_virtual_to_real_commission():
-    return float(get_setting('virtual_to_real_commission', str(VIRTUAL_TO_REAL_COMMISSION)))
+    return settings.current().virtual_to_real_commission
 
 def is_rounding_enabled():
-    return get_setting('rounding_enabled', '1') == '1'
+    return settings.current().rounding_enabled
 
 def get_referral_levels():
-    levels_json = get_setting('referral_levels', '[]')
-    try:
-        return json.loads(levels_json)
-    except:
-        return [
-            {"min": 0, "max": 5, "percent": 5, "name": "Бронзовый"},
-            {"min": 5, "max": 20, "percent": 7, "name": "Серебряный"},
-            {"min": 20, "max": 999999, "percent": 10, "name": "Золотой"}
-        ]
+    return [dict(level) for level in settings.current().referral_levels]
 
 def get_referral_level(referrals_count: int):
-    levels = get_referral_levels()
-    for level in levels:
-        if level["min"] <= referrals_count < level["max"]:
-            return level
-    return levels[0]
+    return settings.current().referral_level(referrals_count)
 
 def set_maintenance_mode(enabled: bool, reason: str = None, duration_minutes: int = None):
     set_setting('maintenance_mode', '1' if enabled else '0')
@@ -1767,31 +1928,30 @@ def set_maintenance_mode(enabled: bool, reason: str = None, duration_minutes: in
         set_setting('maintenance_until', '')
 
 def is_maintenance_mode() -> bool:
-    return get_setting('maintenance_mode', '0') == '1'
+    return settings.current().maintenance_mode
 
 def get_maintenance_info() -> dict:
-    reason = get_setting('maintenance_reason', 'Плановые работы')
-    until_str = get_setting('maintenance_until', '')
+    snapshot = settings.current()
+    reason = snapshot.maintenance_reason
+    until_str = snapshot.get('maintenance_until', '')
+    until = snapshot.maintenance_until
     remaining = "не определено"
     if until_str:
-        try:
-            until = datetime.strptime(until_str, '%Y-%m-%d %H:%M:%S')
-            now = datetime.now()
-            if until > now:
-                delta = until - now
-                total_seconds = int(delta.total_seconds())
-                if total_seconds < 60:
-                    remaining = f"{total_seconds} сек"
-                elif total_seconds < 3600:
-                    remaining = f"{total_seconds // 60} мин"
-                elif total_seconds < 86400:
-                    remaining = f"{total_seconds // 3600} час"
-                else:
-                    remaining = f"{total_seconds // 86400} дн"
-            else:
-                remaining = "истекло"
-        except:
+        now = datetime.now()
+        if until is None:
             remaining = "ошибка"
+        elif until > now:
+            total_seconds = int((until - now).total_seconds())
+            if total_seconds < 60:
+                remaining = f"{total_seconds} сек"
+            elif total_seconds < 3600:
+                remaining = f"{total_seconds // 60} мин"
+            elif total_seconds < 86400:
+                remaining = f"{total_seconds // 3600} час"
+            else:
+                remaining = f"{total_seconds // 86400} дн"
+        else:
+            remaining = "истекло"
     return {
         'reason': reason,
         'remaining': remaining,
@@ -1800,7 +1960,7 @@ def get_maintenance_info() -> dict:
 
 # ========== ДОСТИЖЕНИЯ ==========
 def get_user_achievements(user_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT al.code, al.name, al.description, al.icon, ua.earned_at
@@ -1846,7 +2006,7 @@ def remove_achievement_from_user(user_id: int, ach_code: str):
         conn.close()
 
 def get_all_achievements():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM achievements_list ORDER BY created_at")
     rows = cursor.fetchall()
@@ -1900,7 +2060,7 @@ def update_achievement(code: str, name: str, description: str, icon: str, hidden
         conn.close()
 
 def get_achievement_stats(code: str):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM user_achievements WHERE ach_code = ?", (code,))
     count = cursor.fetchone()[0]
@@ -1926,7 +2086,7 @@ def create_discount_link(discount_percent: int, max_uses: int = 1, expires_at: d
         conn.close()
 
 def get_discount_link(code: str):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM discount_links WHERE code = ?", (code,))
     link = cursor.fetchone()
@@ -1968,7 +2128,7 @@ def use_discount_link(code: str, user_id: int):
         conn.close()
 
 def get_user_active_discount(user_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT discount_percent, expires_at FROM user_discounts
@@ -2004,7 +2164,7 @@ def mark_discount_used(user_id: int, order_id: int):
         conn.close()
 
 def get_all_discount_links():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM discount_links ORDER BY created_at DESC")
     rows = cursor.fetchall()
@@ -2042,7 +2202,7 @@ def create_feedback(user_id: int, order_id: int, rating: int, text: str = None,
         conn.close()
 
 def get_order_feedback(order_id: int):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM feedback WHERE order_id = ?", (order_id,))
     row = cursor.fetchone()
@@ -2065,7 +2225,7 @@ def update_feedback_status(feedback_id: int, status: str):
 
 # ========== ТОП ПОКУПАТЕЛЕЙ ==========
 def get_top_buyers(limit: int = 10):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
         """SELECT u.username, u.full_name, 
@@ -2083,95 +2243,123 @@ def get_top_buyers(limit: int = 10):
     return top_buyers
 
 def get_top_buyers_no_admins(limit: int = 10):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT u.username, u.full_name, SUM(h.total_price) as total_spent
-        FROM purchase_history h
-        JOIN users u ON h.user_id = u.user_id
-        WHERE u.role NOT IN ('admin', 'tech_admin', 'owner', 'moder', 'agent')
-        GROUP BY h.user_id
-        ORDER BY total_spent DESC
-        LIMIT ?
-    ''', (limit,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
-
-def get_cached_top_buyers(limit: int = 10):
-    # кэширование реализовано в helpers.py через aiocache
-    return get_top_buyers_no_admins(limit)
-
-def invalidate_top_cache():
-    cache_delete("top_buyers")
+    # Ведётся инкрементально в leaderboard.py, запроса к БД нет
+    return leaderboard.top(limit)
 
 # ========== СТАТИСТИКА ==========
-def get_revenue_for_period(days: int):
+# Статистика читается из дневного свода sales_daily (по дням UTC, окно в N дней —
+# сегодня и N-1 предыдущих). Все окна считаются одним проходом (условная
+# агрегация), результат кэшируется и сбрасывается при новой покупке (тег 'purchases').
+STATS_WINDOWS = (1, 7, 30)
+
+def get_period_stats(windows=STATS_WINDOWS) -> dict:
+    """{дней: {'revenue', 'orders', 'active_users', 'avg_check'}} для каждого окна."""
+    windows = tuple(sorted({int(days) for days in windows}))
+    cached_stats = cache.get('stats', ('periods', windows))
+    if cached_stats is not None:
+        return cached_stats
+    sums = []
+    buyers = []
+    params = []
+    for days in windows:
+        condition = "day > DATE('now', ?)"
+        sums.append(f"COALESCE(SUM(CASE WHEN {condition} THEN revenue END), 0)")
+        sums.append(f"COALESCE(SUM(CASE WHEN {condition} THEN orders END), 0)")
+        buyers.append(f"COUNT(DISTINCT CASE WHEN {condition} THEN user_id END)")
+        params.append(f'-{days} days')
+    since = f'-{windows[-1]} days'
+    conn = get_read_connection()
+    try:
+        totals = conn.execute(
+            f"SELECT {', '.join(sums)} FROM sales_daily WHERE day > DATE('now', ?)",
+            [p for p in params for _ in range(2)] + [since]
+        ).fetchone()
+        active = conn.execute(
+            f"SELECT {', '.join(buyers)} FROM sales_daily_buyers WHERE day > DATE('now', ?)",
+            params + [since]
+        ).fetchone()
+    finally:
+        conn.close()
+    result = {}
+    for i, days in enumerate(windows):
+        revenue, orders = totals[i * 2:i * 2 + 2]
+        result[days] = {
+            'revenue': revenue,
+            'orders': orders,
+            'active_users': active[i],
+            'avg_check': revenue / orders if orders else 0,
+        }
+    cache.set('stats', ('periods', windows), result, tags=('purchases',))
+    return result
+
+def get_stats_summary(windows=STATS_WINDOWS, top_limit: int = 5) -> dict:
+    """Всё для /stats и меню статистики: окна, роли, топ покупателей."""
+    return {
+        'periods': get_period_stats(windows),
+        'roles': count_users_by_role(),
+        'top': get_top_buyers_no_admins(top_limit),
+    }
+
+def rebuild_sales_daily():
+    """Пересобирает дневной свод по всей истории покупок (команда /rebuild_sales)."""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        """SELECT COALESCE(SUM(total_price), 0) 
-           FROM purchase_history 
-           WHERE purchase_date >= datetime('now', ?)""",
-        (f'-{days} days',)
-    )
-    revenue = cursor.fetchone()[0]
-    conn.close()
-    return revenue
+    try:
+        _rebuild_sales_daily(cursor)
+        conn.commit()
+        cursor.execute("SELECT COUNT(*) FROM sales_daily")
+        days = cursor.fetchone()[0]
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Ошибка пересборки sales_daily: {e}")
+        return None
+    finally:
+        conn.close()
+    cache.invalidate_tag('purchases')
+    invalidation.publish(invalidation.PURCHASES)
+    return days
+
+def get_revenue_for_period(days: int):
+    return get_period_stats((days,))[days]['revenue']
 
 def get_active_users_count(days: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT COUNT(DISTINCT user_id) 
-           FROM purchase_history 
-           WHERE purchase_date >= datetime('now', ?)""",
-        (f'-{days} days',)
-    )
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    return get_period_stats((days,))[days]['active_users']
 
 def get_average_check(days: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT COALESCE(AVG(total_price), 0) 
-           FROM purchase_history 
-           WHERE purchase_date >= datetime('now', ?)""",
-        (f'-{days} days',)
-    )
-    avg = cursor.fetchone()[0]
-    conn.close()
-    return avg
+    return get_period_stats((days,))[days]['avg_check']
 
 def get_sales_by_day(days: int):
-    conn = get_db_connection()
+    cached_sales = cache.get('stats', ('by_day', days))
+    if cached_sales is not None:
+        return cached_sales
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute(
-        """SELECT DATE(purchase_date) as day, 
-                  COUNT(*) as orders_count,
-                  SUM(total_price) as revenue
-           FROM purchase_history 
-           WHERE purchase_date >= datetime('now', ?)
-           GROUP BY DATE(purchase_date)
+        """SELECT day, orders, revenue
+           FROM sales_daily
+           WHERE day > DATE('now', ?)
            ORDER BY day DESC""",
         (f'-{days} days',)
     )
     sales = cursor.fetchall()
     conn.close()
+    cache.set('stats', ('by_day', days), sales, tags=('purchases',))
     return sales
 
 def count_users_by_role():
-    conn = get_db_connection()
+    cached_roles = cache.get('stats', 'roles')
+    if cached_roles is not None:
+        return cached_roles
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT role, COUNT(*) FROM users GROUP BY role")
     rows = cursor.fetchall()
     conn.close()
+    cache.set('stats', 'roles', dict(rows), tags=('users',))
     return dict(rows)
 
 def get_users_by_activity(days: int = 7):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT user_id, username, full_name, last_action 
@@ -2191,7 +2379,7 @@ def get_users_by_activity(days: int = 7):
     return active, inactive
 
 def get_all_users():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT user_id, username, full_name FROM users")
     users = cursor.fetchall()
@@ -2243,6 +2431,7 @@ def update_balance(user_id: int, amount: int, currency: str = 'real', operation:
         )
         conn.commit()
         invalidate_balance_cache(user_id)
+        invalidation.publish(invalidation.BALANCE, user_id)
         return True
     except Exception as e:
         conn.rollback()
@@ -2251,12 +2440,20 @@ def update_balance(user_id: int, amount: int, currency: str = 'real', operation:
     finally:
         conn.close()
 
+@cached('balance', key=lambda user_id, currency='virtual': (user_id, currency), tags=('balances',))
+def get_cached_balance(user_id: int, currency: str = 'virtual'):
+    user = get_user(user_id)
+    if not user:
+        return 0
+    return user[5] if currency == 'virtual' else user[4]
+
 def invalidate_balance_cache(user_id: int):
-    cache_delete(f"balance:{user_id}")
+    cache.delete('balance', (user_id, 'virtual'))
+    cache.delete('balance', (user_id, 'real'))
 
 # ========== ПРОВЕРКА ДЕЙСТВИЙ ==========
 def check_action_allowed(user_id: int, action_type: str, action_id: str = None):
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     try:
         if action_id:
@@ -2321,7 +2518,7 @@ def delete_ticket_template(name: str):
         conn.close()
 
 def get_all_ticket_templates():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT key, value FROM settings WHERE key LIKE 'ticket_template_%'")
     rows = cursor.fetchall()
@@ -2370,11 +2567,7 @@ def create_sale(name: str, discount_type: str, discount_value: int, start_date:
     return sale_id
 
 def get_all_sales():
-    sales = get_setting('sales', '[]')
-    try:
-        return json.loads(sales)
-    except:
-        return []
+    return [dict(sale.data) for sale in settings.current().sales]
 
 def update_sale(sale_id: int, data: dict):
     sales = get_setting('sales', '[]')
@@ -2400,15 +2593,190 @@ def delete_sale(sale_id: int):
         return False
 
 # ========== БЕКАПЫ ==========
-def create_backup():
+# Копия снимается через sqlite3 backup API: страницы копируются пачками по
+# BACKUP_PAGES_PER_STEP с согласованного снимка, запись в базу не блокируется.
+# Проверенная копия потоково сжимается в backup_*.db.gz, рядом кладётся
+# <файл>.sha256 в формате sha256sum. Для отправки в Telegram большой архив
+# режется на части по BACKUP_PART_SIZE с манифестом (split_backup).
+BACKUP_PATTERNS = ('backup_*.db', 'backup_*.db.gz')
+MANIFEST_SUFFIX = '.manifest.json'
+_COPY_CHUNK = 1024 * 1024
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_COPY_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _checksum_path(path: str) -> str:
+    return path + '.sha256'
+
+def _write_checksum(path: str) -> str:
+    checksum = _file_sha256(path)
+    with open(_checksum_path(path), 'w') as f:
+        f.write(f"{checksum}  {os.path.basename(path)}\n")
+    return checksum
+
+def read_backup_checksum(path: str):
+    try:
+        with open(_checksum_path(path)) as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+def verify_backup(path: str) -> bool:
+    """Сверяет файл с его .sha256. Бекап без контрольной суммы считается непроверенным (False)."""
+    expected = read_backup_checksum(path)
+    return expected is not None and expected == _file_sha256(path)
+
+def create_backup(progress=None):
+    """
+    Онлайн-бекап в BACKUP_DIR (backup_*.db.gz). progress(скопировано_страниц,
+    всего_страниц) вызывается после каждого шага. Копия проверяется
+    PRAGMA integrity_check до сжатия.
+    """
     os.makedirs(BACKUP_DIR, exist_ok=True)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_file = f"{BACKUP_DIR}/backup_{timestamp}.db"
-    shutil.copy2(DATABASE_NAME, backup_file)
+    backup_file = f"{BACKUP_DIR}/backup_{timestamp}.db.gz"
+    raw_file = f"{BACKUP_DIR}/backup_{timestamp}.db.tmp"
+    gz_tmp = backup_file + '.tmp'
+
+    def on_step(status, remaining, total):
+        if progress is not None:
+            progress(total - remaining, total)
+
+    started = time.monotonic()
+    try:
+        source = db_pool.open_connection(DATABASE_NAME)
+        target = sqlite3.connect(raw_file)
+        try:
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=on_step, sleep=0)
+            target.execute("PRAGMA journal_mode=DELETE")
+            check = target.execute("PRAGMA integrity_check").fetchall()
+            if check != [('ok',)]:
+                raise sqlite3.DatabaseError(f"integrity_check: {check[:5]}")
+        finally:
+            target.close()
+            source.close()
+        raw_size = os.path.getsize(raw_file)
+        with open(raw_file, 'rb') as src, gzip.open(gz_tmp, 'wb', compresslevel=BACKUP_COMPRESS_LEVEL) as dst:
+            shutil.copyfileobj(src, dst, _COPY_CHUNK)
+        os.replace(gz_tmp, backup_file)
+    finally:
+        for path in (raw_file, gz_tmp):
+            if os.path.exists(path):
+                os.remove(path)
+    checksum = _write_checksum(backup_file)
+    logger.info(
+        f"Бекап {backup_file} создан за {time.monotonic() - started:.1f} сек: "
+        f"{raw_size} -> {os.path.getsize(backup_file)} байт, sha256 {checksum[:12]}…"
+    )
     return backup_file
 
+def split_backup(path: str, part_size: int = BACKUP_PART_SIZE) -> str:
+    """
+    Режет бекап на части не больше part_size в каталоге BACKUP_DIR/parts/<имя>/
+    и пишет манифест (имя, размер и sha256 целого файла и каждой части).
+    Возвращает путь к манифесту; части лежат рядом с ним.
+    """
+    name = os.path.basename(path)
+    parts_dir = os.path.join(BACKUP_DIR, 'parts', name)
+    os.makedirs(parts_dir, exist_ok=True)
+    parts = []
+    with open(path, 'rb') as src:
+        while True:
+            part_name = f"{name}.part{len(parts) + 1:03d}"
+            part_path = os.path.join(parts_dir, part_name)
+            digest = hashlib.sha256()
+            written = 0
+            with open(part_path, 'wb') as dst:
+                while written < part_size:
+                    chunk = src.read(min(_COPY_CHUNK, part_size - written))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+            if not written:
+                os.remove(part_path)
+                break
+            parts.append({'name': part_name, 'size': written, 'sha256': digest.hexdigest()})
+    manifest = {
+        'name': name,
+        'size': os.path.getsize(path),
+        'sha256': read_backup_checksum(path) or _file_sha256(path),
+        'parts': parts,
+    }
+    manifest_path = os.path.join(parts_dir, name + MANIFEST_SUFFIX)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest_path
+
+def discard_backup_parts(manifest_path: str):
+    """Удаляет каталог с частями после отправки."""
+    shutil.rmtree(os.path.dirname(manifest_path), ignore_errors=True)
+
+def _assemble_parts(manifest_path: str, target: str):
+    """Склеивает части из манифеста в target, сверяя sha256 частей и целого файла."""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(manifest_path)
+    whole = hashlib.sha256()
+    with open(target, 'wb') as dst:
+        for part in manifest['parts']:
+            digest = hashlib.sha256()
+            with open(os.path.join(base_dir, part['name']), 'rb') as src:
+                for chunk in iter(lambda: src.read(_COPY_CHUNK), b''):
+                    digest.update(chunk)
+                    whole.update(chunk)
+                    dst.write(chunk)
+            if digest.hexdigest() != part['sha256']:
+                raise ValueError(f"Часть {part['name']} повреждена")
+    if whole.hexdigest() != manifest['sha256']:
+        raise ValueError(f"Контрольная сумма {manifest['name']} не совпадает")
+    return manifest['name']
+
+def _unpack_backup(filepath: str, target: str):
+    """Бекап (.db, .db.gz или манифест частей) -> несжатый файл БД target."""
+    if filepath.endswith(MANIFEST_SUFFIX):
+        assembled = target + '.part'
+        try:
+            name = _assemble_parts(filepath, assembled)
+            if name.endswith('.gz'):
+                with gzip.open(assembled, 'rb') as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, _COPY_CHUNK)
+            else:
+                os.replace(assembled, target)
+        finally:
+            if os.path.exists(assembled):
+                os.remove(assembled)
+    elif filepath.endswith('.gz'):
+        with gzip.open(filepath, 'rb') as src, open(target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, _COPY_CHUNK)
+    else:
+        shutil.copyfile(filepath, target)
+    conn = sqlite3.connect(target)
+    try:
+        check = conn.execute("PRAGMA quick_check").fetchall()
+    finally:
+        conn.close()
+    if check != [('ok',)]:
+        raise sqlite3.DatabaseError(f"quick_check: {check[:5]}")
+
+def delete_backup(path: str):
+    os.remove(path)
+    if os.path.exists(_checksum_path(path)):
+        os.remove(_checksum_path(path))
+
+def _backup_files() -> list:
+    files = []
+    for pattern in BACKUP_PATTERNS:
+        files.extend(glob.glob(f"{BACKUP_DIR}/{pattern}"))
+    return files
+
 def list_backups():
-    files = glob.glob(f"{BACKUP_DIR}/backup_*.db")
+    files = _backup_files()
     files.sort(key=os.path.getmtime, reverse=True)
     backups = []
     for f in files:
@@ -2418,25 +2786,68 @@ def list_backups():
             'path': f,
             'name': os.path.basename(f),
             'size': size,
-            'mtime': datetime.fromtimestamp(mtime)
+            'mtime': datetime.fromtimestamp(mtime),
+            'sha256': read_backup_checksum(f)
         })
     return backups
 
+def _rebuild_state():
+    """Перечитывает всё, что держится в памяти поверх БД."""
+    cache.clear()
+    settings.load()
+    registry.load()
+    leaderboard.load()
+
 def restore_backup(filepath: str):
+    """
+    Горячее восстановление без перезапуска:
+    1) бекап распаковывается и проверяется во временный файл (бот работает);
+    2) защёлка пула останавливает запись и дожидается текущей транзакции;
+    3) содержимое переносится в рабочую базу через backup API — соединения
+       пула и aiosqlite остаются открытыми и видят новые данные;
+    4) применяются миграции (бекап мог быть со старой схемой), кэш, настройки,
+       реестр и топ перечитываются;
+    5) защёлка снимается.
+    """
+    if read_backup_checksum(filepath) is not None and not verify_backup(filepath):
+        logger.error(f"Бекап {filepath} повреждён: контрольная сумма не совпадает")
+        return False
+    unpacked = DATABASE_NAME + '.restore'
+    started = time.monotonic()
     try:
-        shutil.copy2(filepath, DATABASE_NAME)
-        clear_settings_cache()
+        _unpack_backup(filepath, unpacked)
+        unpacked_at = time.monotonic()
+        source = sqlite3.connect(unpacked)
+        try:
+            with db_pool.get_pool(DATABASE_NAME).exclusive() as live:
+                drained_at = time.monotonic()
+                source.backup(live, pages=BACKUP_PAGES_PER_STEP, sleep=0)
+                live.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                swapped_at = time.monotonic()
+                init_db()
+                _rebuild_state()
+                invalidation.publish(invalidation.ALL)
+        finally:
+            source.close()
+        logger.info(
+            f"БД восстановлена из {filepath}: распаковка {unpacked_at - started:.1f} сек, "
+            f"ожидание транзакций {drained_at - unpacked_at:.2f} сек, подмена {swapped_at - drained_at:.2f} сек, "
+            f"всего {time.monotonic() - started:.1f} сек"
+        )
         return True
     except Exception as e:
         logger.error(f"Ошибка восстановления бекапа: {e}")
         return False
+    finally:
+        if os.path.exists(unpacked):
+            os.remove(unpacked)
 
 def cleanup_old_backups(keep_count: int = 7):
-    files = glob.glob(f"{BACKUP_DIR}/backup_*.db")
+    files = _backup_files()
     files.sort(key=os.path.getmtime)
     if len(files) > keep_count:
         for f in files[:-keep_count]:
-            os.remove(f)
+            delete_backup(f)
 
 # ========== РАССЫЛКИ ==========
 def create_mailing(
@@ -2466,7 +2877,7 @@ def create_mailing(
         conn.close()
 
 def get_pending_mailings():
-    conn = get_db_connection()
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("""
         SELECT * FROM mailings 
@@ -2493,14 +2904,210 @@ def update_mailing_status(mailing_id: int, status: str, sent: int = 0, failed: i
     finally:
         conn.close()
 
-def get_mailing_stats(mailing_id: int):
+MAILING_FIELDS = (
+    'id', 'admin_id', 'filter_type', 'text', 'media_file_id', 'media_type',
+    'button_text', 'button_url', 'status', 'total_count', 'sent_count', 'fail_count',
+    'last_user_id', 'progress_chat_id', 'progress_message_id'
+)
+
+def get_next_mailing():
+    """Прерванная рассылка (status='running') или самая старая из готовых к отправке."""
+    conn = get_read_connection()
+    try:
+        row = conn.execute(f"""
+            SELECT {', '.join(MAILING_FIELDS)} FROM mailings
+            WHERE status = 'running'
+               OR (status = 'pending' AND (scheduled_at IS NULL OR scheduled_at <= CURRENT_TIMESTAMP))
+            ORDER BY status = 'running' DESC, created_at ASC, id ASC
+            LIMIT 1
+        """).fetchone()
+    finally:
+        conn.close()
+    return dict(zip(MAILING_FIELDS, row)) if row else None
+
+def set_mailing_progress_message(mailing_id: int, chat_id: int, message_id: int):
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            "UPDATE mailings SET progress_chat_id = ?, progress_message_id = ? WHERE id = ?",
+            (chat_id, message_id, mailing_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def start_mailing(mailing_id: int, total: int):
+    """Переводит рассылку в running; при возобновлении total_count не меняется."""
+    conn = get_db_connection()
+    try:
+        conn.execute("""
+            UPDATE mailings
+            SET status = 'running',
+                total_count = CASE WHEN status = 'running' THEN total_count ELSE ? END,
+                started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+            WHERE id = ?
+        """, (total, mailing_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def checkpoint_mailing(mailing_id: int, sent: int, failed: int, last_user_id: int, blocked=()):
+    """
+    Прибавляет счётчики пачки и сдвигает контрольную точку одной транзакцией.
+    blocked — получатели с постоянной ошибкой доставки, они выпадают из рассылок.
+    """
+    blocked = list(blocked)
+    conn = get_db_connection()
+    try:
+        conn.execute("""
+            UPDATE mailings
+            SET sent_count = sent_count + ?, fail_count = fail_count + ?, last_user_id = ?
+            WHERE id = ?
+        """, (sent, failed, last_user_id, mailing_id))
+        if blocked:
+            conn.executemany("""
+                UPDATE users
+                SET bot_blocked_at = COALESCE(bot_blocked_at, CURRENT_TIMESTAMP),
+                    delivery_failures = delivery_failures + 1
+                WHERE user_id = ?
+            """, [(user_id,) for user_id in blocked])
+        conn.commit()
+    finally:
+        conn.close()
+    if blocked:
+        registry.set_bot_blocked(blocked)
+        invalidation.publish(invalidation.BOT_BLOCKED, list(blocked))
+
+def revive_recipient(user_id: int):
+    """Пользователь снова пишет боту — возвращаем его в аудиторию рассылок."""
     conn = get_db_connection()
+    try:
+        conn.execute(
+            "UPDATE users SET bot_blocked_at = NULL, delivery_failures = 0 WHERE user_id = ?",
+            (user_id,)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    registry.drop_bot_blocked(user_id)
+    invalidation.publish(invalidation.BOT_UNBLOCKED, user_id)
+
+def finish_mailing(mailing_id: int, status: str = 'done'):
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            "UPDATE mailings SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (status, mailing_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+# ---------- аудитории рассылок ----------
+# Условия по таблице users; 'top' и 'test' считаются без запроса к БД.
+# Заблокировавшие бота (bot_blocked_at) в аудиторию не входят, кроме 'test'
+AUDIENCE_CONDITIONS = {
+    'all': "1",
+    'active': "last_action >= datetime('now', '-7 days')",
+    'inactive': "(last_action < datetime('now', '-30 days') OR last_action IS NULL)",
+}
+
+def _audience_ids(filter_type: str, admin_id: int):
+    """Список получателей для фильтров, которые не читают users, иначе None."""
+    if filter_type == 'test':
+        return [admin_id]
+    if filter_type == 'top':
+        return sorted(uid for uid in leaderboard.top_user_ids(10) if not registry.is_bot_blocked(uid))
+    if filter_type not in AUDIENCE_CONDITIONS:
+        return []
+    return None
+
+def count_audience(filter_type: str, admin_id: int = None) -> int:
+    """Размер аудитории одним COUNT(*), без выборки строк."""
+    ids = _audience_ids(filter_type, admin_id)
+    if ids is not None:
+        return len(ids)
+    conn = get_read_connection()
+    try:
+        return conn.execute(
+            f"SELECT COUNT(*) FROM users WHERE bot_blocked_at IS NULL AND {AUDIENCE_CONDITIONS[filter_type]}"
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+def get_audience_batch(filter_type: str, admin_id: int = None, after_user_id: int = 0,
+                       limit: int = MAILING_AUDIENCE_BATCH) -> list:
+    """Следующая пачка user_id по возрастанию после after_user_id (keyset-пагинация)."""
+    ids = _audience_ids(filter_type, admin_id)
+    if ids is not None:
+        return [uid for uid in ids if uid > after_user_id][:limit]
+    conn = get_read_connection()
+    try:
+        rows = conn.execute(
+            f"SELECT user_id FROM users WHERE user_id > ? AND bot_blocked_at IS NULL "
+            f"AND {AUDIENCE_CONDITIONS[filter_type]} "
+            f"ORDER BY user_id LIMIT ?",
+            (after_user_id, limit)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+def get_mailing_stats(mailing_id: int):
+    conn = get_read_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM mailings WHERE id = ?", (mailing_id,))
     row = cursor.fetchone()
     conn.close()
     return row
 
+# ========== ПЛАНИРОВЩИК ==========
+def get_job_runs() -> dict:
+    """name -> {'last_run_at', 'last_duration', 'last_error', 'run_count', 'fail_count'}"""
+    conn = get_read_connection()
+    try:
+        rows = conn.execute(
+            "SELECT name, last_run_at, last_duration, last_error, run_count, fail_count FROM scheduler_jobs"
+        ).fetchall()
+    finally:
+        conn.close()
+    result = {}
+    for name, last_run_at, last_duration, last_error, run_count, fail_count in rows:
+        try:
+            last_run_at = datetime.fromisoformat(last_run_at) if last_run_at else None
+        except (TypeError, ValueError):
+            last_run_at = None
+        result[name] = {
+            'last_run_at': last_run_at,
+            'last_duration': last_duration,
+            'last_error': last_error,
+            'run_count': run_count,
+            'fail_count': fail_count,
+        }
+    return result
+
+def record_job_run(name: str, started_at: datetime, duration: float, error: str = None):
+    conn = get_db_connection()
+    try:
+        conn.execute("""
+            INSERT INTO scheduler_jobs (name, last_run_at, last_duration, last_error, run_count, fail_count)
+            VALUES (?, ?, ?, ?, 1, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                last_run_at = excluded.last_run_at,
+                last_duration = excluded.last_duration,
+                last_error = excluded.last_error,
+                run_count = run_count + 1,
+                fail_count = fail_count + excluded.fail_count
+        """, (name, started_at.strftime('%Y-%m-%d %H:%M:%S'), duration, error, 1 if error else 0))
+        conn.commit()
+    finally:
+        conn.close()
+
 # ========== ВЕРСИЯ БД ==========
-def get_db_version():
-    return "3.0"
\ No newline at end of file
+def get_db_version() -> int:
+    """Текущая версия схемы (PRAGMA user_version)."""
+    conn = get_read_connection()
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
\ No newline at end of file
@@ -0,0 +1,149 @@
+# FILE: database_async.py
+"""
+Асинхронный слой доступа к БД.
+
+Повторяет публичный API database.py, но каждая функция — корутина, поэтому
+медленный запрос или ожидание блокировки не останавливает event loop.
+Горячие чтения, которые выполняются на каждом апдейте, либо берутся из памяти
+(баны и заморозки — registry, настройки — settings), либо идут напрямую через
+aiosqlite (пользователь, роль). Остальные функции
+выполняются в отдельном пуле потоков поверх синхронной реализации, чтобы SQL
+оставался в одном месте. Хендлеры можно переводить постепенно:
+    import database_async as adb
+    user = await adb.get_user(user_id)
+"""
+import asyncio
+import contextvars
+import functools
+import inspect
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiosqlite
+
+import database
+import db_pool
+import metrics
+import sqltrace
+from cache import cache
+from config import DB_EXECUTOR_WORKERS
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+_conn = None
+_conn_lock = asyncio.Lock()
+
+# ========== СОЕДИНЕНИЕ ==========
+async def get_connection() -> aiosqlite.Connection:
+    global _conn
+    if _conn is None:
+        async with _conn_lock:
+            if _conn is None:
+                conn = await aiosqlite.connect(database.DATABASE_NAME, factory=sqltrace.connection_factory())
+                for pragma in db_pool.connection_pragmas():
+                    await conn.execute(pragma)
+                if metrics.ENABLED:
+                    await conn.set_trace_callback(metrics.count_query)
+                _conn = conn
+    return _conn
+
+async def close_connection():
+    """Закрывает соединение aiosqlite; следующий запрос откроет новое."""
+    global _conn
+    if _conn is not None:
+        await _conn.close()
+        _conn = None
+
+async def close():
+    await close_connection()
+    _executor.shutdown(wait=False)
+    db_pool.close_pool()
+
+async def run_sync(func, *args, **kwargs):
+    """Выполняет синхронную функцию БД в пуле потоков (с контекстом вызывающей задачи)."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()  # метрики апдейта видны и в потоке
+    return await loop.run_in_executor(_executor, context.run, functools.partial(func, *args, **kwargs))
+
+async def _fetchone(query: str, params: tuple = ()):
+    conn = await get_connection()
+    started = time.perf_counter()
+    try:
+        async with conn.execute(query, params) as cursor:
+            return await cursor.fetchone()
+    finally:
+        metrics.add_db_time(time.perf_counter() - started)
+
+# ========== ГОРЯЧИЕ ЧТЕНИЯ (aiosqlite) ==========
+async def get_user(user_id: int):
+    return await _fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+
+async def get_user_role(user_id: int):
+    user = await get_user(user_id)
+    if user:
+        return user[7] if len(user) > 7 else 'user'
+    return 'user'
+
+async def get_ban(user_id: int):
+    return await _fetchone("SELECT * FROM bans WHERE user_id = ?", (user_id,))
+
+# Баны и заморозки хранятся в памяти (registry), запрос к БД не нужен
+async def is_user_banned(user_id: int) -> bool:
+    return database.is_user_banned(user_id)
+
+async def is_user_frozen(user_id: int) -> bool:
+    return database.is_user_frozen(user_id)
+
+async def get_freeze_info(user_id: int):
+    return database.get_freeze_info(user_id)
+
+async def get_access_record(user_id: int) -> dict:
+    # Единый кэш общий с database.py: set_user_role сбрасывает запись
+    record = cache.get('roles', user_id)
+    if record is not None:
+        return record
+    record = database.make_access_record(await _fetchone(database.ACCESS_QUERY, (user_id,)))
+    cache.set('roles', user_id, record)
+    return record
+
+# Настройки читаются из снимка в памяти (settings.py)
+async def get_setting(key: str, default=None):
+    return database.get_setting(key, default)
+
+async def is_maintenance_mode() -> bool:
+    return database.is_maintenance_mode()
+
+# Аудитория рассылки: пачки читаются в пуле потоков, в памяти одна пачка
+async def iter_audience(filter_type: str, admin_id: int = None, after_user_id: int = 0,
+                        batch_size: int = database.MAILING_AUDIENCE_BATCH):
+    while True:
+        batch = await run_sync(database.get_audience_batch, filter_type, admin_id, after_user_id, batch_size)
+        if not batch:
+            return
+        yield batch
+        after_user_id = batch[-1]
+
+# ========== ОСТАЛЬНОЙ API (пул потоков) ==========
+# Функции, которые не ходят в БД или возвращают синхронные объекты
+_SKIP = {
+    'get_db_connection', 'get_read_connection',
+    'clear_settings_cache', 'invalidate_balance_cache',
+    'is_ban_expired', 'parse_ban_until', 'make_access_record', 'invalidate_access',
+}
+
+def _make_async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_sync(func, *args, **kwargs)
+    return wrapper
+
+for _name, _func in inspect.getmembers(database, inspect.isfunction):
+    if _func.__module__ != database.__name__ or _name.startswith('_'):
+        continue
+    if _name in _SKIP or _name in globals():
+        continue
+    globals()[_name] = _make_async(_func)
+
+del _name, _func
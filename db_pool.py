@@ -0,0 +1,325 @@
+# FILE: db_pool.py
+"""
+Пул соединений SQLite: один писатель и N читателей.
+
+Соединения открываются один раз при старте в режиме WAL, поэтому читатели не
+блокируют писателя и наоборот. Писатель один на процесс и защищён RLock:
+вложенные вызовы из одного потока (update_order_status -> create_referral_reward
+-> update_balance) получают то же соединение и ту же транзакцию.
+close() у выданного соединения возвращает его в пул, а не закрывает.
+exclusive() — защёлка записи для горячего восстановления: дожидается
+текущей транзакции и держит писателя, пока база подменяется.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+import sqltrace
+from config import (
+    DB_POOL_READERS, DB_POOL_TIMEOUT, DB_BUSY_TIMEOUT_MS, DB_SYNCHRONOUS,
+    DB_CACHE_SIZE_KB, DB_MMAP_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+
+def connection_pragmas() -> list:
+    """PRAGMA, которые выполняются на каждом новом соединении."""
+    return [
+        "PRAGMA journal_mode=WAL",
+        f"PRAGMA synchronous={DB_SYNCHRONOUS}",
+        f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+        f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}",
+        f"PRAGMA mmap_size={DB_MMAP_SIZE}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+
+
+def open_connection(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           factory=sqltrace.connection_factory())
+    for pragma in connection_pragmas():
+        conn.execute(pragma)
+    if metrics.ENABLED:
+        conn.set_trace_callback(metrics.count_query)  # счётчики запросов по таблицам
+    return conn
+
+
+# Время удержания соединений потоком — для метрики «время апдейта в БД».
+# Вложенные выдачи (писатель внутри писателя, читатель внутри писателя) не суммируются.
+_held = threading.local()
+
+def _hold_started():
+    depth = getattr(_held, 'depth', 0)
+    if depth == 0:
+        _held.started = time.perf_counter()
+    _held.depth = depth + 1
+
+def _hold_finished():
+    depth = getattr(_held, 'depth', 0)
+    if depth <= 0:
+        return  # соединение вернули из другого потока
+    _held.depth = depth - 1
+    if depth == 1:
+        metrics.add_db_time(time.perf_counter() - _held.started)
+
+
+class PooledConnection:
+    """
+    Соединение, выданное пулом. Повторный close() безопасен.
+
+    Писатель, взятый внутри открытой транзакции другого писателя этого же
+    потока, работает в точке сохранения: commit() фиксирует её в общей
+    транзакции, rollback() и close() без commit() откатывают только её.
+    Завершает транзакцию внешний владелец.
+    """
+
+    def __init__(self, pool: "ConnectionPool", conn: sqlite3.Connection, kind: str, savepoint: str = None):
+        self._pool = pool
+        self._conn = conn
+        self.kind = kind
+        self._released = False
+        self._savepoint = savepoint
+        self._thread = threading.get_ident()
+        if savepoint is not None:
+            conn.execute(f"SAVEPOINT {savepoint}")
+        _hold_started()
+
+    def cursor(self):
+        return self._conn.cursor()
+
+    def execute(self, *args):
+        return self._conn.execute(*args)
+
+    def executemany(self, *args):
+        return self._conn.executemany(*args)
+
+    def commit(self):
+        if self._savepoint is None:
+            self._conn.commit()
+            return
+        self._conn.execute(f"RELEASE {self._savepoint}")
+        self._conn.execute(f"SAVEPOINT {self._savepoint}")  # дальнейшие запросы — в новой точке
+
+    def rollback(self):
+        if self._savepoint is None:
+            self._conn.rollback()
+            return
+        self._conn.execute(f"ROLLBACK TO {self._savepoint}")
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        try:
+            self._pool._release(self)
+        finally:
+            _hold_finished()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def __del__(self):
+        # Соединение должны возвращать close() в finally. Здесь только сообщаем об утечке:
+        # писателя может вернуть лишь поток, захвативший RLock, а сборщик мусора
+        # вызывает __del__ в произвольном потоке.
+        if getattr(self, '_released', True):
+            return
+        if self.kind != 'writer' or self._thread == threading.get_ident():
+            logger.warning(f"Пул БД: соединение ({self.kind}) не закрыто, возвращаем при сборке мусора")
+            try:
+                self.close()
+            except Exception as e:
+                logger.error(f"Пул БД: не удалось вернуть соединение: {e}")
+        else:
+            logger.error("Пул БД: писатель не закрыт и собран в чужом потоке — блокировка записи не снята")
+
+
+class ConnectionPool:
+    def __init__(self, path: str, readers: int = DB_POOL_READERS, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._writer = open_connection(path)
+        self._writer_lock = threading.RLock()
+        self._writer_depth = 0
+        self._writer_handles = 0  # открытые PooledConnection-писатели (без exclusive)
+        self._paused = False
+        self._readers = queue.Queue()
+        self._reader_count = readers
+        for _ in range(readers):
+            self._readers.put(open_connection(path))
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'writer_acquired': 0,
+            'reader_acquired': 0,
+            'overflow': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+        }
+        logger.info(f"Пул БД открыт: {path}, читателей: {readers}")
+
+    def _record_wait(self, key: str, started: float):
+        waited = time.perf_counter() - started
+        with self._stats_lock:
+            self._stats[key] += 1
+            self._stats['wait_total'] += waited
+            self._stats['wait_max'] = max(self._stats['wait_max'], waited)
+
+    def writer(self) -> PooledConnection:
+        started = time.perf_counter()
+        if not self._writer_lock.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("Пул БД: писатель занят дольше таймаута")
+        self._writer_depth += 1
+        self._record_wait('writer_acquired', started)
+        savepoint = None
+        if self._writer_handles and self._writer.in_transaction:
+            # Вложенный вызов (хелпер внутри чужой транзакции) не должен её фиксировать или откатывать
+            savepoint = f"nested_{self._writer_handles}"
+        try:
+            pooled = PooledConnection(self, self._writer, 'writer', savepoint)
+        except BaseException:
+            self._writer_depth -= 1
+            self._writer_lock.release()
+            raise
+        self._writer_handles += 1
+        return pooled
+
+    def reader(self) -> PooledConnection:
+        started = time.perf_counter()
+        try:
+            conn = self._readers.get(timeout=self.timeout)
+            kind = 'reader'
+        except queue.Empty:
+            # Все читатели заняты (например, вложенные вызовы) — временное соединение
+            conn = open_connection(self.path)
+            kind = 'overflow'
+            with self._stats_lock:
+                self._stats['overflow'] += 1
+        self._record_wait('reader_acquired', started)
+        return PooledConnection(self, conn, kind)
+
+    def _release(self, pooled: PooledConnection):
+        conn = pooled._conn
+        if pooled.kind == 'writer':
+            self._writer_handles -= 1
+            self._writer_depth -= 1
+            try:
+                if pooled._savepoint is not None:
+                    try:
+                        # Незафиксированное во вложенном писателе отбрасывается
+                        conn.execute(f"ROLLBACK TO {pooled._savepoint}")
+                        conn.execute(f"RELEASE {pooled._savepoint}")
+                    except sqlite3.OperationalError:
+                        pass  # внешняя транзакция уже завершена вместе с точкой сохранения
+                # Как и у sqlite3.Connection.close(): незакоммиченное отбрасывается
+                if self._writer_depth == 0 and conn.in_transaction:
+                    conn.rollback()
+            finally:
+                self._writer_lock.release()
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        if pooled.kind == 'overflow' or self._closed:
+            conn.close()
+        else:
+            self._readers.put(conn)
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Останавливает запись: новые писатели ждут, текущая транзакция
+        дописывается (захват RLock и есть ожидание). Отдаёт sqlite3-соединение
+        писателя; этот же поток внутри блока может брать writer() как обычно.
+        """
+        self._paused = True
+        try:
+            started = time.perf_counter()
+            if not self._writer_lock.acquire(timeout=self.timeout):
+                raise sqlite3.OperationalError("Пул БД: не дождались завершения транзакций")
+            self._writer_depth += 1
+            self._record_wait('writer_acquired', started)
+            try:
+                if self._writer.in_transaction:
+                    self._writer.rollback()
+                yield self._writer
+            finally:
+                self._writer_depth -= 1
+                self._writer_lock.release()
+        finally:
+            self._paused = False
+
+    def checkpoint(self):
+        """Переносит WAL в основной файл БД."""
+        conn = self.writer()
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        acquired = stats['writer_acquired'] + stats['reader_acquired']
+        stats['readers_total'] = self._reader_count
+        stats['readers_idle'] = self._readers.qsize()
+        stats['wait_avg'] = stats['wait_total'] / acquired if acquired else 0.0
+        return stats
+
+    def close(self):
+        with self._writer_lock:
+            self._closed = True
+            self._writer.close()
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+        logger.info(f"Пул БД закрыт: {self.path}")
+
+
+# ========== ГЛОБАЛЬНЫЙ ПУЛ ==========
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool(path: str) -> ConnectionPool:
+    global _pool
+    if _pool is None or _pool.path != path:
+        with _pool_lock:
+            if _pool is None or _pool.path != path:
+                if _pool is not None:
+                    _pool.close()
+                _pool = ConnectionPool(path)
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+def writes_paused() -> bool:
+    """Идёт восстановление: запись остановлена защёлкой exclusive()."""
+    return _pool is not None and _pool.paused
+
+def get_pool_stats() -> dict:
+    return _pool.stats() if _pool is not None else {}
@@ -0,0 +1,267 @@
+# FILE: fsm_storage.py
+"""
+Хранилище FSM aiogram в отдельном файле SQLite.
+
+Состояния и данные переживают перезапуск: начатая покупка, черновик тикета,
+обмен и игра продолжаются после деплоя. Горячие ключи лежат в LRU-кэше в
+памяти, запись копится и раз в FSM_FLUSH_INTERVAL секунд уходит в БД одной
+транзакцией (при остановке бота — сразу). Брошенные сценарии старше
+FSM_STATE_TTL считаются пустыми и удаляются purge_expired() по расписанию.
+Данные сериализуются компактным JSON; datetime и кортежи сохраняются.
+В кэше они лежат уже строкой: set_data фиксирует снимок (изменения словаря
+после вызова в хранилище не попадают), get_data отдаёт независимую копию.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import db_pool
+from config import FSM_DB_PATH, FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL, FSM_STATE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+# ========== СЕРИАЛИЗАЦИЯ ==========
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    if isinstance(value, tuple):
+        return {'$t': [_encode(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    return value
+
+def _decode(obj):
+    if '$dt' in obj and len(obj) == 1:
+        return datetime.fromisoformat(obj['$dt'])
+    if '$t' in obj and len(obj) == 1:
+        return tuple(obj['$t'])
+    return obj
+
+def dumps(data: Mapping) -> str:
+    return json.dumps(_encode(dict(data)), ensure_ascii=False, separators=(',', ':'))
+
+def loads(raw: Optional[str]) -> dict:
+    return json.loads(raw, object_hook=_decode) if raw else {}
+
+def make_key(key: StorageKey) -> str:
+    return ':'.join(str(part) if part is not None else '' for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+    ))
+
+
+_EMPTY = dumps({})
+
+
+class _Record:
+    __slots__ = ('state', 'raw', 'updated_at')
+
+    def __init__(self, state=None, raw=None, updated_at=0.0):
+        self.state = state
+        self.raw = raw or _EMPTY  # данные в JSON — в таком виде и пишутся в БД
+        self.updated_at = updated_at
+
+    def is_empty(self) -> bool:
+        return self.state is None and self.raw == _EMPTY
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str = FSM_DB_PATH, cache_size: int = FSM_CACHE_SIZE,
+                 flush_interval: float = FSM_FLUSH_INTERVAL, ttl: float = FSM_STATE_TTL):
+        self.path = path
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._conn = db_pool.open_connection(path)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL
+            ) WITHOUT ROWID
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm(updated_at)')
+        self._conn.commit()
+        self._db_lock = threading.Lock()
+        self._cache = OrderedDict()  # key -> _Record
+        self._dirty = set()
+        self._flusher = None
+        self._flushing = False
+        self._closed = False
+        self._stats = {'hits': 0, 'misses': 0, 'flushes': 0, 'written': 0}
+
+    # ---------- БД (в пуле потоков) ----------
+    def _load_row(self, key: str):
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT state, data, updated_at FROM fsm WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _write_rows(self, upserts: list, deletes: list):
+        with self._db_lock:
+            try:
+                if upserts:
+                    self._conn.executemany('''
+                        INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(key) DO UPDATE SET
+                            state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+                    ''', upserts)
+                if deletes:
+                    self._conn.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def purge_expired(self) -> int:
+        """Удаляет из файла сценарии, не менявшиеся дольше TTL. Синхронная, для планировщика."""
+        with self._db_lock:
+            deleted = self._conn.execute(
+                "DELETE FROM fsm WHERE updated_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+            self._conn.commit()
+        if deleted:
+            logger.info(f"FSM: удалено брошенных сценариев: {deleted}")
+        return deleted
+
+    # ---------- кэш ----------
+    def _expired(self, record: _Record) -> bool:
+        return bool(self.ttl) and record.updated_at < time.time() - self.ttl
+
+    def _remember(self, key: str, record: _Record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        self._trim(keep=key)
+
+    def _trim(self, keep: str = None):
+        """Вытесняет самые старые из уже записанных ключей; несохранённые ждут сброса."""
+        if len(self._cache) <= self.cache_size:
+            return
+        for old_key in list(self._cache):
+            if len(self._cache) <= self.cache_size:
+                break
+            if old_key != keep and old_key not in self._dirty:
+                del self._cache[old_key]
+
+    async def _record(self, key: StorageKey) -> _Record:
+        storage_key = make_key(key)
+        record = self._cache.get(storage_key)
+        if record is not None:
+            self._stats['hits'] += 1
+            self._cache.move_to_end(storage_key)
+        else:
+            self._stats['misses'] += 1
+            loop = asyncio.get_running_loop()
+            row = await loop.run_in_executor(None, self._load_row, storage_key)
+            record = self._cache.get(storage_key)  # могли записать, пока читали
+            if record is None:
+                record = _Record(*row) if row else _Record()
+                self._remember(storage_key, record)
+        if not record.is_empty() and self._expired(record):
+            record.state, record.raw = None, _EMPTY
+        return record
+
+    def _touch(self, key: StorageKey, record: _Record):
+        record.updated_at = time.time()
+        storage_key = make_key(key)
+        self._dirty.add(storage_key)
+        self._remember(storage_key, record)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_later())
+
+    # ---------- запись пачками ----------
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        if not self._dirty or self._closed:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for storage_key in keys:
+            record = self._cache.get(storage_key)
+            if record is None:
+                continue
+            if record.is_empty():
+                deletes.append((storage_key,))
+            else:
+                upserts.append((storage_key, record.state, record.raw, record.updated_at))
+        loop = asyncio.get_running_loop()
+        self._flushing = True
+        try:
+            await loop.run_in_executor(None, self._write_rows, upserts, deletes)
+            self._stats['flushes'] += 1
+            self._stats['written'] += len(keys)
+            self._trim()
+        except Exception as e:
+            logger.error(f"FSM: ошибка записи {len(keys)} ключей: {e}")
+            self._dirty |= keys
+        finally:
+            self._flushing = False
+        # Изменения, пришедшие во время записи (или не записанные), — следующей пачкой
+        if self._dirty and not self._closed:
+            self._flusher = loop.create_task(self._flush_later())
+
+    # ---------- API BaseStorage ----------
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._touch(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        try:
+            raw = dumps(data)  # ошибку получит хендлер, а не фоновая запись
+        except (TypeError, ValueError) as e:
+            raise TypeError(f"Данные FSM должны сериализоваться в JSON: {e}") from e
+        record = await self._record(key)
+        record.raw = raw
+        self._touch(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return loads((await self._record(key)).raw)
+
+    def stats(self) -> dict:
+        return dict(self._stats, cached=len(self._cache), dirty=len(self._dirty))
+
+    async def close(self) -> None:
+        flusher = self._flusher
+        if flusher is not None and not flusher.done():
+            if self._flushing:
+                await asyncio.gather(flusher, return_exceptions=True)  # запись уже идёт — дожидаемся
+            else:
+                flusher.cancel()
+        await self.flush()
+        self._closed = True
+        with self._db_lock:
+            self._conn.close()
+
+
+def create_storage() -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE: 'sqlite' или 'memory'."""
+    from config import FSM_STORAGE
+    if FSM_STORAGE == 'memory':
+        from aiogram.fsm.storage.memory import MemoryStorage
+        return MemoryStorage()
+    if FSM_STORAGE != 'sqlite':
+        logger.warning(f"Неизвестное FSM_STORAGE={FSM_STORAGE!r}, используется sqlite")
+    return SQLiteStorage()
@@ -1,4 +1,5 @@
 # FILE: handlers/admin.py
+import asyncio
 import logging
 import os
 import json
@@ -11,13 +12,13 @@ from aiogram.types import FSInputFile
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from config import (
-    OWNER_ID, TECH_ADMIN_ID, ITEMS_PER_PAGE, BACKUP_DIR,
+    OWNER_ID, TECH_ADMIN_ID, ITEMS_PER_PAGE, BACKUP_DIR, BACKUP_PART_SIZE, MAILING_RATE,
     MINES_GAME_WIN_REWARD, MINES_GAME_LOSE_PENALTY,
     CASINO_BET_AMOUNTS, CASINO_WIN_CHANCE, CASINO_WIN_MULTIPLIER
 )
 from database import (
     get_user, get_user_role, set_user_role, get_user_by_id_or_username,
-    get_all_users, get_user_orders, get_pending_orders, get_order_status, update_order_status,
+    get_user_orders, get_pending_orders, get_order_status, update_order_status,
     get_revenue_for_period, get_active_users_count, get_average_check, get_sales_by_day,
     get_top_buyers_no_admins, get_top_buyers, count_users_by_role,
     update_balance, create_promocode, get_promocode, delete_promocode, get_all_promocodes, update_promocode,
@@ -27,18 +28,20 @@ from database import (
     get_achievement_stats, award_achievement, remove_achievement_from_user,
     create_discount_link, get_all_discount_links, delete_discount_link,
     freeze_user, unfreeze_user, is_user_frozen, get_all_frozen_users,
-    create_backup, list_backups, restore_backup, cleanup_old_backups,
+    list_backups, cleanup_old_backups, delete_backup, read_backup_checksum,
     set_maintenance_mode, is_maintenance_mode, get_maintenance_info,
     log_admin_action, get_admin_logs,
     create_sale, get_all_sales, update_sale, delete_sale,
     save_ticket_template, delete_ticket_template, get_all_ticket_templates, get_ticket_template,
     get_birthday_info, set_birthday_info,
     create_mailing, get_pending_mailings, update_mailing_status, get_mailing_stats,
-    get_users_by_activity, get_db_connection,
+    get_db_connection,
     add_warn, get_warns, remove_warn,
     add_ban, remove_ban, get_ban, is_user_banned, get_all_bans,
     get_ticket, get_all_tickets, add_ticket_message, update_ticket_status
 )
+import database_async as adb
+import cluster
 from keyboards import (
     AdminCallback, UserCallback, PromocodeCallback, BackupCallback, AchievementCallback,
     get_admin_main_keyboard, get_back_to_admin_keyboard, get_economy_keyboard,
@@ -55,13 +58,21 @@ from keyboards import (
 from states import AdminStates
 from helpers import (
     has_access, format_datetime, format_file_size, format_duration,
-    get_role_display, invalidate_settings_cache, invalidate_top_cache
+    get_role_display
 )
 
 logger = logging.getLogger(__name__)
 
 router = Router(name="admin")
 
+
+async def wake_mailer():
+    """Будит воркер рассылок; в кластере он в приёмном процессе."""
+    try:
+        await cluster.call('mailer.enqueue')
+    except (ConnectionError, asyncio.TimeoutError) as e:
+        logger.warning(f"Рассылка начнётся при плановой проверке очереди: {e}")
+
 # ... (весь остальной код admin.py без изменений, только импорт вы
 # ========== ВХОД В АДМИНКУ ==========
 @router.message(Command("admin"))
@@ -118,7 +129,6 @@ async def process_star_rate(message: types.Message, state: FSMContext):
         if rate <= 0:
             raise ValueError
         set_setting('star_rate', str(rate))
-        await invalidate_settings_cache()
         await message.answer(f"✅ Курс изменён: 1⭐ = {rate:.2f}₽")
         await state.clear()
         await economy_menu_custom(message)
@@ -142,7 +152,6 @@ async def process_withdraw_commission(message: types.Message, state: FSMContext)
         if comm < 0 or comm > 100:
             raise ValueError
         set_setting('withdraw_commission', str(comm/100))
-        await invalidate_settings_cache()
         await message.answer(f"✅ Комиссия вывода изменена: {comm:.0f}%")
         await state.clear()
         await economy_menu_custom(message)
@@ -163,7 +172,6 @@ async def process_exchange_commission_real(message: types.Message, state: FSMCon
         if comm < 0 or comm > 100:
             raise ValueError
         set_setting('exchange_commission', str(comm/100))
-        await invalidate_settings_cache()
         await message.answer(f"✅ Комиссия обмена реальные→вирт изменена: {comm:.0f}%")
         await state.clear()
         await economy_menu_custom(message)
@@ -184,7 +192,6 @@ async def process_exchange_commission_virtual(message: types.Message, state: FSM
         if comm < 0 or comm > 100:
             raise ValueError
         set_setting('virtual_to_real_commission', str(comm))
-        await invalidate_settings_cache()
         await message.answer(f"✅ Комиссия обмена вирт→реальные изменена: {comm:.0f}%")
         await state.clear()
         await economy_menu_custom(message)
@@ -205,7 +212,6 @@ async def process_min_stars(message: types.Message, state: FSMContext):
         if min_stars < 1:
             raise ValueError
         set_setting('min_stars', str(min_stars))
-        await invalidate_settings_cache()
         await message.answer(f"✅ Минимальная покупка изменена: {min_stars}⭐")
         await state.clear()
         await economy_menu_custom(message)
@@ -226,7 +232,6 @@ async def process_withdraw_min(message: types.Message, state: FSMContext):
         if min_withdraw < 1:
             raise ValueError
         set_setting('withdraw_min_real', str(min_withdraw))
-        await invalidate_settings_cache()
         await message.answer(f"✅ Минимальный вывод изменён: {min_withdraw}₽")
         await state.clear()
         await economy_menu_custom(message)
@@ -238,7 +243,6 @@ async def process_withdraw_min(message: types.Message, state: FSMContext):
 async def toggle_rounding(callback: types.CallbackQuery):
     current = is_rounding_enabled()
     set_setting('rounding_enabled', '0' if current else '1')
-    await invalidate_settings_cache()
     await callback.answer(f"✅ Округление {'включено' if not current else 'выключено'}", show_alert=True)
     await economy_menu(callback)
 
@@ -1158,18 +1162,62 @@ async def backup_menu(callback: types.CallbackQuery):
     await callback.message.edit_text("💾 <b>БЕКАПЫ</b>", reply_markup=get_backup_menu_keyboard())
     await callback.answer()
 
+async def send_new_backup(message: types.Message):
+    """Создаёт бекап в пуле потоков, показывает прогресс и отправляет файл в чат."""
+    import asyncio
+    import time
+    status = await message.answer("⏳ Создаю бекап...")
+    loop = asyncio.get_running_loop()
+    last_shown = [0.0]
+
+    def progress(done: int, total: int):
+        # Вызывается из потока бекапа; сообщение правим не чаще раза в 2 секунды
+        now = time.monotonic()
+        if total and now - last_shown[0] >= 2:
+            last_shown[0] = now
+            text = f"⏳ Создаю бекап... {done * 100 // total}% ({done}/{total} стр.)"
+            asyncio.run_coroutine_threadsafe(status.edit_text(text), loop)
+
+    try:
+        backup_file = await adb.create_backup(progress)
+    except Exception as e:
+        logger.error(f"Ошибка создания бекапа: {e}")
+        await status.edit_text(f"❌ Ошибка создания бекапа: {e}")
+        return
+    checksum = read_backup_checksum(backup_file) or "—"
+    size = os.path.getsize(backup_file)
+    await status.edit_text("✅ Бекап создан, проверка целостности пройдена")
+    caption = (
+        f"✅ Бекап создан: {os.path.basename(backup_file)}\n"
+        f"Размер: {format_file_size(size)}\n"
+        f"SHA-256: <code>{checksum}</code>"
+    )
+    if size <= BACKUP_PART_SIZE:
+        await message.answer_document(FSInputFile(backup_file), caption=caption)
+        return
+    # Больше лимита Bot API — отправляем частями, манифест последним
+    manifest_path = await adb.split_backup(backup_file)
+    try:
+        with open(manifest_path) as f:
+            parts = json.load(f)['parts']
+        for number, part in enumerate(parts, start=1):
+            part_path = os.path.join(os.path.dirname(manifest_path), part['name'])
+            await message.answer_document(FSInputFile(part_path), caption=f"📦 Часть {number}/{len(parts)}")
+        await message.answer_document(
+            FSInputFile(manifest_path),
+            caption=caption + f"\n\nЧастей: {len(parts)}. Для восстановления положите части и манифест "
+                              f"в один каталог внутри {BACKUP_DIR} и укажите манифест в /restore."
+        )
+    finally:
+        await adb.discard_backup_parts(manifest_path)
+
 @router.callback_query(AdminCallback.filter(F.action == "create_backup"))
 async def create_backup_cmd(callback: types.CallbackQuery):
     if not has_access(callback.from_user.id, 'tech_admin'):
         await callback.answer("⛔ Нет доступа", show_alert=True)
         return
-    backup_file = create_backup()
-    doc = FSInputFile(backup_file)
-    await callback.message.answer_document(
-        doc,
-        caption=f"✅ Бекап создан: {os.path.basename(backup_file)}\nРазмер: {format_file_size(os.path.getsize(backup_file))}"
-    )
     await callback.answer()
+    await send_new_backup(callback.message)
 
 @router.callback_query(AdminCallback.filter(F.action == "list_backups"))
 async def list_backups_cmd(callback: types.CallbackQuery, callback_data: AdminCallback):
@@ -1187,7 +1235,8 @@ async def list_backups_cmd(callback: types.CallbackQuery, callback_data: AdminCa
 
     text = f"📋 <b>СПИСОК БЕКАПОВ</b> (стр. {page}/{total_pages})\n\n"
     for i, b in enumerate(current, start=start+1):
-        text += f"{i}. {b['name']} — {format_file_size(b['size'])} — {format_datetime(b['mtime'])}\n"
+        checked = "🔒" if b['sha256'] else "⚠️ без контрольной суммы"
+        text += f"{i}. {b['name']} — {format_file_size(b['size'])} — {format_datetime(b['mtime'])} {checked}\n"
         text += f"   [🔄 ВОССТАНОВИТЬ] [🗑️ УДАЛИТЬ]\n\n"
 
     keyboard = get_pagination_keyboard(page, total_pages, "list_backups")
@@ -1225,7 +1274,9 @@ async def confirm_restore(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     filepath = data['backup_file']
-    if restore_backup(filepath):
+    await message.answer("⏳ Восстанавливаю базу данных, запись на время подмены приостановлена...")
+    if await adb.restore_backup(filepath):
+        log_admin_action(message.from_user.id, 'restore_backup', 'system', None, {'file': os.path.basename(filepath)})
         await message.answer("✅ База данных восстановлена из бекапа!")
     else:
         await message.answer("❌ Ошибка восстановления.")
@@ -1239,7 +1290,7 @@ async def delete_backup_cmd(callback: types.CallbackQuery, callback_data: Backup
     filename = callback_data.filename
     filepath = os.path.join(BACKUP_DIR, filename)
     try:
-        os.remove(filepath)
+        delete_backup(filepath)
         await callback.answer(f"🗑️ Бекап {filename} удалён", show_alert=True)
     except Exception as e:
         logger.error(f"Ошибка удаления бекапа: {e}")
@@ -1248,10 +1299,10 @@ async def delete_backup_cmd(callback: types.CallbackQuery, callback_data: Backup
 
 @router.callback_query(AdminCallback.filter(F.action == "clear_cache"))
 async def clear_cache_cmd(callback: types.CallbackQuery):
-    from helpers import cache  # <-- ИСПРАВЛЕНО
-    await invalidate_settings_cache()
-    await invalidate_top_cache()
-    await cache.clear()
+    from cache import cache
+    import invalidation
+    cache.clear()
+    invalidation.publish(invalidation.CACHE)
     await callback.answer("🧹 Кэш очищен!", show_alert=True)
 
 @router.callback_query(AdminCallback.filter(F.action == "system_status"))
@@ -1259,11 +1310,42 @@ async def system_status(callback: types.CallbackQuery):
     import psutil
     import platform
     from main import bot
+    from db_pool import get_pool_stats
+    from middlewares import get_throttle_stats
+    from cache import cache
+    import registry
+    import outbox
+    import metrics
     uptime_seconds = (datetime.now() - bot.start_time).seconds if hasattr(bot, 'start_time') else 0
+    pool = get_pool_stats()
+    throttled = get_throttle_stats()
+    throttled_text = ", ".join(f"{name}: {count}" for name, count in sorted(throttled.items())) or "нет"
+    cache_stats = cache.stats()
+    hits = sum(s['hits'] for s in cache_stats.values())
+    misses = sum(s['misses'] for s in cache_stats.values())
+    evictions = sum(s['evictions'] for s in cache_stats.values())
+    hit_rate = hits / (hits + misses) * 100 if hits + misses else 0
+    outbox_text = "\n".join(
+        f"│  {name}: в очереди {s['queued']}, отправлено {s['sent']}, "
+        f"ожидание ср. {s['wait_avg'] * 1000:.0f} мс, запрос ср. {s['latency_avg'] * 1000:.0f} мс"
+        for name, s in outbox.stats().items()
+    )
+    handlers_text = "\n".join(
+        f"│  {router_name}.{handler_name}: {count}, p50 {p50 * 1000:.0f} / p95 {p95 * 1000:.0f} / p99 {p99 * 1000:.0f} мс"
+        for router_name, handler_name, count, p50, p95, p99 in metrics.top_handlers(5)
+    ) or "│  нет данных"
     status_text = (
         f"📊 <b>СТАТУС СИСТЕМЫ</b>\n\n"
         f"├─ Бот: 🟢 РАБОТАЕТ\n"
-        f"├─ БД: 🟢 СОЕДИНЕНИЕ\n"
+        f"├─ БД: 🟢 СОЕДИНЕНИЕ (WAL)\n"
+        f"├─ Пул БД: читателей свободно {pool.get('readers_idle', 0)}/{pool.get('readers_total', 0)}, "
+        f"сверх пула {pool.get('overflow', 0)}\n"
+        f"├─ Ожидание соединения: ср. {pool.get('wait_avg', 0) * 1000:.1f} мс, макс. {pool.get('wait_max', 0) * 1000:.1f} мс\n"
+        f"├─ Отклонено троттлингом: {throttled_text}\n"
+        f"├─ Кэш: {len(cache)} записей, попаданий {hit_rate:.0f}%, вытеснено {evictions}\n"
+        f"├─ Заблокировали бота: {registry.stats()['bot_blocked']} (исключены из рассылок)\n"
+        f"├─ Исходящие:\n{outbox_text}\n"
+        f"├─ Хендлеры (вызовов, время ответа):\n{handlers_text}\n"
         f"├─ RAM: {psutil.virtual_memory().used / 1024 / 1024:.0f} MB / {psutil.virtual_memory().total / 1024 / 1024:.0f} MB\n"
         f"├─ Uptime: {format_duration(uptime_seconds)}\n"
         f"└─ Платформа: {platform.system()} {platform.release()}"
@@ -1357,86 +1439,30 @@ async def preview_mailing(message: types.Message, state: FSMContext):
     media = data.get('mailing_media')
     button = data.get('mailing_button')
 
-    if filter_type == 'all':
-        users = get_all_users()
-        count = len(users)
-    elif filter_type == 'active':
-        active, _ = get_users_by_activity(7)
-        count = len(active)
-    elif filter_type == 'inactive':
-        _, inactive = get_users_by_activity(30)
-        count = len(inactive)
-    elif filter_type == 'top':
-        top = get_top_buyers_no_admins(10)
-        count = len(top)
-    elif filter_type == 'test':
-        count = 1
-    else:
-        count = 0
+    count = await adb.count_audience(filter_type, message.from_user.id)
 
     preview = f"📢 <b>ПРЕДПРОСМОТР РАССЫЛКИ</b>\n\n"
     preview += f"КОМУ: {filter_type} ({count} чел.)\n\n"
     preview += f"ТЕКСТ:\n━━━━━━━━━━━━━━━━━━━━\n{text}\n━━━━━━━━━━━━━━━━━━━━\n\n"
-    preview += f"📊 СТАТИСТИКА:\n├─ Длина текста: {len(text)} символов\n├─ Есть медиа: {'Да' if media else 'Нет'}\n└─ Примерное время отправки: {count//30 + 1} сек"
+    preview += f"📊 СТАТИСТИКА:\n├─ Длина текста: {len(text)} символов\n├─ Есть медиа: {'Да' if media else 'Нет'}\n└─ Примерное время отправки: {int(count / MAILING_RATE) + 1} сек"
     await message.answer(preview, reply_markup=get_mailing_preview_keyboard())
 
 @router.callback_query(AdminCallback.filter(F.action == "mailing_send"))
 async def mailing_send(callback: types.CallbackQuery, state: FSMContext):
-    from main import bot
     data = await state.get_data()
-    filter_type = data.get('mailing_filter')
-    text = data.get('mailing_text')
-    media = data.get('mailing_media')
-    button = data.get('mailing_button')
-
-    if filter_type == 'all':
-        users = get_all_users()
-    elif filter_type == 'active':
-        active, _ = get_users_by_activity(7)
-        users = active
-    elif filter_type == 'inactive':
-        _, inactive = get_users_by_activity(30)
-        users = inactive
-    elif filter_type == 'top':
-        top = get_top_buyers_no_admins(10)
-        users = [(u[0], u[1], u[2]) for u in top]
-    elif filter_type == 'test':
-        users = [(callback.from_user.id, None, None)]
-    else:
-        users = []
-
-    success = 0
-    fail = 0
-
-    for user in users:
-        user_id = user[0] if isinstance(user, tuple) else user[0]
-        try:
-            if media:
-                media_type, file_id = media
-                if media_type == 'photo':
-                    await bot.send_photo(user_id, file_id, caption=text)
-                elif media_type == 'video':
-                    await bot.send_video(user_id, file_id, caption=text)
-                elif media_type == 'animation':
-                    await bot.send_animation(user_id, file_id, caption=text)
-                elif media_type == 'sticker':
-                    await bot.send_sticker(user_id, file_id)
-                    if text:
-                        await bot.send_message(user_id, text)
-            else:
-                await bot.send_message(user_id, text)
-            success += 1
-        except Exception as e:
-            logger.error(f"Ошибка отправки {user_id}: {e}")
-            fail += 1
-
-    await callback.message.edit_text(
-        f"✅ РАССЫЛКА ЗАВЕРШЕНА\n\n"
-        f"📊 РЕЗУЛЬТАТЫ:\n"
-        f"├─ Всего: {len(users)}\n"
-        f"├─ Доставлено: {success}\n"
-        f"└─ Ошибок: {fail}"
+    media_type, file_id = data.get('mailing_media') or (None, None)
+    button_text, button_url = data.get('mailing_button') or (None, None)
+    mailing_id = await adb.create_mailing(
+        callback.from_user.id, data.get('mailing_filter'), data.get('mailing_text'),
+        media_file_id=file_id, media_type=media_type,
+        button_text=button_text, button_url=button_url
     )
+    if not mailing_id:
+        await callback.answer("❌ Не удалось создать рассылку", show_alert=True)
+        return
+    await callback.message.edit_text(f"⏳ Рассылка #{mailing_id} поставлена в очередь...")
+    await adb.set_mailing_progress_message(mailing_id, callback.message.chat.id, callback.message.message_id)
+    await wake_mailer()
     await state.clear()
     await callback.answer()
 
@@ -1513,17 +1539,13 @@ async def list_orders(callback: types.CallbackQuery):
 # ========== СТАТИСТИКА ==========
 @router.callback_query(AdminCallback.filter(F.action == "stats_menu"))
 async def stats_menu(callback: types.CallbackQuery):
-    revenue_day = get_revenue_for_period(1)
-    revenue_week = get_revenue_for_period(7)
-    revenue_month = get_revenue_for_period(30)
-    active_users_day = get_active_users_count(1)
-    active_users_week = get_active_users_count(7)
-    active_users_month = get_active_users_count(30)
-    avg_check_day = get_average_check(1)
-    avg_check_week = get_average_check(7)
-    avg_check_month = get_average_check(30)
-    top_buyers = get_top_buyers_no_admins(5)
-    users_by_role = count_users_by_role()
+    summary = await adb.get_stats_summary((1, 7, 30), top_limit=5)
+    day, week, month = (summary['periods'][days] for days in (1, 7, 30))
+    revenue_day, revenue_week, revenue_month = day['revenue'], week['revenue'], month['revenue']
+    active_users_day, active_users_week, active_users_month = day['active_users'], week['active_users'], month['active_users']
+    avg_check_day, avg_check_week, avg_check_month = day['avg_check'], week['avg_check'], month['avg_check']
+    top_buyers = summary['top']
+    users_by_role = summary['roles']
     stats_text = "📊 <b>СТАТИСТИКА БОТА</b>\n\n"
     stats_text += "💰 <b>Выручка:</b>\n"
     stats_text += f"• За день: {revenue_day:.2f}₽\n"
@@ -1678,12 +1700,107 @@ async def cmd_backup(message: types.Message):
     if not has_access(message.from_user.id, 'tech_admin'):
         await message.answer("⛔ Нет доступа")
         return
-    backup_file = create_backup()
-    doc = FSInputFile(backup_file)
-    await message.answer_document(
-        doc,
-        caption=f"✅ Бекап создан: {os.path.basename(backup_file)}\nРазмер: {format_file_size(os.path.getsize(backup_file))}"
+    await send_new_backup(message)
+
+@router.message(Command("rebuild_sales"))
+async def cmd_rebuild_sales(message: types.Message):
+    if not has_access(message.from_user.id, 'tech_admin'):
+        await message.answer("⛔ Нет доступа")
+        return
+    await message.answer("⏳ Пересчитываю дневной свод продаж...")
+    days = await adb.rebuild_sales_daily()
+    if days is None:
+        await message.answer("❌ Ошибка пересчёта свода продаж")
+        return
+    log_admin_action(message.from_user.id, 'rebuild_sales', 'system', None, {'days': days})
+    await message.answer(f"✅ Свод продаж пересчитан: {days} дн.")
+
+@router.message(Command("jobs"))
+async def cmd_jobs(message: types.Message):
+    if not has_access(message.from_user.id, 'tech_admin'):
+        await message.answer("⛔ Нет доступа")
+        return
+    try:
+        jobs = await cluster.call('scheduler.snapshot')
+    except (ConnectionError, asyncio.TimeoutError, RuntimeError) as e:
+        await message.answer(f"❌ Планировщик недоступен: {e}")
+        return
+    if not jobs:
+        await message.answer("📭 Задач нет")
+        return
+    text = "⏰ <b>ПЛАНИРОВЩИК</b>\n\n"
+    for job in jobs:
+        state = "▶️ выполняется" if job['running'] else ("⚠️ ошибка" if job['last_error'] else "✅")
+        text += (
+            f"<b>{job['name']}</b> {state} — {job['description']}\n"
+            f"├─ Расписание: {job['schedule']}\n"
+            f"├─ Следующий запуск: {job['next_run'] or '—'}\n"
+            f"├─ Последний: {job['last_run'] or '—'}"
+            + (f", {job['last_duration']:.2f} сек" if job['last_duration'] is not None else "") + "\n"
+            f"└─ Запусков: {job['runs']}, ошибок: {job['failures']}, пропущено: {job['skipped']}, "
+            f"ср. {job['avg_duration']:.2f} / макс. {job['max_duration']:.2f} сек\n\n"
+        )
+    text += "Запустить сейчас: /runjob имя"
+    await message.answer(text)
+
+@router.message(Command("runjob"))
+async def cmd_runjob(message: types.Message):
+    if not has_access(message.from_user.id, 'tech_admin'):
+        await message.answer("⛔ Нет доступа")
+        return
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.answer("❌ Использование: /runjob имя_задачи")
+        return
+    try:
+        found = await cluster.call('scheduler.run_now', args[1].strip())
+    except (ConnectionError, asyncio.TimeoutError, RuntimeError) as e:
+        await message.answer(f"❌ Планировщик недоступен, задача не запущена: {e}")
+        return
+    if not found:
+        await message.answer("❌ Нет такой задачи. Список: /jobs")
+        return
+    log_admin_action(message.from_user.id, 'run_job', 'system', None, {'job': args[1].strip()})
+    await message.answer(f"✅ Задача {args[1].strip()} поставлена на запуск")
+
+@router.message(Command("sqltop"))
+async def cmd_sqltop(message: types.Message):
+    if not has_access(message.from_user.id, 'tech_admin'):
+        await message.answer("⛔ Нет доступа")
+        return
+    from html import escape
+    import sqltrace
+    args = message.text.split(maxsplit=1)
+    arg = args[1].strip() if len(args) > 1 else ""
+    if not sqltrace.stats()['enabled']:
+        await message.answer("ℹ️ Трассировка SQL выключена. Включить: SQL_TRACE=1 и перезапуск")
+        return
+    if arg == "reset":
+        sqltrace.reset()
+        await message.answer("✅ Статистика SQL сброшена")
+        return
+    limit = min(int(arg), 15) if arg.isdigit() and int(arg) > 0 else 10
+    rows = sqltrace.top(limit)
+    if not rows:
+        await message.answer("📭 Запросов пока не было")
+        return
+    stats = sqltrace.stats()
+    text = (
+        f"🐢 <b>ТОП SQL ПО ВРЕМЕНИ</b>\n"
+        f"Запросов: {stats['statements']}, выполнений: {stats['calls']}, всего {stats['total']:.2f} сек\n\n"
     )
+    for index, row in enumerate(rows, 1):
+        sql = row['sql'] if len(row['sql']) <= 200 else row['sql'][:200] + "…"
+        entry = (
+            f"<b>{index}.</b> {'⚠️ SCAN TABLE ' if row['full_scan'] else ''}<code>{escape(sql)}</code>\n"
+            f"└─ {row['total']:.3f} сек, вызовов {row['calls']}, ср. {row['avg'] * 1000:.2f} / "
+            f"макс. {row['max'] * 1000:.1f} мс, медленных {row['slow']}\n\n"
+        )
+        if len(text) + len(entry) > 3900:  # лимит сообщения Telegram
+            break
+        text += entry
+    text += "Сбросить: /sqltop reset"
+    await message.answer(text)
 
 @router.message(Command("restore"))
 async def cmd_restore(message: types.Message, state: FSMContext):
@@ -1692,7 +1809,7 @@ async def cmd_restore(message: types.Message, state: FSMContext):
         return
     args = message.text.split(maxsplit=1)
     if len(args) < 2:
-        await message.answer("❌ Использование: /restore имя_файла.db")
+        await message.answer("❌ Использование: /restore имя_файла.db.gz")
         return
     filename = args[1]
     filepath = os.path.join(BACKUP_DIR, filename)
@@ -2083,17 +2200,13 @@ async def cmd_news(message: types.Message):
         await message.answer("❌ Использование: /news текст новости")
         return
     news_text = args[1]
-    users = get_all_users()
-    success = 0
-    fail = 0
-    from main import bot
-    for user in users:
-        try:
-            await bot.send_message(user[0], f"📢 <b>Новости:</b>\n\n{news_text}")
-            success += 1
-        except Exception:
-            fail += 1
-    await message.answer(f"✅ Рассылка завершена!\nОтправлено: {success}\nНе доставлено: {fail}")
+    mailing_id = await adb.create_mailing(message.from_user.id, 'all', f"📢 <b>Новости:</b>\n\n{news_text}")
+    if not mailing_id:
+        await message.answer("❌ Не удалось создать рассылку")
+        return
+    progress = await message.answer(f"⏳ Рассылка #{mailing_id} поставлена в очередь...")
+    await adb.set_mailing_progress_message(mailing_id, progress.chat.id, progress.message_id)
+    await wake_mailer()
 
 @router.message(Command("addpromo"))
 async def cmd_addpromo(message: types.Message, state: FSMContext):
@@ -2152,6 +2265,10 @@ async def cmd_helpadmin(message: types.Message):
         "🛠️ <b>Техническое:</b>\n"
         "/backup - Создать бекап\n"
         "/restore имя_файла.db - Восстановить\n"
+        "/rebuild_sales - Пересчитать свод продаж\n"
+        "/jobs - Периодические задачи\n"
+        "/runjob имя - Запустить задачу сейчас\n"
+        "/sqltop [N] - Самые затратные SQL-запросы\n"
         "/teh_on - Включить тех.работы\n"
         "/teh_off - Выключить тех.работы\n"
         "/freeze @username причина - Заморозить\n"
@@ -2187,16 +2304,12 @@ async def cmd_stats(message: types.Message):
     if not has_access(message.from_user.id, 'admin'):
         await message.answer("⛔ Нет доступа")
         return
-    revenue_day = get_revenue_for_period(1)
-    revenue_week = get_revenue_for_period(7)
-    revenue_month = get_revenue_for_period(30)
-    active_day = get_active_users_count(1)
-    active_week = get_active_users_count(7)
-    active_month = get_active_users_count(30)
-    avg_day = get_average_check(1)
-    avg_week = get_average_check(7)
-    avg_month = get_average_check(30)
-    top = get_top_buyers_no_admins(5)
+    summary = await adb.get_stats_summary((1, 7, 30), top_limit=5)
+    day, week, month = (summary['periods'][days] for days in (1, 7, 30))
+    revenue_day, revenue_week, revenue_month = day['revenue'], week['revenue'], month['revenue']
+    active_day, active_week, active_month = day['active_users'], week['active_users'], month['active_users']
+    avg_day, avg_week, avg_month = day['avg_check'], week['avg_check'], month['avg_check']
+    top = summary['top']
     text = (
         f"📊 <b>Статистика бота</b>\n\n"
         f"💰 <b>Выручка:</b>\n"
@@ -11,7 +11,7 @@ from config import BOT_USERNAME
 from database import (
     get_user, get_user_orders, get_warns, get_user_referrals, get_db_connection,
     get_user_achievements, get_all_achievements, get_referral_level, get_referral_levels,
-    get_cached_top_buyers, invalidate_top_cache, is_user_frozen, get_freeze_info,
+    get_top_buyers_no_admins, is_user_frozen, get_freeze_info,
     create_user
 )
 from keyboards import MenuCallback, get_back_to_menu_keyboard, get_referrals_keyboard
@@ -56,13 +56,15 @@ async def show_profile_internal(message: types.Message, user_id: int, edit: bool
     referrals_count = len(referrals)
 
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT COALESCE(SUM(amount), 0) FROM referral_rewards WHERE referrer_id = ?",
-        (user_id,)
-    )
-    referrals_earnings = cursor.fetchone()[0]
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM referral_rewards WHERE referrer_id = ?",
+            (user_id,)
+        )
+        referrals_earnings = cursor.fetchone()[0]
+    finally:
+        conn.close()
 
     level = get_referral_level(referrals_count)
 
@@ -154,10 +156,12 @@ async def show_achievements(callback: types.CallbackQuery):
                 text += f"   Прогресс: {bar} {total:.0f} / 50 000₽\n"
             elif code == 'games_100':
                 conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(*) FROM games WHERE user_id = ? AND game_type = 'casino_virtual'", (user_id,))
-                games = cursor.fetchone()[0]
-                conn.close()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT COUNT(*) FROM games WHERE user_id = ? AND game_type = 'casino_virtual'", (user_id,))
+                    games = cursor.fetchone()[0]
+                finally:
+                    conn.close()
                 progress = min(100, int(games / 100 * 100))
                 bar = "█" * (progress // 10) + "░" * (10 - progress // 10)
                 text += f"   Прогресс: {bar} {games} / 100\n"
@@ -191,17 +195,19 @@ async def show_referrals(callback: types.CallbackQuery):
     total_turnover = 0
     earned = 0
     conn = get_db_connection()
-    cursor = conn.cursor()
-    for ref in referrals:
-        ref_id = ref[0]
-        cursor.execute("SELECT SUM(total_price) FROM purchase_history WHERE user_id = ?", (ref_id,))
-        turnover = cursor.fetchone()[0] or 0
-        total_turnover += turnover
-        if turnover > 0:
-            active += 1
-    cursor.execute("SELECT SUM(amount) FROM referral_rewards WHERE referrer_id = ? AND paid = 1", (user_id,))
-    earned = cursor.fetchone()[0] or 0
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        for ref in referrals:
+            ref_id = ref[0]
+            cursor.execute("SELECT SUM(total_price) FROM purchase_history WHERE user_id = ?", (ref_id,))
+            turnover = cursor.fetchone()[0] or 0
+            total_turnover += turnover
+            if turnover > 0:
+                active += 1
+        cursor.execute("SELECT SUM(amount) FROM referral_rewards WHERE referrer_id = ? AND paid = 1", (user_id,))
+        earned = cursor.fetchone()[0] or 0
+    finally:
+        conn.close()
 
     text = (
         f"━━━━━━━━━━━━━━━━━━━━\n"
@@ -218,22 +224,24 @@ async def show_referrals(callback: types.CallbackQuery):
         text += "👤 АКТИВНЫЕ РЕФЕРАЛЫ:\n"
         shown = 0
         conn = get_db_connection()
-        cursor = conn.cursor()
-        for ref in referrals[:5]:
-            ref_id, ref_username, ref_name, joined = ref
-            cursor.execute("SELECT COUNT(*), SUM(total_price) FROM purchase_history WHERE user_id = ?", (ref_id,))
-            purchases, spent = cursor.fetchone()
-            purchases = purchases or 0
-            spent = spent or 0
-            if purchases > 0:
-                shown += 1
-                reward = spent * level['percent'] / 100
-                text += f"━━━━━━━━━━━━━━━━━━━━\n"
-                text += f"{shown}. @{ref_username or 'no_username'}\n"
-                text += f"   ├─ Покупок: {purchases}\n"
-                text += f"   ├─ Оборот: {spent:.2f}₽\n"
-                text += f"   └─ Ваш доход: {reward:.0f} ⭐\n"
-        conn.close()
+        try:
+            cursor = conn.cursor()
+            for ref in referrals[:5]:
+                ref_id, ref_username, ref_name, joined = ref
+                cursor.execute("SELECT COUNT(*), SUM(total_price) FROM purchase_history WHERE user_id = ?", (ref_id,))
+                purchases, spent = cursor.fetchone()
+                purchases = purchases or 0
+                spent = spent or 0
+                if purchases > 0:
+                    shown += 1
+                    reward = spent * level['percent'] / 100
+                    text += f"━━━━━━━━━━━━━━━━━━━━\n"
+                    text += f"{shown}. @{ref_username or 'no_username'}\n"
+                    text += f"   ├─ Покупок: {purchases}\n"
+                    text += f"   ├─ Оборот: {spent:.2f}₽\n"
+                    text += f"   └─ Ваш доход: {reward:.0f} ⭐\n"
+        finally:
+            conn.close()
         if len(referrals) > 5:
             text += f"\n... и ещё {len(referrals)-5} рефералов\n"
     else:
@@ -268,7 +276,7 @@ async def show_referrals(callback: types.CallbackQuery):
 # ========== ТОП ПОКУПАТЕЛЕЙ ==========
 @router.callback_query(MenuCallback.filter(F.action == "top_buyers"))
 async def show_top_buyers(callback: types.CallbackQuery):
-    top = await get_cached_top_buyers(10)
+    top = get_top_buyers_no_admins(10)
     if not top:
         await callback.message.edit_text("🏆 Топ покупателей пока пуст.", reply_markup=get_back_to_menu_keyboard())
         await callback.answer()
@@ -49,7 +49,7 @@ from states import (
 )
 from helpers import (
     get_screenshot_path, format_datetime, has_access,
-    invalidate_balance_cache, invalidate_top_cache, is_duplicate_action,
+    is_duplicate_action,
     generate_referral_code, get_role_display
 )
 
@@ -179,23 +179,25 @@ async def cmd_support(message: types.Message):
 async def cmd_staff(message: types.Message):
     from database import get_db_connection
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT username, full_name, role 
-        FROM users 
-        WHERE role IN ('agent', 'moder', 'admin', 'tech_admin', 'owner')
-        ORDER BY 
-          CASE role
-            WHEN 'owner' THEN 1
-            WHEN 'tech_admin' THEN 2
-            WHEN 'admin' THEN 3
-            WHEN 'moder' THEN 4
-            WHEN 'agent' THEN 5
-            ELSE 6
-          END
-    ''')
-    staff = cursor.fetchall()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT username, full_name, role 
+            FROM users 
+            WHERE role IN ('agent', 'moder', 'admin', 'tech_admin', 'owner')
+            ORDER BY 
+              CASE role
+                WHEN 'owner' THEN 1
+                WHEN 'tech_admin' THEN 2
+                WHEN 'admin' THEN 3
+                WHEN 'moder' THEN 4
+                WHEN 'agent' THEN 5
+                ELSE 6
+              END
+        ''')
+        staff = cursor.fetchall()
+    finally:
+        conn.close()
     if not staff:
         await message.answer("📭 Список администрации пуст.")
         return
@@ -516,13 +518,15 @@ async def _process_screenshot_file(message: types.Message, state: FSMContext):
         discount = get_user_active_discount(user_id)
         if discount:
             conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE orders SET discount = total_price * ? / 100 WHERE id = ?",
-                (discount, order_id)
-            )
-            conn.commit()
-            conn.close()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "UPDATE orders SET discount = total_price * ? / 100 WHERE id = ?",
+                    (discount, order_id)
+                )
+                conn.commit()
+            finally:
+                conn.close()
             mark_discount_used(user_id, order_id)
 
     order_text = (
@@ -563,13 +567,15 @@ async def approve_order(callback: types.CallbackQuery, callback_data: OrderCallb
     update_order_status(order_id, "approved")
 
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT user_id, amount, recipient_username, total_price, discount FROM orders WHERE id = ?",
-        (order_id,)
-    )
-    order = cursor.fetchone()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT user_id, amount, recipient_username, total_price, discount FROM orders WHERE id = ?",
+            (order_id,)
+        )
+        order = cursor.fetchone()
+    finally:
+        conn.close()
     if order:
         user_id, amount, recipient_username, total_price, discount = order
         final_price = total_price - (discount or 0)
@@ -586,7 +592,6 @@ async def approve_order(callback: types.CallbackQuery, callback_data: OrderCallb
         except Exception as e:
             logger.error(f"Ошибка уведомления пользователя: {e}")
         log_admin_action(callback.from_user.id, 'approve_order', 'order', order_id, {'amount': amount})
-        await invalidate_top_cache()
 
     await callback.message.edit_reply_markup(reply_markup=get_processed_order_keyboard("approved"))
     await callback.answer("✅ Заказ подтверждён", show_alert=True)
@@ -604,10 +609,12 @@ async def reject_order(callback: types.CallbackQuery, callback_data: OrderCallba
     update_order_status(order_id, "rejected")
 
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM orders WHERE id = ?", (order_id,))
-    row = cursor.fetchone()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id FROM orders WHERE id = ?", (order_id,))
+        row = cursor.fetchone()
+    finally:
+        conn.close()
     if row:
         user_id = row[0]
         try:
@@ -904,42 +911,42 @@ async def approve_exchange(callback: types.CallbackQuery, callback_data: Exchang
         await callback.answer("⛔ Нет доступа", show_alert=True)
         return
 
+    # Писатель не держим через await: ответы отправляются после close()
+    error = None
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT user_id, amount, converted_amount, from_currency, to_currency, recipient_username FROM exchanges WHERE exchange_id = ?",
-        (exchange_id,)
-    )
-    result = cursor.fetchone()
-    if not result:
-        conn.close()
-        await callback.answer("❌ Заявка не найдена", show_alert=True)
-        return
-
-    user_id, amount, converted, from_cur, to_cur, recipient = result
-
-    if from_cur == 'real' and to_cur == 'virtual':
-        if not update_balance(user_id, converted, 'virtual', 'add'):
-            await callback.answer("❌ Ошибка начисления виртуальных звёзд", show_alert=True)
-            conn.close()
-            return
-        success_text = f"✅ Ваша заявка на обмен #{exchange_id} одобрена!\n" \
-                       f"Вы обменяли {amount} реальных ⭐ на {converted} виртуальных ⭐."
-    elif from_cur == 'virtual' and to_cur == 'real':
-        success_text = f"✅ Ваша заявка на обмен #{exchange_id} одобрена!\n" \
-                       f"Сумма к выдаче: {converted} реальных ⭐\nПолучатель: {recipient}"
-    else:
-        await callback.answer("❌ Неизвестный тип обмена", show_alert=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT user_id, amount, converted_amount, from_currency, to_currency, recipient_username FROM exchanges WHERE exchange_id = ?",
+            (exchange_id,)
+        )
+        result = cursor.fetchone()
+        if not result:
+            error = "❌ Заявка не найдена"
+        else:
+            user_id, amount, converted, from_cur, to_cur, recipient = result
+            if from_cur == 'real' and to_cur == 'virtual':
+                if not update_balance(user_id, converted, 'virtual', 'add'):
+                    error = "❌ Ошибка начисления виртуальных звёзд"
+                success_text = f"✅ Ваша заявка на обмен #{exchange_id} одобрена!\n" \
+                               f"Вы обменяли {amount} реальных ⭐ на {converted} виртуальных ⭐."
+            elif from_cur == 'virtual' and to_cur == 'real':
+                success_text = f"✅ Ваша заявка на обмен #{exchange_id} одобрена!\n" \
+                               f"Сумма к выдаче: {converted} реальных ⭐\nПолучатель: {recipient}"
+            else:
+                error = "❌ Неизвестный тип обмена"
+            if error is None:
+                cursor.execute(
+                    "UPDATE exchanges SET status = 'approved' WHERE exchange_id = ?",
+                    (exchange_id,)
+                )
+                conn.commit()
+    finally:
         conn.close()
+    if error is not None:
+        await callback.answer(error, show_alert=True)
         return
 
-    cursor.execute(
-        "UPDATE exchanges SET status = 'approved' WHERE exchange_id = ?",
-        (exchange_id,)
-    )
-    conn.commit()
-    conn.close()
-
     try:
         bot = callback.bot
         await bot.send_message(user_id, success_text)
@@ -959,24 +966,28 @@ async def reject_exchange(callback: types.CallbackQuery, callback_data: Exchange
         return
 
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT user_id, amount, from_currency FROM exchanges WHERE exchange_id = ?",
-        (exchange_id,)
-    )
-    result = cursor.fetchone()
-    if result:
-        user_id, amount, from_cur = result
-        if from_cur == 'real':
-            update_balance(user_id, amount, 'real', 'add')
-        else:
-            update_balance(user_id, amount, 'virtual', 'add')
-
+    try:
+        cursor = conn.cursor()
         cursor.execute(
-            "UPDATE exchanges SET status = 'rejected' WHERE exchange_id = ?",
+            "SELECT user_id, amount, from_currency FROM exchanges WHERE exchange_id = ?",
             (exchange_id,)
         )
-        conn.commit()
+        result = cursor.fetchone()
+        if result:
+            user_id, amount, from_cur = result
+            if from_cur == 'real':
+                update_balance(user_id, amount, 'real', 'add')
+            else:
+                update_balance(user_id, amount, 'virtual', 'add')
+
+            cursor.execute(
+                "UPDATE exchanges SET status = 'rejected' WHERE exchange_id = ?",
+                (exchange_id,)
+            )
+            conn.commit()
+    finally:
+        conn.close()
+    if result:
         try:
             bot = callback.bot
             await bot.send_message(
@@ -987,7 +998,6 @@ async def reject_exchange(callback: types.CallbackQuery, callback_data: Exchange
         except Exception as e:
             logger.error(f"Ошибка уведомления пользователя {user_id}: {e}")
         log_admin_action(callback.from_user.id, 'reject_exchange', 'exchange', None, {'exchange_id': exchange_id})
-    conn.close()
 
     await callback.message.edit_reply_markup(reply_markup=None)
     await callback.answer("❌ Заявка отклонена!", show_alert=True)
@@ -1048,25 +1058,29 @@ async def process_withdrawal_recipient(message: types.Message, state: FSMContext
         await state.clear()
         return
 
+    # Писатель не держим через await: возврат и ответ — после close()
     withdrawal_id = str(uuid.uuid4())
+    created = False
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
         cursor.execute(
-            """INSERT INTO withdrawals (withdrawal_id, user_id, amount, payout_amount, recipient_username, status) 
+            """INSERT INTO withdrawals (withdrawal_id, user_id, amount, payout_amount, recipient_username, status)
             VALUES (?, ?, ?, ?, ?, 'pending')""",
             (withdrawal_id, user_id, amount, real_amount, recipient)
         )
         conn.commit()
+        created = True
     except Exception as e:
         conn.rollback()
         logger.error(f"Ошибка создания заявки: {e}")
+    finally:
+        conn.close()
+    if not created:
         update_balance(user_id, amount, 'virtual', 'add')
         await message.answer("❌ Ошибка создания заявки!")
         await state.clear()
         return
-    finally:
-        conn.close()
 
     user = get_user(user_id)
     username = user[2] or "без юзернейма"
@@ -1110,13 +1124,15 @@ async def reject_withdrawal(callback: types.CallbackQuery, callback_data: Withdr
         await callback.answer("⛔ Нет доступа", show_alert=True)
         return
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, amount FROM withdrawals WHERE withdrawal_id = ?", (withdrawal_id,))
-    row = cursor.fetchone()
-    if row:
-        user_id, amount = row
-        update_balance(user_id, amount, 'virtual', 'add')
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, amount FROM withdrawals WHERE withdrawal_id = ?", (withdrawal_id,))
+        row = cursor.fetchone()
+        if row:
+            user_id, amount = row
+            update_balance(user_id, amount, 'virtual', 'add')
+    finally:
+        conn.close()
     update_withdrawal_status(withdrawal_id, 'rejected')
     await callback.answer("❌ Вывод отклонён!", show_alert=True)
     await callback.message.edit_reply_markup(reply_markup=None)
@@ -1272,10 +1288,11 @@ async def process_feedback_text(message: types.Message, state: FSMContext):
         await state.clear()
         return
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE feedback SET text = ? WHERE id = ?", (message.text, feedback_id))
-    conn.commit()
-    conn.close()
+    try:
+        conn.execute("UPDATE feedback SET text = ? WHERE id = ?", (message.text, feedback_id))
+        conn.commit()
+    finally:
+        conn.close()
     await message.answer("✅ Комментарий добавлен! Спасибо!")
     await state.clear()
 
@@ -1303,10 +1320,11 @@ async def process_feedback_photo(message: types.Message, state: FSMContext):
         return
     photo = message.photo[-1]
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE feedback SET photo_id = ? WHERE id = ?", (photo.file_id, feedback_id))
-    conn.commit()
-    conn.close()
+    try:
+        conn.execute("UPDATE feedback SET photo_id = ? WHERE id = ?", (photo.file_id, feedback_id))
+        conn.commit()
+    finally:
+        conn.close()
     await message.answer("✅ Фото добавлено! Спасибо!")
     await state.clear()
 
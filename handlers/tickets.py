@@ -88,11 +88,13 @@ async def process_ticket_message(message: types.Message, state: FSMContext):
 
         priority = auto_set_priority_text(text)
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE tickets SET priority = ?, topic_id = ?, topic_name = ? WHERE id = ?",
-                      (priority, topic_id, topic_name, ticket_id))
-        conn.commit()
-        conn.close()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE tickets SET priority = ?, topic_id = ?, topic_name = ? WHERE id = ?",
+                          (priority, topic_id, topic_name, ticket_id))
+            conn.commit()
+        finally:
+            conn.close()
 
         if media_type == 'photo':
             await bot.send_photo(
@@ -357,10 +359,12 @@ async def close_ticket_callback(callback: types.CallbackQuery, callback_data: Ti
 
     update_ticket_status(ticket_id, 'closed')
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE tickets SET closed_by = ? WHERE id = ?", (user_id, ticket_id))
-    conn.commit()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE tickets SET closed_by = ? WHERE id = ?", (user_id, ticket_id))
+        conn.commit()
+    finally:
+        conn.close()
 
     if ticket[4]:
         try:
@@ -413,14 +417,16 @@ async def rate_ticket_callback(callback: types.CallbackQuery, callback_data: Tic
     agent_id = ticket[8] if len(ticket) > 8 else None  # closed_by
     if not agent_id:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT user_id FROM ticket_messages 
-            WHERE ticket_id = ? AND is_from_support = 1 
-            ORDER BY created_at DESC LIMIT 1
-        ''', (ticket_id,))
-        row = cursor.fetchone()
-        conn.close()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user_id FROM ticket_messages 
+                WHERE ticket_id = ? AND is_from_support = 1 
+                ORDER BY created_at DESC LIMIT 1
+            ''', (ticket_id,))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
         agent_id = row[0] if row else None
 
     if agent_id:
@@ -464,9 +470,11 @@ async def set_priority(callback: types.CallbackQuery, callback_data: TicketCallb
     ticket_id = callback_data.ticket_id
 
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE tickets SET priority = ? WHERE id = ?", (emoji, ticket_id))
-    conn.commit()
+    try:
+        conn.execute("UPDATE tickets SET priority = ? WHERE id = ?", (emoji, ticket_id))
+        conn.commit()
+    finally:
+        conn.close()
     ticket = get_ticket(ticket_id)
     if ticket and ticket[4]:
         try:
@@ -478,7 +486,6 @@ async def set_priority(callback: types.CallbackQuery, callback_data: TicketCallb
             )
         except Exception as e:
             logger.error(f"Ошибка обновления названия топика: {e}")
-    conn.close()
 
     await callback.answer(f"✅ Приоритет изменён на {emoji}", show_alert=True)
     await show_ticket_details_internal(callback, ticket_id)
@@ -557,16 +564,18 @@ async def group_open_tickets(callback: types.CallbackQuery):
 async def group_my_tickets(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT DISTINCT t.id, t.user_id, t.subject, t.status, t.priority, t.created_at
-        FROM tickets t
-        JOIN ticket_messages tm ON t.id = tm.ticket_id
-        WHERE tm.user_id = ? AND tm.is_from_support = 1
-        ORDER BY t.created_at DESC
-    ''', (user_id,))
-    tickets = cursor.fetchall()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT DISTINCT t.id, t.user_id, t.subject, t.status, t.priority, t.created_at
+            FROM tickets t
+            JOIN ticket_messages tm ON t.id = tm.ticket_id
+            WHERE tm.user_id = ? AND tm.is_from_support = 1
+            ORDER BY t.created_at DESC
+        ''', (user_id,))
+        tickets = cursor.fetchall()
+    finally:
+        conn.close()
     if not tickets:
         await callback.message.edit_text("📭 Вы ещё не участвовали в тикетах.")
         await callback.answer()
@@ -613,10 +622,12 @@ async def process_search_query(message: types.Message, state: FSMContext):
     else:
         clean = query.lstrip('@')
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE username = ?", (clean,))
-        row = cursor.fetchone()
-        conn.close()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id FROM users WHERE username = ?", (clean,))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
         if row:
             user_id = row[0]
             tickets = get_user_tickets(user_id)
@@ -664,17 +675,19 @@ async def agent_stats_callback(callback: types.CallbackQuery):
 @router.callback_query(TicketCallback.filter(F.action == "group_rating"))
 async def group_rating(callback: types.CallbackQuery):
     conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT u.username, u.full_name, AVG(tr.rating) as avg_rating, COUNT(tr.id) as votes
-        FROM ticket_ratings tr
-        JOIN users u ON tr.agent_id = u.user_id
-        GROUP BY tr.agent_id
-        ORDER BY avg_rating DESC, votes DESC
-        LIMIT 10
-    ''')
-    top = cursor.fetchall()
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.username, u.full_name, AVG(tr.rating) as avg_rating, COUNT(tr.id) as votes
+            FROM ticket_ratings tr
+            JOIN users u ON tr.agent_id = u.user_id
+            GROUP BY tr.agent_id
+            ORDER BY avg_rating DESC, votes DESC
+            LIMIT 10
+        ''')
+        top = cursor.fetchall()
+    finally:
+        conn.close()
     if not top:
         await callback.message.edit_text("⭐ Рейтинг поддержки пока пуст.")
         await callback.answer()
@@ -8,182 +8,22 @@ import uuid
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any, Tuple, Union
 
-from aiocache import Cache
-from aiocache.decorators import cached
-
 from config import (
-    SCREENSHOTS_DIR, BACKUP_DIR, CACHE_TTL_BALANCE, CACHE_TTL_TOP, CACHE_TTL_STAR_RATE,
-    ACTION_TIMEOUT_SECONDS, REQUIRED_CHANNELS
-)
-from database import (
-    get_user, get_star_rate, get_top_buyers_no_admins, clear_settings_cache,
-    is_user_banned, is_user_frozen, get_freeze_info, get_ban,
-    is_maintenance_mode, get_maintenance_info
+    SCREENSHOTS_DIR, BACKUP_DIR, ACTION_TIMEOUT_SECONDS, REQUIRED_CHANNELS
 )
+from cache import cache
 
 logger = logging.getLogger(__name__)
 
-# ========== КЭШИРОВАНИЕ ==========
-cache = Cache(Cache.MEMORY)
-
-@cached(ttl=CACHE_TTL_BALANCE, key="balance:{user_id}")
-async def get_cached_balance(user_id: int, currency: str = 'virtual'):
-    user = get_user(user_id)
-    if not user:
-        return 0
-    return user[5] if currency == 'virtual' else user[4]
-
-async def invalidate_balance_cache(user_id: int):
-    await cache.delete(f"balance:{user_id}")
-
-@cached(ttl=CACHE_TTL_TOP, key="top_buyers")
-async def get_cached_top_buyers(limit: int = 10):
-    return get_top_buyers_no_admins(limit)
-
-async def invalidate_top_cache():
-    await cache.delete("top_buyers")
-
-@cached(ttl=CACHE_TTL_STAR_RATE, key="star_rate")
-async def get_cached_star_rate():
-    return get_star_rate()
-
-async def invalidate_settings_cache():
-    clear_settings_cache()
-    await cache.delete("star_rate")
-    await cache.delete("top_buyers")
-
 # ========== ДЕДУПЛИКАЦИЯ ДЕЙСТВИЙ ==========
 async def is_duplicate_action(action_id: str, ttl: int = 5) -> bool:
-    key = f"action:{action_id}"
-    if await cache.exists(key):
-        return True
-    await cache.set(key, "1", ttl=ttl)
-    return False
-
-# ========== MIDDLEWARE ДЛЯ ПРОВЕРКИ БАНА ==========
-async def check_ban_middleware(handler, event, data):
-    """Middleware для проверки, забанен ли пользователь."""
-    from aiogram import types
-    
-    user_id = None
-    if isinstance(event, (types.Message, types.CallbackQuery)):
-        user_id = event.from_user.id
-    else:
-        return await handler(event, data)
-    
-    # Пропускаем команду /start
-    if isinstance(event, types.Message) and event.text and event.text.startswith('/start'):
-        return await handler(event, data)
-    
-    if is_user_banned(user_id):
-        ban = get_ban(user_id)
-        reason = ban[2] if ban else "Не указана"
-        banned_until = ban[4] if ban and len(ban) > 4 else None
-        
-        text = "🚫 Вы забанены!\n"
-        text += f"Причина: {reason}\n"
-        if banned_until:
-            try:
-                banned_until_dt = datetime.strptime(banned_until, '%Y-%m-%d %H:%M:%S')
-                text += f"Бан истекает: {format_datetime(banned_until_dt)}"
-            except:
-                text += f"Бан навсегда"
-        else:
-            text += "Бан навсегда"
-        
-        if isinstance(event, types.Message):
-            await event.answer(text)
-        elif isinstance(event, types.CallbackQuery):
-            await event.answer(text, show_alert=True)
-        return
-    
-    return await handler(event, data)
-
-# ========== MIDDLEWARE ДЛЯ ПРОВЕРКИ ТЕХНИЧЕСКИХ РАБОТ ==========
-async def check_maintenance_middleware(handler, event, data):
-    """Middleware для проверки режима технических работ."""
-    from aiogram import types
-    from helpers import has_access
-    
-    if not is_maintenance_mode():
-        return await handler(event, data)
-    
-    user_id = None
-    if isinstance(event, (types.Message, types.CallbackQuery)):
-        user_id = event.from_user.id
-    
-    # Админы и владелец могут работать в режиме ТО
-    if user_id and has_access(user_id, 'admin'):
-        return await handler(event, data)
-    
-    info = get_maintenance_info()
-    reason = info.get('reason', 'Плановые работы')
-    duration = info.get('duration', '15 минут')
-    
-    text = (
-        "🔧 <b>Ведутся технические работы</b>\n\n"
-        f"📋 Причина: {reason}\n"
-        f"⏳ Ориентировочно: {duration}\n\n"
-        "Приносим извинения за неудобства!\n"
-        "Попробуйте зайти позже."
-    )
-    
-    if isinstance(event, types.Message):
-        await event.answer(text)
-    elif isinstance(event, types.CallbackQuery):
-        await event.answer("🔧 Технические работы", show_alert=True)
-        await event.message.answer(text)
-    
-    return None
-
-# ========== MIDDLEWARE ДЛЯ ПРОВЕРКИ ЗАМОРОЗКИ ==========
-async def check_freeze_middleware(handler, event, data):
-    """Middleware для проверки, заморожен ли пользователь."""
-    from aiogram import types
-    from helpers import has_access
-    
-    user_id = None
-    if isinstance(event, (types.Message, types.CallbackQuery)):
-        user_id = event.from_user.id
-    else:
-        return await handler(event, data)
-    
-    # Админы не блокируются заморозкой
-    if user_id and has_access(user_id, 'admin'):
-        return await handler(event, data)
-    
-    # Пропускаем команду /start и /support
-    if isinstance(event, types.Message):
-        if event.text and event.text.startswith(('/start', '/support')):
-            return await handler(event, data)
-    
-    if is_user_frozen(user_id):
-        freeze_info = get_freeze_info(user_id)
-        reason = freeze_info[0] if freeze_info else "Не указана"
-        date = freeze_info[1] if freeze_info else "Неизвестно"
-        
-        text = (
-            f"❄️ <b>ВАШ АККАУНТ ЗАМОРОЖЕН</b>\n\n"
-            f"🧊 Причина: {reason}\n"
-            f"📅 Дата заморозки: {format_datetime(date)}\n\n"
-            f"Для разморозки обратитесь в поддержку: /support"
-        )
-        
-        if isinstance(event, types.Message):
-            await event.answer(text)
-        elif isinstance(event, types.CallbackQuery):
-            await event.answer("❌ Ваш аккаунт заморожен", show_alert=True)
-        return
-    
-    return await handler(event, data)
+    return not cache.add('actions', action_id, True, ttl=ttl)
 
 # ========== ФУНКЦИИ ДЛЯ ПРОВЕРКИ ПРАВ ДОСТУПА ==========
 def get_user_role(user_id: int) -> str:
-    from database import get_user
-    user = get_user(user_id)
-    if user:
-        return user[7] if len(user) > 7 else 'user'
-    return 'user'
+    # Роль берётся из кэша доступа, его же читает мидлварь
+    from database import get_access_record
+    return get_access_record(user_id)['role']
 
 def has_access(user_id: int, required_role: str) -> bool:
     role = get_user_role(user_id)
@@ -0,0 +1,268 @@
+# FILE: invalidation.py
+"""
+События сброса данных, которые процесс держит в памяти.
+
+Функции database.py после записи обновляют свои кэши сами и вызывают
+publish(): событие Event уходит подписанным транспортам, а пришедшее извне
+применяется через apply() — оно только сбрасывает или перечитывает
+локальные данные и дальше не публикуется.
+    invalidation.publish(invalidation.ACCESS, user_id)
+
+Транспорты:
+    — кластер (cluster.py) — Unix-сокет между приёмным процессом и обработчиками;
+    — журнал в БД (DatabaseBus) — таблица invalidations. Процесс дописывает
+      свои события пачкой и раз в INVALIDATION_POLL_INTERVAL проверяет
+      PRAGMA data_version: пока БД никто не менял, это единственный запрос.
+      Так согласуются несколько экземпляров бота и скрипты администратора
+      на одной БД. Скрипту достаточно вызвать connect() — события запишутся
+      при выходе.
+"""
+import asyncio
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any
+
+from config import DATABASE_NAME, INVALIDATION_POLL_INTERVAL, INVALIDATION_KEEP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# ========== ТИПЫ СОБЫТИЙ ==========
+SETTINGS = 'settings'          # таблица settings (ключ — имя настройки или None)
+ROLE = 'role'                  # роль пользователя (ключ — user_id)
+ACCESS = 'access'              # бан или заморозка (ключ — user_id)
+USER = 'user'                  # новый пользователь или смена имени (ключ — user_id)
+BALANCE = 'balance'            # баланс (ключ — user_id)
+PURCHASES = 'purchases'        # одобрена покупка: топ и статистика
+BOT_BLOCKED = 'bot_blocked'    # заблокировали бота (ключ — список user_id)
+BOT_UNBLOCKED = 'bot_unblocked'  # снова доступен для рассылок (ключ — user_id)
+CACHE = 'cache'                # администратор очистил кэш
+ALL = 'all'                    # БД восстановлена из бекапа — перечитать всё
+
+KINDS = frozenset((SETTINGS, ROLE, ACCESS, USER, BALANCE, PURCHASES, BOT_BLOCKED, BOT_UNBLOCKED, CACHE, ALL))
+
+
+@dataclass(frozen=True)
+class Event:
+    kind: str
+    key: Any = None
+
+    def __post_init__(self):
+        if self.kind not in KINDS:
+            raise ValueError(f"Неизвестное событие инвалидации: {self.kind}")
+
+    def to_json(self) -> list:
+        return [self.kind, self.key]
+
+    @classmethod
+    def from_json(cls, data) -> "Event":
+        return cls(data[0], data[1])
+
+
+_transports = []
+
+
+def subscribe(send):
+    """send(event) вызывается для каждого события этого процесса; должен быть потокобезопасным."""
+    _transports.append(send)
+
+def unsubscribe(send):
+    if send in _transports:
+        _transports.remove(send)
+
+def forward(event: Event, skip=None):
+    """Передаёт событие всем транспортам, кроме skip (откуда оно пришло)."""
+    for send in list(_transports):
+        if send == skip:  # bound-методы сравниваются по ==, не по is
+            continue
+        try:
+            send(event)
+        except Exception as e:
+            logger.error(f"Не удалось разослать событие {event.kind}:{event.key}: {e}")
+
+def publish(kind: str, key=None):
+    forward(Event(kind, key))
+
+# ========== ПРИМЕНЕНИЕ ==========
+def apply(event: Event):
+    """Применяет событие другого процесса к своим кэшам. Синхронная: может читать БД."""
+    import database
+    import registry
+    import settings
+    import leaderboard
+    from cache import cache
+    kind, key = event.kind, event.key
+    if kind == SETTINGS:
+        settings.reload()
+    elif kind == ROLE:
+        database.invalidate_access(key)
+        cache.invalidate_tag('users')
+        leaderboard.reload()  # состав персонала в топе
+    elif kind == ACCESS:
+        registry.refresh(key)
+    elif kind == USER:
+        cache.invalidate_tag('users')
+        user = database.get_user(key)
+        if user:
+            leaderboard.rename(key, user[2], user[3])
+    elif kind == BALANCE:
+        database.invalidate_balance_cache(key)
+    elif kind == PURCHASES:
+        cache.invalidate_tag('purchases')
+        leaderboard.reload()
+    elif kind == BOT_BLOCKED:
+        registry.set_bot_blocked(key)
+    elif kind == BOT_UNBLOCKED:
+        registry.drop_bot_blocked(key)
+    elif kind == CACHE:
+        cache.clear()
+    elif kind == ALL:
+        cache.clear()
+        settings.load()
+        registry.load()
+        leaderboard.load()
+
+# ========== ЖУРНАЛ В БД ==========
+class DatabaseBus:
+    """Транспорт через таблицу invalidations. Своё соединение: запись не смешивается с транзакциями пула."""
+
+    def __init__(self, path: str = DATABASE_NAME):
+        import db_pool
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._conn = db_pool.open_connection(path)
+        self._lock = threading.Lock()
+        self._outgoing = []
+        self._data_version = None
+        self._last_id = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+        self._stats = {'sent': 0, 'received': 0, 'polls': 0}
+
+    def send(self, event: Event):
+        with self._lock:
+            self._outgoing.append(event)
+
+    def flush(self):
+        with self._lock:
+            events, self._outgoing = self._outgoing, []
+            if not events:
+                return
+            now = time.time()
+            try:
+                self._conn.executemany(
+                    "INSERT INTO invalidations (kind, key, origin, created_at) VALUES (?, ?, ?, ?)",
+                    [(e.kind, json.dumps(e.key), self.origin, now) for e in events]
+                )
+                self._conn.commit()
+                self._stats['sent'] += len(events)
+            except Exception:
+                self._conn.rollback()
+                self._outgoing[:0] = events  # повторим следующей пачкой
+                raise
+
+    def poll(self) -> list:
+        """Новые события других процессов. Без изменений в БД — один PRAGMA."""
+        with self._lock:
+            self._stats['polls'] += 1
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._data_version:
+                return []
+            self._data_version = version
+            rows = self._conn.execute(
+                "SELECT id, kind, key, origin FROM invalidations WHERE id > ? ORDER BY id", (self._last_id,)
+            ).fetchall()
+            if not rows:
+                top = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+                if top < self._last_id:
+                    # Журнал «отмотан назад» — БД восстановили из бекапа в другом процессе
+                    self._last_id = top
+                    return [Event(ALL)]
+                return []
+            self._last_id = rows[-1][0]
+        events = []
+        for _, kind, key, origin in rows:
+            if origin == self.origin:
+                continue
+            try:
+                events.append(Event(kind, json.loads(key) if key is not None else None))
+            except ValueError as e:
+                logger.warning(f"Журнал инвалидации: пропущено событие {kind}: {e}")
+        self._stats['received'] += len(events)
+        return events
+
+    def purge(self, keep_seconds: float = INVALIDATION_KEEP_SECONDS) -> int:
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM invalidations WHERE created_at < ?", (time.time() - keep_seconds,)
+            ).rowcount
+            self._conn.commit()
+        return deleted
+
+    def stats(self) -> dict:
+        return dict(self._stats, pending=len(self._outgoing))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._conn.close()
+
+
+_bus = None
+_poller = None
+
+
+def connect(path: str = DATABASE_NAME) -> DatabaseBus:
+    """Подключает процесс к журналу в БД (для скриптов — без опроса, запись при выходе)."""
+    global _bus
+    if _bus is None:
+        _bus = DatabaseBus(path)
+        subscribe(_bus.send)
+        atexit.register(_bus.flush)
+    return _bus
+
+def get_bus():
+    return _bus
+
+async def _poll_worker(bus: DatabaseBus):
+    import database_async as adb
+    while True:
+        try:
+            await adb.run_sync(bus.flush)
+            for event in await adb.run_sync(bus.poll):
+                await adb.run_sync(apply, event)
+                forward(event, skip=bus.send)  # например, обработчикам кластера
+        except Exception as e:
+            logger.error(f"Журнал инвалидации: {e}")
+        await asyncio.sleep(INVALIDATION_POLL_INTERVAL)
+
+def start():
+    """Подключается к журналу и запускает опрос в текущем event loop."""
+    global _poller
+    bus = connect()
+    _poller = asyncio.create_task(_poll_worker(bus))
+    return _poller
+
+def purge_journal() -> int:
+    """Удаляет события старше INVALIDATION_KEEP_SECONDS. Синхронная, для планировщика."""
+    return _bus.purge() if _bus is not None else 0
+
+async def stop():
+    global _poller, _bus
+    if _poller is not None:
+        _poller.cancel()
+        try:
+            await _poller
+        except asyncio.CancelledError:
+            pass
+        _poller = None
+    if _bus is not None:
+        unsubscribe(_bus.send)
+        atexit.unregister(_bus.flush)
+        _bus.close()
+        _bus = None
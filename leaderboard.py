@@ -0,0 +1,154 @@
+# FILE: leaderboard.py
+"""
+Топ покупателей в памяти.
+
+Суммы покупок загружаются одним запросом при старте, дальше таблица
+обновляется инкрементально: update_order_status(..., 'approved') добавляет
+сумму, set_user_role переносит пользователя в персонал или обратно,
+create_user обновляет имя. Рейтинг — отсортированный список (-сумма, user_id),
+поэтому топ-k читается за O(k) и всегда актуален.
+
+Покупки, зафиксированные во время загрузки, копятся в _pending и
+применяются после неё, если их id больше последнего id в снимке загрузки.
+"""
+import logging
+import threading
+from bisect import insort, bisect_left
+
+logger = logging.getLogger(__name__)
+
+# Роли, которые не попадают в публичный топ
+STAFF_ROLES = ('admin', 'tech_admin', 'owner', 'moder', 'agent')
+
+_totals = {}    # user_id -> [сумма, число покупок]
+_names = {}     # user_id -> (username, full_name)
+_staff = set()
+_ranking = []   # (-сумма, user_id), по возрастанию
+_lock = threading.Lock()
+_loaded = False
+_generation = 0  # растёт при reload(): загрузка, начатая раньше, не считается актуальной
+_loading = 0     # число идущих загрузок
+_pending = []    # покупки, зафиксированные во время загрузки: (purchase_id, аргументы)
+
+# ========== ЗАГРУЗКА ==========
+def load():
+    global _loaded, _loading
+    from database import get_read_connection
+    with _lock:
+        _loading += 1
+        generation = _generation
+    try:
+        conn = get_read_connection()
+        try:
+            # MAX(id) в том же запросе — граница снимка: покупки с большим id
+            # в него не попали и применяются из _pending
+            rows = conn.execute('''
+                SELECT h.user_id, u.username, u.full_name, u.role,
+                       SUM(h.total_price), COUNT(h.id),
+                       (SELECT MAX(id) FROM purchase_history)
+                FROM purchase_history h
+                JOIN users u ON h.user_id = u.user_id
+                GROUP BY h.user_id
+            ''').fetchall()
+        finally:
+            conn.close()
+    except Exception:
+        with _lock:
+            _loading -= 1
+            if not _loading:
+                _pending.clear()
+        raise
+    last_id = rows[0][6] if rows else 0
+    with _lock:
+        _loading -= 1
+        _totals.clear()
+        _names.clear()
+        _staff.clear()
+        for user_id, username, full_name, role, total, count, _ in rows:
+            _totals[user_id] = [total or 0, count]
+            _names[user_id] = (username, full_name)
+            if role in STAFF_ROLES:
+                _staff.add(user_id)
+        _ranking[:] = sorted((-total, user_id) for user_id, (total, _) in _totals.items())
+        for purchase_id, purchase in _pending:
+            if purchase_id > last_id:
+                _apply_purchase(*purchase)
+        if not _loading:
+            _pending.clear()
+        _loaded = generation == _generation
+    logger.info(f"Топ покупателей загружен: {len(rows)} покупателей")
+
+def reload():
+    global _loaded, _generation
+    with _lock:
+        _loaded = False
+        _generation += 1
+
+def _ensure_loaded():
+    if not _loaded:
+        load()
+
+# ========== ОБНОВЛЕНИЕ ==========
+def record_purchase(purchase_id: int, user_id: int, amount: float, username: str, full_name: str,
+                    role: str = 'user'):
+    """Вызывается после коммита строки purchase_history с этим id."""
+    purchase = (user_id, amount, username, full_name, role)
+    with _lock:
+        if _loading:
+            _pending.append((purchase_id, purchase))  # загрузка решит, есть ли покупка в снимке
+        elif _loaded:
+            _apply_purchase(*purchase)
+        # иначе первая загрузка прочитает покупку из БД
+
+def _apply_purchase(user_id: int, amount: float, username: str, full_name: str, role: str):
+    # Вызывается под _lock
+    entry = _totals.get(user_id)
+    if entry is None:
+        entry = _totals[user_id] = [0, 0]
+    else:
+        _ranking.pop(bisect_left(_ranking, (-entry[0], user_id)))
+    entry[0] += amount
+    entry[1] += 1
+    insort(_ranking, (-entry[0], user_id))
+    _names[user_id] = (username, full_name)
+    if role in STAFF_ROLES:
+        _staff.add(user_id)
+
+def set_role(user_id: int, role: str):
+    with _lock:
+        if role in STAFF_ROLES:
+            _staff.add(user_id)
+        else:
+            _staff.discard(user_id)
+
+def rename(user_id: int, username: str, full_name: str):
+    with _lock:
+        if user_id in _names:
+            _names[user_id] = (username, full_name)
+
+# ========== ЧТЕНИЕ ==========
+def top(limit: int = 10, include_staff: bool = False) -> list:
+    """[(username, full_name, сумма), ...] по убыванию суммы."""
+    _ensure_loaded()
+    result = []
+    with _lock:
+        for neg_total, user_id in _ranking:
+            if len(result) >= limit:
+                break
+            if not include_staff and user_id in _staff:
+                continue
+            username, full_name = _names[user_id]
+            result.append((username, full_name, -neg_total))
+    return result
+
+def top_user_ids(limit: int = 10, include_staff: bool = False) -> list:
+    """user_id лучших покупателей по убыванию суммы (для рассылок)."""
+    _ensure_loaded()
+    result = []
+    with _lock:
+        for _, user_id in _ranking:
+            if len(result) >= limit:
+                break
+            if include_staff or user_id not in _staff:
+                result.append(user_id)
+    return result
@@ -0,0 +1,234 @@
+# FILE: mailer.py
+"""
+Фоновая доставка рассылок.
+
+Обработчики только создают запись в mailings и будят воркер. Воркер берёт
+рассылки по одной (сначала прерванные со status='running'), читает аудиторию
+пачками по MAILING_AUDIENCE_BATCH в порядке user_id и отправляет с общим
+темпом MAILING_RATE сообщений в секунду и не более MAILING_CONCURRENCY
+запросов одновременно. После каждой
+пачки счётчики и last_user_id фиксируются в БД, поэтому после перезапуска
+рассылка продолжается с контрольной точки (повторно может уйти не больше
+одной пачки). TelegramRetryAfter приостанавливает всю отправку на retry_after.
+Получатели, заблокировавшие бота или удалившие аккаунт, помечаются в users
+(bot_blocked_at) и в следующие рассылки не попадают.
+Администратор видит прогресс в сообщении, которое редактируется по ходу.
+"""
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import (
+    MAILING_RATE, MAILING_CONCURRENCY, MAILING_BATCH_SIZE, MAILING_MAX_RETRIES,
+    MAILING_PROGRESS_INTERVAL, MAILING_POLL_INTERVAL
+)
+import database_async as adb
+import outbox
+
+logger = logging.getLogger(__name__)
+
+_wakeup = None
+_worker = None
+_loop = None
+
+
+class RateLimiter:
+    """Равномерный темп отправки на весь процесс с общей паузой по RetryAfter."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._paused_until = 0.0
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            slot = max(now, self._next, self._paused_until)
+            self._next = slot + self.interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # Пока ждали, могла прийти пауза от RetryAfter — тогда занимаем слот заново
+            if loop.time() >= self._paused_until:
+                return
+
+    def pause(self, seconds: float):
+        until = asyncio.get_running_loop().time() + seconds
+        self._paused_until = max(self._paused_until, until)
+
+
+_limiter = RateLimiter(MAILING_RATE)
+
+# ========== ОТПРАВКА ==========
+def _reply_markup(mailing: dict):
+    if mailing['button_text'] and mailing['button_url']:
+        return InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=mailing['button_text'], url=mailing['button_url'])
+        ]])
+    return None
+
+async def _deliver(bot, user_id: int, mailing: dict):
+    text = mailing['text']
+    file_id = mailing['media_file_id']
+    media_type = mailing['media_type']
+    markup = _reply_markup(mailing)
+    if media_type == 'photo':
+        await bot.send_photo(user_id, file_id, caption=text, reply_markup=markup)
+    elif media_type == 'video':
+        await bot.send_video(user_id, file_id, caption=text, reply_markup=markup)
+    elif media_type == 'animation':
+        await bot.send_animation(user_id, file_id, caption=text, reply_markup=markup)
+    elif media_type == 'sticker':
+        await bot.send_sticker(user_id, file_id, reply_markup=None if text else markup)
+        if text:
+            await _limiter.wait()
+            await bot.send_message(user_id, text, reply_markup=markup)
+    else:
+        await bot.send_message(user_id, text, reply_markup=markup)
+
+# Итог отправки одному получателю
+SENT, FAILED, BLOCKED = 'sent', 'failed', 'blocked'
+
+def _is_permanent(error: Exception) -> bool:
+    """Ошибка, после которой писать пользователю бесполезно."""
+    if isinstance(error, TelegramForbiddenError):
+        return True  # бот заблокирован, аккаунт удалён
+    return isinstance(error, TelegramBadRequest) and 'chat not found' in str(error).lower()
+
+async def _send(bot, semaphore: asyncio.Semaphore, user_id: int, mailing: dict) -> str:
+    async with semaphore:
+        for attempt in range(MAILING_MAX_RETRIES + 1):
+            await _limiter.wait()
+            try:
+                await _deliver(bot, user_id, mailing)
+                return SENT
+            except TelegramRetryAfter as e:
+                logger.warning(f"Рассылка #{mailing['id']}: флуд-лимит, пауза {e.retry_after} сек")
+                _limiter.pause(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                logger.info(f"Рассылка #{mailing['id']}: {user_id} недоступен: {e}")
+                return BLOCKED if _is_permanent(e) else FAILED
+            except Exception as e:
+                logger.error(f"Ошибка отправки {user_id}: {e}")
+                return FAILED
+        return FAILED
+
+# ========== ПРОГРЕСС ==========
+def _progress_text(mailing: dict, finished: bool = False) -> str:
+    total = mailing['total_count'] or 0
+    done = mailing['sent_count'] + mailing['fail_count']
+    percent = done * 100 // total if total else 100
+    header = "✅ РАССЫЛКА ЗАВЕРШЕНА" if finished else "⏳ РАССЫЛКА ИДЁТ"
+    text = (
+        f"{header} #{mailing['id']}\n\n"
+        f"📊 РЕЗУЛЬТАТЫ:\n"
+        f"├─ Всего: {total}\n"
+        f"├─ Обработано: {done} ({percent}%)\n"
+        f"├─ Доставлено: {mailing['sent_count']}\n"
+        f"└─ Ошибок: {mailing['fail_count']}"
+    )
+    if not finished:
+        text += f"\n\n⏱ Осталось примерно: {int(max(total - done, 0) / MAILING_RATE) + 1} сек"
+    return text
+
+async def _show_progress(bot, mailing: dict, finished: bool = False):
+    if not mailing['progress_chat_id'] or not mailing['progress_message_id']:
+        return
+    try:
+        await bot.edit_message_text(
+            _progress_text(mailing, finished),
+            chat_id=mailing['progress_chat_id'],
+            message_id=mailing['progress_message_id']
+        )
+    except TelegramRetryAfter as e:
+        _limiter.pause(e.retry_after)
+    except TelegramBadRequest:
+        pass  # сообщение не изменилось или удалено
+    except Exception as e:
+        logger.warning(f"Не удалось обновить прогресс рассылки #{mailing['id']}: {e}")
+
+# ========== ВОРКЕР ==========
+async def _run_mailing(bot, mailing: dict):
+    mailing_id = mailing['id']
+    resumed = mailing['status'] == 'running'
+    after_user_id = mailing['last_user_id'] or 0
+    if resumed:
+        logger.info(f"Рассылка #{mailing_id} возобновлена после user_id {after_user_id}")
+    else:
+        mailing['total_count'] = await adb.count_audience(mailing['filter_type'], mailing['admin_id'])
+        logger.info(f"Рассылка #{mailing_id} запущена: {mailing['total_count']} получателей")
+    await adb.start_mailing(mailing_id, mailing['total_count'])
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(MAILING_CONCURRENCY)
+    shown_at = 0.0
+    async for recipients in adb.iter_audience(mailing['filter_type'], mailing['admin_id'], after_user_id):
+        for start in range(0, len(recipients), MAILING_BATCH_SIZE):
+            batch = recipients[start:start + MAILING_BATCH_SIZE]
+            results = await asyncio.gather(*(_send(bot, semaphore, user_id, mailing) for user_id in batch))
+            sent = results.count(SENT)
+            failed = len(batch) - sent
+            # Получатель тестовой рассылки — сам администратор, его не помечаем
+            blocked = [] if mailing['filter_type'] == 'test' else [
+                user_id for user_id, result in zip(batch, results) if result == BLOCKED
+            ]
+            await adb.checkpoint_mailing(mailing_id, sent, failed, batch[-1], blocked)
+            mailing['sent_count'] += sent
+            mailing['fail_count'] += failed
+            if loop.time() - shown_at >= MAILING_PROGRESS_INTERVAL:
+                shown_at = loop.time()
+                await _show_progress(bot, mailing)
+
+    await adb.finish_mailing(mailing_id)
+    await _show_progress(bot, mailing, finished=True)
+    logger.info(f"Рассылка #{mailing_id} завершена: доставлено {mailing['sent_count']}, ошибок {mailing['fail_count']}")
+
+async def _mailing_worker(bot):
+    outbox.set_priority(outbox.BULK)  # ответы пользователям уходят раньше рассылки
+    while True:
+        try:
+            mailing = await adb.get_next_mailing()
+        except Exception as e:
+            logger.error(f"Ошибка выборки рассылок: {e}")
+            mailing = None
+        if mailing is None:
+            # Будят обработчики и задача планировщика для отложенных рассылок
+            await _wakeup.wait()
+            _wakeup.clear()
+            continue
+        try:
+            await _run_mailing(bot, mailing)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception(f"Рассылка #{mailing['id']} прервана ошибкой")
+            try:
+                await adb.finish_mailing(mailing['id'], 'failed')
+            except Exception as e:
+                logger.error(f"Не удалось отметить рассылку #{mailing['id']}: {e}")
+                await asyncio.sleep(MAILING_POLL_INTERVAL)
+
+def enqueue():
+    """Будит воркер после создания рассылки."""
+    if _loop is not None and _wakeup is not None:
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+def start(bot):
+    """Запускает воркер рассылок в текущем event loop (подхватывает прерванные)."""
+    global _loop, _wakeup, _worker
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    _worker = asyncio.create_task(_mailing_worker(bot))
+    return _worker
+
+async def stop():
+    global _worker, _loop, _wakeup
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+    _worker = _loop = _wakeup = None
@@ -5,11 +5,29 @@ from datetime import datetime
 
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 
-from config import BOT_TOKEN, OWNER_ID, TECH_ADMIN_ID
-from database import init_db, get_user, create_user, set_user_role
+from config import (
+    BOT_TOKEN, OWNER_ID, TECH_ADMIN_ID, THROTTLE_ROUTER_BUDGETS, BOT_MODE, METRICS_PORT,
+    AUTO_BACKUP_INTERVAL_HOURS, BACKUP_KEEP_COUNT, MAILING_POLL_INTERVAL,
+    SCREENSHOTS_CLEANUP_CRON, SCREENSHOTS_KEEP_DAYS, SCHEDULER_JITTER
+)
+from database import (
+    init_db, get_user, create_user, set_user_role, get_setting, set_maintenance_mode,
+    update_sale, create_backup, cleanup_old_backups
+)
+import database_async
+import registry
+import settings
+import leaderboard
+import mailer
+import outbox
+import cluster
+import invalidation
+import metrics
+import scheduler
+import fsm_storage
+from scheduler import IntervalTrigger, CronTrigger
 
 from handlers.admin import router as admin_router
 from handlers.tickets import router as tickets_router
@@ -18,11 +36,7 @@ from handlers.shop import router as shop_router
 from handlers.games import router as games_router
 from handlers.errors import router as errors_router
 
-from middlewares import (
-    check_ban_middleware,
-    check_freeze_middleware,
-    check_maintenance_middleware
-)
+from middlewares import access_gate_middleware, throttling_middleware, ThrottlingMiddleware
 
 from helpers import cleanup_old_screenshots  # <-- импортируем функцию очистки
 
@@ -31,6 +45,9 @@ logger = logging.getLogger(__name__)
 
 # Инициализация БД
 init_db()
+settings.load()
+registry.load()
+leaderboard.load()
 
 # Создание бота и диспетчера
 bot = Bot(
@@ -38,8 +55,10 @@ bot = Bot(
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 bot.start_time = datetime.now()
+bot.session.middleware(metrics.ApiMetricsMiddleware())  # первой: время запроса вместе с очередью исходящих
+bot.session.middleware(outbox.OutboundMiddleware())  # все отправки — через общие лимиты
 
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=fsm_storage.create_storage())
 
 # ===== ОБНОВЛЕНИЕ ПРОФИЛЕЙ АДМИНИСТРАТОРОВ =====
 async def update_admin_profiles():
@@ -64,24 +83,84 @@ async def update_admin_profiles():
     except Exception as e:
         logger.error(f"Ошибка при обновлении профилей администраторов: {e}")
 
-# ===== ФОНОВАЯ ЗАДАЧА ДЛЯ ОЧИСТКИ СКРИНШОТОВ =====
-async def scheduled_cleanup():
-    """Запускается раз в сутки и удаляет скриншоты старше 30 дней."""
-    while True:
-        await asyncio.sleep(86400)  # 24 часа
-        try:
-            deleted = cleanup_old_screenshots(days=30)
-            logger.info(f"Очистка скриншотов: удалено {deleted} файлов")
-        except Exception as e:
-            logger.error(f"Ошибка при очистке скриншотов: {e}")
+# ===== ПЕРИОДИЧЕСКИЕ ЗАДАЧИ =====
+def cleanup_screenshots_job():
+    deleted = cleanup_old_screenshots(days=SCREENSHOTS_KEEP_DAYS)
+    logger.info(f"Очистка скриншотов: удалено {deleted} файлов")
+
+def _setting_number(key: str, default):
+    try:
+        return float(get_setting(key, default) or default)
+    except ValueError:
+        return default
+
+def _backup_interval() -> int:
+    """Интервал авто-бекапа из настройки auto_backup_interval (часы, 0 — выключен)."""
+    return int(_setting_number('auto_backup_interval', AUTO_BACKUP_INTERVAL_HOURS) * 3600)
+
+def auto_backup_job():
+    backup_file = create_backup()
+    cleanup_old_backups(int(_setting_number('backup_keep_count', BACKUP_KEEP_COUNT)))
+    logger.info(f"Авто-бекап создан: {backup_file}")
+
+def maintenance_expiry_job():
+    """Выключает техработы, когда наступил maintenance_until."""
+    snapshot = settings.current()
+    if snapshot.maintenance_mode and snapshot.maintenance_until and snapshot.maintenance_until <= datetime.now():
+        set_maintenance_mode(False)
+        logger.info("Техработы завершены по сроку")
+
+def sales_expiry_job():
+    """Снимает флаг active с закончившихся акций (цены их и так не учитывают)."""
+    now = datetime.now()
+    for sale in settings.current().sales:
+        if sale.data.get('active', True) and sale.end is not None and sale.end <= now:
+            update_sale(sale.data['id'], {'active': False})
+            logger.info(f"Акция {sale.data.get('name')} завершена")
+
+scheduler.add_job('cleanup_screenshots', cleanup_screenshots_job,
+                  CronTrigger(SCREENSHOTS_CLEANUP_CRON, jitter=SCHEDULER_JITTER), "Удаление старых скриншотов")
+scheduler.add_job('auto_backup', auto_backup_job,
+                  IntervalTrigger(_backup_interval, jitter=SCHEDULER_JITTER), "Авто-бекап и ротация")
+scheduler.add_job('maintenance_expiry', maintenance_expiry_job,
+                  IntervalTrigger(minutes=1), "Окончание техработ по сроку")
+scheduler.add_job('sales_expiry', sales_expiry_job,
+                  IntervalTrigger(minutes=1), "Завершение акций")
+scheduler.add_job('scheduled_mailings', mailer.enqueue,
+                  IntervalTrigger(MAILING_POLL_INTERVAL), "Запуск отложенных рассылок")
+scheduler.add_job('invalidations_purge', invalidation.purge_journal,
+                  IntervalTrigger(hours=1, jitter=SCHEDULER_JITTER), "Очистка журнала инвалидации")
+if isinstance(dp.storage, fsm_storage.SQLiteStorage):
+    scheduler.add_job('fsm_purge', dp.storage.purge_expired,
+                      IntervalTrigger(hours=1, jitter=SCHEDULER_JITTER), "Удаление брошенных FSM-сценариев")
 
 # ===== РЕГИСТРАЦИЯ MIDDLEWARE =====
-dp.message.middleware(check_ban_middleware)
-dp.callback_query.middleware(check_ban_middleware)
-dp.message.middleware(check_maintenance_middleware)
-dp.callback_query.middleware(check_maintenance_middleware)
-dp.message.middleware(check_freeze_middleware)
-dp.callback_query.middleware(check_freeze_middleware)
+dp.message.middleware(throttling_middleware)
+dp.callback_query.middleware(throttling_middleware)
+dp.message.middleware(access_gate_middleware)
+dp.callback_query.middleware(access_gate_middleware)
+
+# Отдельные бюджеты для роутеров (игры, магазин)
+for _router in (games_router, shop_router):
+    if _router.name in THROTTLE_ROUTER_BUDGETS:
+        _throttle = ThrottlingMiddleware(_router.name, *THROTTLE_ROUTER_BUDGETS[_router.name])
+        _router.message.middleware(_throttle)
+        _router.callback_query.middleware(_throttle)
+
+metrics.setup(dp)  # после остальных middleware: метка хендлера ставится последней
+
+# ===== МЕТРИКИ СОСТОЯНИЯ =====
+def _pool_gauge():
+    from db_pool import get_pool_stats
+    pool = get_pool_stats()
+    return {(('state', 'idle'),): pool.get('readers_idle', 0), (('state', 'total'),): pool.get('readers_total', 0)}
+
+metrics.gauge('outbox_queued', "Исходящие в очереди по приоритетам",
+              lambda: {(('priority', name),): s['queued'] for name, s in outbox.stats().items()})
+metrics.gauge('db_pool_readers', "Читатели пула БД", _pool_gauge)
+if isinstance(dp.storage, fsm_storage.SQLiteStorage):
+    metrics.gauge('fsm_storage_entries', "Состояния FSM в памяти",
+                  lambda: {(('kind', kind),): dp.storage.stats()[kind] for kind in ('cached', 'dirty')})
 
 # ===== ПОДКЛЮЧЕНИЕ РОУТЕРОВ =====
 dp.include_router(admin_router)
@@ -91,11 +170,47 @@ dp.include_router(shop_router)
 dp.include_router(games_router)
 dp.include_router(errors_router)
 
+async def run_worker(index: int):
+    """Процесс-обработчик кластера: только обновления, фоновые задачи — в приёмном."""
+    if METRICS_PORT:
+        await metrics.start_server(METRICS_PORT + index + 1)
+    try:
+        await cluster.run_worker(dp, bot, index)
+    finally:
+        await metrics.stop_server()
+        await outbox.stop()
+        await database_async.close()
+
 async def main():
+    if cluster.enabled():
+        cluster.share_limits()
+        if cluster.worker_index() is not None:
+            await run_worker(cluster.worker_index())
+            return
     await update_admin_profiles()
-    asyncio.create_task(scheduled_cleanup())  # <-- запускаем фоновую задачу
-    logger.info("Бот запущен")
-    await dp.start_polling(bot, skip_updates=True)
+    try:
+        registry.start(bot)  # снятие временных банов по сроку
+        mailer.start(bot)    # фоновые рассылки, продолжает прерванные
+        invalidation.start()  # события других экземпляров и скриптов через журнал в БД
+        scheduler.start()    # периодические задачи
+        await metrics.start_server()
+        logger.info("Бот запущен")
+        if cluster.enabled():
+            await cluster.Front(dp, bot).run()
+        elif BOT_MODE == 'webhook':
+            import webhook
+            await webhook.run(dp, bot)
+        else:
+            await bot.delete_webhook()  # после работы на вебхуке getUpdates иначе недоступен
+            await dp.start_polling(bot, skip_updates=True)
+    finally:
+        await scheduler.stop()
+        await mailer.stop()
+        await outbox.stop()
+        await invalidation.stop()
+        await metrics.stop_server()
+        await registry.stop()
+        await database_async.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,341 @@
+# FILE: metrics.py
+"""
+Метрики обработки апдейтов в памяти и их выдача в формате Prometheus.
+
+UpdateMetricsMiddleware (внешняя на dp.update) замеряет каждый апдейт:
+общее время, время в БД и в Bot API, исход (ok, error, unhandled,
+rejected — отклонён мидлварью). Роутер и хендлер подставляет
+HandlerLabelMiddleware — внутренняя, срабатывает после фильтров. Время в БД
+копит db_pool (удержание соединения, вложенные вызовы не суммируются),
+время в Bot API — ApiMetricsMiddleware сессии бота. Кроме того, трассировка
+соединений SQLite считает запросы по таблицам (только при включённом
+сервере — trace callback не бесплатен), а очереди (исходящие, вебхук,
+FSM) отдаются как gauge.
+
+Гистограммы HDR-подобные: логарифмические корзины по 2**SUB_BITS делений,
+ошибка перцентилей не больше ~3% при любом разбросе значений, память — только
+занятые корзины. Сервер /metrics слушает METRICS_HOST:METRICS_PORT
+(по умолчанию выключен).
+"""
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from math import ceil
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+
+from config import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Без сервера счётчики запросов никто не читает — trace callback не ставится
+ENABLED = bool(METRICS_PORT)
+
+# Границы корзин при выдаче в Prometheus, секунды
+EXPORT_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# ========== ГИСТОГРАММА ==========
+class Histogram:
+    SUB_BITS = 6
+    UNIT = 1e-6  # значения хранятся в микросекундах
+
+    def __init__(self):
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def _index(cls, value: int) -> int:
+        bits = value.bit_length()
+        if bits <= cls.SUB_BITS:
+            return value
+        shift = bits - cls.SUB_BITS
+        return (shift << (cls.SUB_BITS - 1)) + (value >> shift)
+
+    @classmethod
+    def _upper(cls, index: int) -> float:
+        """Верхняя граница корзины в секундах."""
+        if index < (1 << cls.SUB_BITS):
+            return index * cls.UNIT
+        shift = (index >> (cls.SUB_BITS - 1)) - 1
+        top = index - (shift << (cls.SUB_BITS - 1))
+        return (((top + 1) << shift) - 1) * cls.UNIT
+
+    def record(self, seconds: float):
+        index = self._index(max(0, int(seconds / self.UNIT)))
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, q: float) -> float:
+        with self._lock:
+            if not self.count:
+                return 0.0
+            target = max(1, ceil(q * self.count))
+            seen = 0
+            for index in sorted(self._counts):
+                seen += self._counts[index]
+                if seen >= target:
+                    return min(self._upper(index), self.max)
+        return self.max
+
+    def cumulative(self, bounds=EXPORT_BOUNDS) -> list:
+        """[(граница, число значений не больше неё), ...] для корзин Prometheus."""
+        with self._lock:
+            items = sorted(self._counts.items())
+        result, seen, position = [], 0, 0
+        for bound in bounds:
+            while position < len(items) and self._upper(items[position][0]) <= bound:
+                seen += items[position][1]
+                position += 1
+            result.append((bound, seen))
+        return result
+
+
+# ========== РЕЕСТР МЕТРИК ==========
+_HELP = {
+    'bot_update_seconds': ('histogram', "Полное время обработки апдейта"),
+    'bot_update_db_seconds': ('histogram', "Время апдейта в обращениях к БД"),
+    'bot_update_api_seconds': ('histogram', "Время апдейта в запросах к Bot API"),
+    'bot_updates_total': ('counter', "Обработанные апдейты по исходу"),
+    'bot_update_db_queries_total': ('counter', "SQL-запросы, выполненные при обработке апдейтов"),
+    'bot_api_request_seconds': ('histogram', "Длительность запросов к Bot API по методам"),
+    'bot_api_errors_total': ('counter', "Ошибки запросов к Bot API"),
+    'db_queries_total': ('counter', "SQL-запросы по таблицам"),
+}
+
+_histograms = {}                # (имя, метки) -> Histogram
+_counters = defaultdict(float)  # (имя, метки) -> значение
+_gauges = {}                    # имя -> (описание, функция -> {метки: значение})
+_lock = threading.Lock()
+
+
+def _labels(**labels) -> tuple:
+    return tuple(sorted(labels.items()))
+
+def histogram(name: str, **labels) -> Histogram:
+    key = (name, _labels(**labels))
+    hist = _histograms.get(key)
+    if hist is None:
+        with _lock:
+            hist = _histograms.setdefault(key, Histogram())
+    return hist
+
+def inc(name: str, value: float = 1, **labels):
+    key = (name, _labels(**labels))
+    with _lock:
+        _counters[key] += value
+
+def gauge(name: str, description: str, collect: Callable[[], dict]):
+    """collect() возвращает {кортеж меток: значение}; () — без меток."""
+    _gauges[name] = (description, collect)
+
+# ========== ВРЕМЯ АПДЕЙТА ==========
+class _UpdateTiming:
+    __slots__ = ('router', 'handler', 'db', 'api', 'queries')
+
+    def __init__(self):
+        self.router = None
+        self.handler = None
+        self.db = 0.0
+        self.api = 0.0
+        self.queries = 0
+
+
+_current = ContextVar('metrics_update', default=None)
+
+def add_db_time(seconds: float):
+    timing = _current.get()
+    if timing is not None:
+        timing.db += seconds
+
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+["\[`]?(\w+)', re.IGNORECASE)
+
+def count_query(sql: str):
+    """Trace callback соединений SQLite: запрос засчитывается первой таблице в нём."""
+    operation = sql.lstrip()[:6].lower()
+    if operation not in ('select', 'insert', 'update', 'delete', 'replac'):
+        return  # BEGIN, COMMIT, PRAGMA и т.п.
+    match = _TABLE_RE.search(sql)
+    inc('db_queries_total', table=match.group(1) if match else '-',
+        op='replace' if operation == 'replac' else operation)
+    timing = _current.get()
+    if timing is not None:
+        timing.queries += 1
+
+# ========== MIDDLEWARE ==========
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any]
+    ) -> Any:
+        timing = _UpdateTiming()
+        token = _current.set(timing)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = await handler(event, data)
+            if timing.handler is not None:
+                outcome = 'ok'
+            else:
+                outcome = 'unhandled' if result is UNHANDLED else 'rejected'
+            return result
+        finally:
+            _current.reset(token)
+            elapsed = time.perf_counter() - started
+            labels = {'router': timing.router or '-', 'handler': timing.handler or '-'}
+            histogram('bot_update_seconds', **labels).record(elapsed)
+            histogram('bot_update_db_seconds', **labels).record(timing.db)
+            histogram('bot_update_api_seconds', **labels).record(timing.api)
+            inc('bot_updates_total', outcome=outcome, **labels)
+            if timing.queries:
+                inc('bot_update_db_queries_total', timing.queries, **labels)
+
+
+class HandlerLabelMiddleware(BaseMiddleware):
+    """Запоминает выбранный хендлер: регистрируется последней, ближе всех к хендлеру."""
+
+    async def __call__(self, handler, event, data):
+        timing = _current.get()
+        handler_object = data.get('handler')
+        if timing is not None and handler_object is not None:
+            callback = handler_object.callback
+            timing.router = getattr(callback, '__module__', '-').rsplit('.', 1)[-1]
+            timing.handler = getattr(callback, '__name__', '-')
+        return await handler(event, data)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        api_method = method.__api_method__
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            inc('bot_api_errors_total', method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            histogram('bot_api_request_seconds', method=api_method).record(elapsed)
+            timing = _current.get()
+            if timing is not None:
+                timing.api += elapsed
+
+
+def setup(dp):
+    """
+    Подключает мидлвари метрик к диспетчеру. Вызывать после остальных мидлварей,
+    чтобы метка хендлера ставилась последней. ApiMetricsMiddleware регистрируется
+    в сессии бота отдельно.
+    """
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    label = HandlerLabelMiddleware()
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(label)
+
+# ========== ЧТЕНИЕ ==========
+def top_handlers(limit: int = 5) -> list:
+    """Самые частые хендлеры: [(роутер, хендлер, число, p50, p95, p99), ...]."""
+    rows = []
+    for (name, labels), hist in list(_histograms.items()):
+        if name != 'bot_update_seconds' or not hist.count:
+            continue
+        labels = dict(labels)
+        if labels['handler'] == '-':
+            continue
+        rows.append((labels['router'], labels['handler'], hist.count,
+                     hist.percentile(0.5), hist.percentile(0.95), hist.percentile(0.99)))
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows[:limit]
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    by_name = defaultdict(list)
+    for (name, labels), hist in list(_histograms.items()):
+        by_name[name].append((labels, hist))
+    with _lock:
+        counters = list(_counters.items())
+    for (name, labels), value in counters:
+        by_name[name].append((labels, value))
+    for name in sorted(by_name):
+        kind, description = _HELP.get(name, ('untyped', name))
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in by_name[name]:
+            if isinstance(value, Histogram):
+                for bound, seen in value.cumulative():
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {seen}")
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {value.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value.sum:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    for name, (description, collect) in sorted(_gauges.items()):
+        try:
+            values = collect()
+        except Exception as e:
+            logger.warning(f"Метрика {name} недоступна: {e}")
+            continue
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in values.items():
+            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    return '\n'.join(lines) + '\n'
+
+# ========== СЕРВЕР ==========
+_runner = None
+
+async def start_server(port: int = METRICS_PORT):
+    """Поднимает /metrics на METRICS_HOST:port. port=0 — выключено; занятый порт не мешает запуску бота."""
+    global _runner
+    if not port:
+        return
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        logger.error(f"Метрики: не удалось открыть {METRICS_HOST}:{port}, сервер не запущен: {e}")
+        await runner.cleanup()
+        return
+    _runner = runner
+    logger.info(f"Метрики: http://{METRICS_HOST}:{port}/metrics")
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
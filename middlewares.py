@@ -1,114 +1,96 @@
 # FILE: middlewares.py
 import logging
-from datetime import datetime
+import time
+from collections import Counter
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
 
-from database import is_user_banned, get_ban, is_user_frozen, get_freeze_info, is_maintenance_mode, get_maintenance_info
-from helpers import has_access, format_datetime
+import database_async as adb
+import db_pool
+import registry
+from config import MAX_REQUESTS_PER_MINUTE, THROTTLE_CALLBACK_BUDGETS, THROTTLE_MAX_BUCKETS
+from helpers import check_permission, format_datetime
 
 logger = logging.getLogger(__name__)
 
-class CheckBanMiddleware(BaseMiddleware):
+class AccessGateMiddleware(BaseMiddleware):
+    """
+    Восстановление БД, бан, техработы и заморозка за один проход; заодно возвращает в рассылки
+    пользователей, которые раньше заблокировали бота.
+    Баны и заморозки берутся из registry, роль — из кэша доступа
+    (adb.get_access_record), поэтому обычный пользователь проходит без
+    обращений к БД.
+    """
     async def __call__(
         self,
         handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
         event: Message | CallbackQuery,
         data: Dict[str, Any]
     ) -> Any:
-        if isinstance(event, Message):
-            if event.text and event.text.startswith(('/start', '/support')):
-                return await handler(event, data)
-            user_id = event.from_user.id
-        elif isinstance(event, CallbackQuery):
-            user_id = event.from_user.id
-        else:
+        if not isinstance(event, (Message, CallbackQuery)) or not event.from_user:
             return await handler(event, data)
+        user_id = event.from_user.id
+        # Идёт горячее восстановление БД — запись остановлена на несколько секунд
+        if db_pool.writes_paused():
+            await self._reject_restoring(event)
+            return
+        # Пользователь снова пишет боту — он снова достижим для рассылок
+        if registry.is_bot_blocked(user_id):
+            await adb.revive_recipient(user_id)
+        # /start и /support доступны забаненным и замороженным, но не во время техработ
+        exempt = isinstance(event, Message) and bool(event.text) and event.text.startswith(('/start', '/support'))
 
-        if is_user_banned(user_id):
-            ban = get_ban(user_id)
-            reason = ban[2] if ban and len(ban) > 2 else "Не указана"
-            banned_until = ban[4] if ban and len(ban) > 4 else None
-            
-            if isinstance(event, Message):
-                ban_text = "🚫 ВЫ ЗАБАНЕНЫ!\n\n"
-                ban_text += f"Причина: {reason}\n"
-                if banned_until:
-                    try:
-                        ban_until_str = format_datetime(banned_until)
-                        ban_text += f"Истекает: {ban_until_str}"
-                    except:
-                        ban_text += f"Истекает: {banned_until}"
-                else:
-                    ban_text += "Навсегда"
-                await event.answer(ban_text)
-                return
-            elif isinstance(event, CallbackQuery):
-                await event.answer("🚫 Вы забанены и не можете использовать бота!", show_alert=True)
+        if not exempt:
+            ban = registry.get_ban(user_id)
+            if ban:
+                await self._reject_banned(event, ban)
                 return
 
-        return await handler(event, data)
-
-class CheckFreezeMiddleware(BaseMiddleware):
-    async def __call__(
-        self,
-        handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
-        event: Message | CallbackQuery,
-        data: Dict[str, Any]
-    ) -> Any:
-        if isinstance(event, Message):
-            if event.text and event.text.startswith(('/start', '/support')):
-                return await handler(event, data)
-            user_id = event.from_user.id
-        elif isinstance(event, CallbackQuery):
-            user_id = event.from_user.id
-        else:
-            return await handler(event, data)
+        if await adb.is_maintenance_mode():
+            access = await adb.get_access_record(user_id)
+            if not check_permission(access['role'], 'tech_admin'):
+                await self._reject_maintenance(event)
+                return None  # Прерываем обработку
 
-        if is_user_frozen(user_id):
-            freeze_info = get_freeze_info(user_id)
-            reason = freeze_info[0] if freeze_info else "Не указана"
-            date = freeze_info[1] if freeze_info else "Неизвестно"
-            text = (
-                f"❄️ ВАШ АККАУНТ ЗАМОРОЖЕН\n\n"
-                f"Причина: {reason}\n"
-                f"Дата: {format_datetime(date)}\n\n"
-                f"Для разморозки обратитесь в поддержку: /support"
-            )
-            if isinstance(event, Message):
-                await event.answer(text)
-            else:
-                await event.answer("❌ Ваш аккаунт заморожен", show_alert=True)
-                await event.message.answer(text)
-            return
+        if not exempt:
+            freeze = registry.get_freeze(user_id)
+            if freeze:
+                await self._reject_frozen(event, freeze)
+                return
 
         return await handler(event, data)
 
-class CheckMaintenanceMiddleware(BaseMiddleware):
-    async def __call__(
-        self,
-        handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
-        event: Message | CallbackQuery,
-        data: Dict[str, Any]
-    ) -> Any:
-        if not is_maintenance_mode():
-            return await handler(event, data)
-
-        # Определяем пользователя
-        if isinstance(event, Message):
-            user_id = event.from_user.id
-        elif isinstance(event, CallbackQuery):
-            user_id = event.from_user.id
+    @staticmethod
+    async def _reject_banned(event: Message | CallbackQuery, ban: dict):
+        if isinstance(event, CallbackQuery):
+            await event.answer("🚫 Вы забанены и не можете использовать бота!", show_alert=True)
+            return
+        reason = ban['reason'] or "Не указана"
+        banned_until = ban['banned_until']
+        ban_text = "🚫 ВЫ ЗАБАНЕНЫ!\n\n"
+        ban_text += f"Причина: {reason}\n"
+        if banned_until:
+            try:
+                ban_until_str = format_datetime(banned_until)
+                ban_text += f"Истекает: {ban_until_str}"
+            except:
+                ban_text += f"Истекает: {banned_until}"
         else:
-            return await handler(event, data)
+            ban_text += "Навсегда"
+        await event.answer(ban_text)
 
-        # Админы и тех.админы пропускаются
-        if has_access(user_id, 'tech_admin'):
-            return await handler(event, data)
+    @staticmethod
+    async def _reject_restoring(event: Message | CallbackQuery):
+        text = "⏳ Идёт восстановление базы данных. Повторите через несколько секунд."
+        if isinstance(event, CallbackQuery):
+            await event.answer(text, show_alert=True)
+        else:
+            await event.answer(text)
 
-        # Для всех остальных – показываем сообщение о техработах
-        info = get_maintenance_info()
+    @staticmethod
+    async def _reject_maintenance(event: Message | CallbackQuery):
+        info = await adb.get_maintenance_info()
         text = (
             "🔧 <b>Ведутся технические работы</b>\n\n"
             f"📋 Причина: {info['reason']}\n"
@@ -116,15 +98,116 @@ class CheckMaintenanceMiddleware(BaseMiddleware):
             "Приносим извинения за неудобства!\n"
             "Попробуйте зайти позже."
         )
-
         if isinstance(event, Message):
             await event.answer(text)
-        elif isinstance(event, CallbackQuery):
+        else:
             await event.answer("🔧 Технические работы", show_alert=True)
             await event.message.answer(text)
 
-        return None  # Прерываем обработку
+    @staticmethod
+    async def _reject_frozen(event: Message | CallbackQuery, freeze: dict):
+        reason = freeze['reason'] or "Не указана"
+        date = freeze['frozen_at'] or "Неизвестно"
+        text = (
+            f"❄️ ВАШ АККАУНТ ЗАМОРОЖЕН\n\n"
+            f"Причина: {reason}\n"
+            f"Дата: {format_datetime(date)}\n\n"
+            f"Для разморозки обратитесь в поддержку: /support"
+        )
+        if isinstance(event, Message):
+            await event.answer(text)
+        else:
+            await event.answer("❌ Ваш аккаунт заморожен", show_alert=True)
+            await event.message.answer(text)
+
+# ========== ТРОТТЛИНГ ==========
+_throttle_rejections = Counter()  # бюджет -> отклонено запросов
+
+def get_throttle_stats() -> dict:
+    return dict(_throttle_rejections)
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Token bucket на пользователя. Общий бюджет name (limit запросов за period
+    секунд) плюс отдельные бюджеты для префиксов callback_data. Экземпляр можно
+    повесить на диспетчер или на отдельный роутер — тогда бюджет у роутера свой.
+    Персонал (moder и выше) не ограничивается.
+    """
+    def __init__(self, name: str = 'global', limit: int = MAX_REQUESTS_PER_MINUTE, period: int = 60,
+                 callback_budgets: Dict[str, tuple] = None):
+        self.name = name
+        self.budgets = {name: (limit, period)}
+        self.prefix_budgets = {}
+        for prefix, (prefix_limit, prefix_period) in (callback_budgets or {}).items():
+            self.prefix_budgets[prefix] = f"{name}:{prefix}"
+            self.budgets[f"{name}:{prefix}"] = (prefix_limit, prefix_period)
+        self._buckets = {}  # (бюджет, user_id) -> [токены, время обновления, уведомлён]
+
+    def _refill(self, budget: str, user_id: int, now: float) -> tuple:
+        """Пополняет корзину. Возвращает её и 0 или сколько секунд ждать токена."""
+        limit, period = self.budgets[budget]
+        rate = limit / period
+        bucket = self._buckets.get((budget, user_id))
+        if bucket is None:
+            bucket = self._buckets[(budget, user_id)] = [float(limit), now, False]
+        else:
+            bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return bucket, (0 if bucket[0] >= 1 else (1 - bucket[0]) / rate)
+
+    def _sweep(self, now: float):
+        # Корзина, простоявшая период, снова полная — хранить её незачем
+        idle = [key for key, bucket in self._buckets.items()
+                if now - bucket[1] >= self.budgets[key[0]][1]]
+        for key in idle:
+            del self._buckets[key]
+
+    async def __call__(
+        self,
+        handler: Callable[[Message | CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not isinstance(event, (Message, CallbackQuery)) or not event.from_user:
+            return await handler(event, data)
+        user_id = event.from_user.id
+        now = time.monotonic()
+        if len(self._buckets) > THROTTLE_MAX_BUCKETS:
+            self._sweep(now)
+
+        # Токен списывается, только если он есть во всех бюджетах:
+        # отклонённый запрос не тратит ни один из них
+        budgets = [self.name]
+        if isinstance(event, CallbackQuery) and event.data:
+            prefix_budget = self.prefix_budgets.get(event.data.split(':', 1)[0])
+            if prefix_budget:
+                budgets.insert(0, prefix_budget)
+
+        buckets = []
+        for budget in budgets:
+            bucket, wait = self._refill(budget, user_id, now)
+            if wait:
+                access = await adb.get_access_record(user_id)
+                if check_permission(access['role'], 'moder'):
+                    return await handler(event, data)
+                _throttle_rejections[budget] += 1
+                await self._reject(event, bucket, wait)
+                return
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket[0] -= 1
+            bucket[2] = False
+        return await handler(event, data)
+
+    @staticmethod
+    async def _reject(event: Message | CallbackQuery, bucket: list, wait: float):
+        text = f"⏳ Слишком много запросов! Подождите {max(1, round(wait))} сек."
+        if isinstance(event, CallbackQuery):
+            await event.answer(text)
+        elif not bucket[2]:
+            # На сообщения отвечаем один раз, пока корзина не пополнится
+            bucket[2] = True
+            await event.answer(text)
 
-check_ban_middleware = CheckBanMiddleware()
-check_freeze_middleware = CheckFreezeMiddleware()
-check_maintenance_middleware = CheckMaintenanceMiddleware()
+access_gate_middleware = AccessGateMiddleware()
+throttling_middleware = ThrottlingMiddleware(callback_budgets=THROTTLE_CALLBACK_BUDGETS)
@@ -0,0 +1,264 @@
+# FILE: outbox.py
+"""
+Единая очередь исходящих сообщений в Telegram.
+
+OutboundMiddleware подключается к сессии бота, поэтому через неё проходит
+любая отправка (send_*, copy_message, forward_message) — и ответы в
+обработчиках, и уведомления, и рассылки. Перед запросом отправка ждёт
+разрешения диспетчера, который соблюдает лимиты Bot API:
+    — общий: OUTBOX_GLOBAL_RATE сообщений в секунду на бота;
+    — личный чат: OUTBOX_CHAT_RATE в секунду с запасом OUTBOX_CHAT_BURST;
+    — группа (chat_id < 0): OUTBOX_GROUP_PER_MINUTE в минуту.
+Разрешения выдаются по приоритету: ответы пользователям, затем
+уведомления в группы, затем массовые рассылки (mailer помечает себя через
+set_priority(BULK)). Внутри чата порядок сообщений сохраняется.
+TelegramRetryAfter приостанавливает чат (а для рассылок — весь массовый
+трафик) на retry_after, после чего отправка повторяется.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import (
+    OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_BURST, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST,
+    OUTBOX_GROUP_PER_MINUTE, OUTBOX_GROUP_BURST, OUTBOX_MAX_RETRIES, OUTBOX_MAX_CHATS
+)
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты, меньше — важнее
+INTERACTIVE, NOTIFY, BULK = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: 'ответы', NOTIFY: 'уведомления', BULK: 'рассылки'}
+
+_priority = contextvars.ContextVar('outbox_priority', default=None)
+
+# Методы, на которые распространяются лимиты на сообщения
+_EXTRA_LIMITED = {'copyMessage', 'copyMessages', 'forwardMessage', 'forwardMessages'}
+_NOT_LIMITED = {'sendChatAction'}
+
+
+def set_priority(priority: int):
+    """Приоритет отправок текущей задачи и порождённых ею (contextvar)."""
+    _priority.set(priority)
+
+def _is_limited(api_method: str) -> bool:
+    if api_method in _NOT_LIMITED:
+        return False
+    return api_method.startswith('send') or api_method in _EXTRA_LIMITED
+
+def _is_group(chat_id) -> bool:
+    return isinstance(chat_id, str) or chat_id < 0  # '@channel' или отрицательный id
+
+
+class _Bucket:
+    """Token bucket с паузой по RetryAfter."""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.paused_until = 0.0
+
+    def ready_in(self, now: float) -> float:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def idle(self, now: float) -> bool:
+        return self.ready_in(now) <= 0 and self.tokens >= self.capacity
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Waiter:
+    __slots__ = ('chat_id', 'future', 'enqueued')
+
+    def __init__(self, chat_id, future, enqueued):
+        self.chat_id = chat_id
+        self.future = future
+        self.enqueued = enqueued
+
+
+def _new_stats() -> dict:
+    return {'sent': 0, 'retries': 0, 'wait_total': 0.0, 'wait_max': 0.0,
+            'latency_total': 0.0, 'latency_max': 0.0}
+
+
+class Outbox:
+    def __init__(self):
+        self._queues = {priority: deque() for priority in PRIORITY_NAMES}
+        self._paused = {priority: 0.0 for priority in PRIORITY_NAMES}
+        self._stats = {priority: _new_stats() for priority in PRIORITY_NAMES}
+        self._chats = {}
+        self._global = None
+        self.global_rate = OUTBOX_GLOBAL_RATE
+        self.global_burst = OUTBOX_GLOBAL_BURST
+        self._wakeup = None
+        self._task = None
+
+    # ---------- ожидание разрешения ----------
+    async def acquire(self, chat_id, priority: int) -> float:
+        """Ждёт слота отправки в чат. Возвращает время ожидания в секундах."""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._global = _Bucket(self.global_rate, self.global_burst, loop.time())
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._dispatcher())
+        waiter = _Waiter(chat_id, loop.create_future(), loop.time())
+        self._queues[priority].append(waiter)
+        self._wakeup.set()
+        await waiter.future  # при отмене диспетчер сам выбросит ожидающего
+        return loop.time() - waiter.enqueued
+
+    def _bucket(self, chat_id, now: float) -> _Bucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= OUTBOX_MAX_CHATS:
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle(now)}
+            if _is_group(chat_id):
+                bucket = _Bucket(OUTBOX_GROUP_PER_MINUTE / 60, OUTBOX_GROUP_BURST, now)
+            else:
+                bucket = _Bucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _pick(self, now: float):
+        """Первый ожидающий, чей чат готов, по приоритетам. Иначе — через сколько проверить снова."""
+        delay = None
+        for priority, queue in self._queues.items():
+            if not queue:
+                continue
+            if self._paused[priority] > now:
+                delay = min(delay, self._paused[priority] - now) if delay is not None else self._paused[priority] - now
+                continue
+            index = 0
+            while index < len(queue):
+                waiter = queue[index]
+                if waiter.future.done():
+                    del queue[index]  # отменён
+                    continue
+                bucket = self._bucket(waiter.chat_id, now)
+                wait = bucket.ready_in(now)
+                if wait <= 0:
+                    del queue[index]
+                    return waiter, bucket, None
+                delay = min(delay, wait) if delay is not None else wait
+                index += 1
+        return None, None, delay
+
+    async def _dispatcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            delay = None
+            while True:
+                now = loop.time()
+                global_wait = self._global.ready_in(now)
+                if global_wait > 0:
+                    delay = global_wait
+                    break
+                waiter, bucket, delay = self._pick(now)
+                if waiter is None:
+                    break
+                self._global.take()
+                bucket.take()
+                waiter.future.set_result(None)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    # ---------- RetryAfter и метрики ----------
+    def retry_after(self, chat_id, priority: int, seconds: float):
+        now = asyncio.get_running_loop().time()
+        bucket = self._bucket(chat_id, now)
+        bucket.paused_until = max(bucket.paused_until, now + seconds)
+        if priority == BULK:
+            # Флуд-лимит во время рассылки — общий, тормозим весь массовый трафик
+            self._paused[BULK] = max(self._paused[BULK], now + seconds)
+        self._stats[priority]['retries'] += 1
+
+    def record(self, priority: int, waited: float, latency: float):
+        stats = self._stats[priority]
+        stats['sent'] += 1
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+        stats['latency_total'] += latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
+
+    def stats(self) -> dict:
+        """По приоритетам: глубина очереди, отправлено, повторы, ожидание и задержка (ср./макс.)."""
+        result = {}
+        for priority, name in PRIORITY_NAMES.items():
+            stats = self._stats[priority]
+            sent = stats['sent']
+            result[name] = {
+                'queued': sum(not waiter.future.done() for waiter in self._queues[priority]),
+                'sent': sent,
+                'retries': stats['retries'],
+                'wait_avg': stats['wait_total'] / sent if sent else 0.0,
+                'wait_max': stats['wait_max'],
+                'latency_avg': stats['latency_total'] / sent if sent else 0.0,
+                'latency_max': stats['latency_max'],
+            }
+        return result
+
+    def share(self, parts: int):
+        """Общий лимит бота делится между процессами кластера."""
+        self.global_rate = OUTBOX_GLOBAL_RATE / parts
+        self.global_burst = max(1.0, OUTBOX_GLOBAL_BURST / parts)
+        if self._global is not None:
+            self._global.rate, self._global.capacity = self.global_rate, self.global_burst
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
+outbox = Outbox()
+
+
+# ========== MIDDLEWARE СЕССИИ ==========
+class OutboundMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None or not _is_limited(method.__api_method__):
+            return await make_request(bot, method)
+        priority = _priority.get()
+        if priority is None:
+            priority = NOTIFY if _is_group(chat_id) else INTERACTIVE
+        for attempt in range(OUTBOX_MAX_RETRIES + 1):
+            waited = await outbox.acquire(chat_id, priority)
+            started = time.monotonic()
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                outbox.retry_after(chat_id, priority, e.retry_after)
+                if attempt == OUTBOX_MAX_RETRIES:
+                    raise
+                logger.warning(f"Флуд-лимит в чате {chat_id}: пауза {e.retry_after} сек, повтор")
+                continue
+            outbox.record(priority, waited, time.monotonic() - started)
+            return result
+
+
+def stats() -> dict:
+    return outbox.stats()
+
+async def stop():
+    await outbox.stop()
@@ -0,0 +1,231 @@
+# FILE: registry.py
+"""
+Реестр банов и заморозок в памяти.
+
+Загружается из таблиц bans/freezes при старте и дальше обновляется функциями
+database.py (add_ban, remove_ban, freeze_user, unfreeze_user). Проверка на
+горячем пути — поиск в словаре и сравнение с заранее посчитанным timestamp,
+без разбора дат. Временные баны снимаются фоновой задачей точно в banned_until
+по куче сроков, пользователь получает уведомление.
+
+Здесь же множество пользователей, заблокировавших бота (users.bot_blocked_at):
+рассылки их пропускают, а первый входящий апдейт от такого пользователя
+возвращает его в аудиторию.
+"""
+import asyncio
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_bans = {}      # user_id -> {'reason', 'banned_until', 'until_ts'}
+_freezes = {}   # user_id -> {'reason', 'frozen_at'}
+_bot_blocked = set()  # user_id, до которых рассылка не доходит
+_expiry_heap = []  # (until_ts, user_id); устаревшие записи отбрасываются при извлечении
+_lock = threading.Lock()
+_loaded = False
+
+_loop = None
+_wakeup = None
+_worker = None
+
+# ========== ЗАГРУЗКА ==========
+def load():
+    """Читает bans и freezes из БД и заменяет содержимое реестра."""
+    global _loaded
+    from database import get_read_connection
+    conn = get_read_connection()
+    try:
+        bans = conn.execute("SELECT user_id, reason, banned_until FROM bans").fetchall()
+        freezes = conn.execute("SELECT user_id, reason, frozen_at FROM freezes").fetchall()
+        blocked = conn.execute("SELECT user_id FROM users WHERE bot_blocked_at IS NOT NULL").fetchall()
+    finally:
+        conn.close()
+    with _lock:
+        _bans.clear()
+        _freezes.clear()
+        _expiry_heap.clear()
+        for user_id, reason, banned_until in bans:
+            _put_ban(user_id, reason, banned_until)
+        for user_id, reason, frozen_at in freezes:
+            _freezes[user_id] = {'reason': reason, 'frozen_at': frozen_at}
+        _bot_blocked.clear()
+        _bot_blocked.update(row[0] for row in blocked)
+        _loaded = True
+    _wake()
+    logger.info(f"Реестр доступа загружен: банов {len(bans)}, заморозок {len(freezes)}, "
+                f"заблокировали бота {len(blocked)}")
+
+def reload():
+    """Сбрасывает реестр, следующая проверка загрузит его заново (после восстановления БД)."""
+    global _loaded
+    with _lock:
+        _loaded = False
+    _wake()
+
+def _ensure_loaded():
+    if not _loaded:
+        load()
+
+# ========== ИЗМЕНЕНИЕ ==========
+def _put_ban(user_id: int, reason: str, banned_until):
+    from database import parse_ban_until
+    until = parse_ban_until(banned_until)
+    until_ts = until.timestamp() if until else None
+    _bans[user_id] = {
+        'reason': reason,
+        'banned_until': str(banned_until) if banned_until else None,
+        'until_ts': until_ts,
+    }
+    if until_ts is not None:
+        heapq.heappush(_expiry_heap, (until_ts, user_id))
+
+def set_ban(user_id: int, reason: str, banned_until=None):
+    if not _loaded:
+        return  # реестр ещё не загружен — загрузка прочитает бан из БД
+    with _lock:
+        _put_ban(user_id, reason, banned_until)
+    _wake()
+
+def drop_ban(user_id: int):
+    with _lock:
+        _bans.pop(user_id, None)
+
+def set_freeze(user_id: int, reason: str, frozen_at=None):
+    if not _loaded:
+        return
+    with _lock:
+        _freezes[user_id] = {'reason': reason, 'frozen_at': frozen_at}
+
+def drop_freeze(user_id: int):
+    with _lock:
+        _freezes.pop(user_id, None)
+
+def refresh(user_id: int):
+    """Перечитывает бан и заморозку одного пользователя (изменены другим процессом)."""
+    if not _loaded:
+        return
+    from database import get_read_connection
+    conn = get_read_connection()
+    try:
+        ban = conn.execute("SELECT reason, banned_until FROM bans WHERE user_id = ?", (user_id,)).fetchone()
+        freeze = conn.execute("SELECT reason, frozen_at FROM freezes WHERE user_id = ?", (user_id,)).fetchone()
+    finally:
+        conn.close()
+    with _lock:
+        _bans.pop(user_id, None)
+        _freezes.pop(user_id, None)
+        if ban:
+            _put_ban(user_id, *ban)
+        if freeze:
+            _freezes[user_id] = {'reason': freeze[0], 'frozen_at': freeze[1]}
+    _wake()
+
+def set_bot_blocked(user_ids):
+    if not _loaded:
+        return
+    with _lock:
+        _bot_blocked.update(user_ids)
+
+def drop_bot_blocked(user_id: int):
+    with _lock:
+        _bot_blocked.discard(user_id)
+
+# ========== ПРОВЕРКИ ==========
+def get_ban(user_id: int):
+    """Действующий бан или None. Истёкший, но ещё не снятый бан не учитывается."""
+    _ensure_loaded()
+    ban = _bans.get(user_id)
+    if ban is None:
+        return None
+    if ban['until_ts'] is not None and ban['until_ts'] <= time.time():
+        return None
+    return ban
+
+def is_banned(user_id: int) -> bool:
+    return get_ban(user_id) is not None
+
+def get_freeze(user_id: int):
+    _ensure_loaded()
+    return _freezes.get(user_id)
+
+def is_frozen(user_id: int) -> bool:
+    return get_freeze(user_id) is not None
+
+def is_bot_blocked(user_id: int) -> bool:
+    _ensure_loaded()
+    return user_id in _bot_blocked
+
+def stats() -> dict:
+    return {'bans': len(_bans), 'freezes': len(_freezes), 'scheduled': len(_expiry_heap),
+            'bot_blocked': len(_bot_blocked)}
+
+# ========== СНЯТИЕ ВРЕМЕННЫХ БАНОВ ==========
+def _wake():
+    if _loop is not None and _wakeup is not None:
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+def _pop_expired(now: float) -> list:
+    expired = []
+    with _lock:
+        while _expiry_heap and _expiry_heap[0][0] <= now:
+            until_ts, user_id = heapq.heappop(_expiry_heap)
+            ban = _bans.get(user_id)
+            # Бан могли снять или продлить — тогда запись в куче устарела
+            if ban is not None and ban['until_ts'] == until_ts:
+                expired.append(user_id)
+    return expired
+
+def _next_deadline():
+    with _lock:
+        return _expiry_heap[0][0] if _expiry_heap else None
+
+async def _lift_ban(bot, user_id: int):
+    import database_async as adb
+    await adb.remove_ban(user_id)
+    logger.info(f"Временный бан пользователя {user_id} снят по истечении срока")
+    try:
+        await bot.send_message(
+            user_id,
+            "✅ Срок вашего бана истёк.\n\nВы снова можете пользоваться ботом."
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось уведомить {user_id} о снятии бана: {e}")
+
+async def _expiry_worker(bot):
+    while True:
+        if not _loaded:
+            import database_async as adb
+            await adb.run_sync(load)
+        deadline = _next_deadline()
+        timeout = None if deadline is None else max(0.0, deadline - time.time())
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        for user_id in _pop_expired(time.time()):
+            try:
+                await _lift_ban(bot, user_id)
+            except Exception as e:
+                logger.error(f"Ошибка снятия бана {user_id}: {e}")
+
+def start(bot):
+    """Запускает фоновую задачу снятия банов в текущем event loop."""
+    global _loop, _wakeup, _worker
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    _worker = asyncio.create_task(_expiry_worker(bot))
+    return _worker
+
+async def stop():
+    global _worker, _loop, _wakeup
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+    _worker = _loop = _wakeup = None
@@ -0,0 +1,283 @@
+# FILE: scheduler.py
+"""
+Планировщик периодических задач внутри процесса бота.
+
+Задача — функция (синхронная выполняется в пуле потоков БД) и триггер:
+    scheduler.add_job('backup', make_backup, IntervalTrigger(hours=6), "Авто-бекап")
+    scheduler.add_job('cleanup', cleanup, CronTrigger('30 4 * * *'), "Очистка")
+Время последнего запуска хранится в таблице scheduler_jobs, поэтому после
+перезапуска интервалы отсчитываются от реального запуска, а пропущенный
+запуск выполняется сразу. Задача не запускается, пока не закончился её
+предыдущий запуск (такой слот считается пропущенным). По каждой задаче
+копятся длительность, число запусков и ошибок — их показывает /jobs.
+"""
+import asyncio
+import inspect
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# ========== ТРИГГЕРЫ ==========
+class IntervalTrigger:
+    """Каждые N секунд; seconds может быть функцией (интервал из настроек)."""
+
+    def __init__(self, seconds=0, minutes=0, hours=0, jitter: float = 0):
+        if callable(seconds):
+            self._seconds = seconds
+        else:
+            total = seconds + minutes * 60 + hours * 3600
+            self._seconds = lambda: total
+        self.jitter = jitter
+
+    def next_after(self, last_run: Optional[datetime], now: datetime) -> Optional[datetime]:
+        seconds = self._seconds()
+        if not seconds or seconds <= 0:
+            return None  # задача отключена настройкой
+        base = last_run or now
+        return base + timedelta(seconds=seconds)
+
+    def describe(self) -> str:
+        seconds = self._seconds()
+        if not seconds or seconds <= 0:
+            return "отключена"
+        seconds = int(seconds)
+        if seconds % 3600 == 0:
+            return f"каждые {seconds // 3600} ч"
+        if seconds % 60 == 0:
+            return f"каждые {seconds // 60} мин"
+        return f"каждые {seconds} сек"
+
+
+class CronTrigger:
+    """Выражение cron из пяти полей: минута час день месяц день_недели (0 — воскресенье)."""
+
+    _RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str, jitter: float = 0):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Ожидалось 5 полей cron: {expression!r}")
+        self.expression = expression
+        self.jitter = jitter
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(value, low, high) for value, (low, high) in zip(fields, self._RANGES)
+        )
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}  # 7 — тоже воскресенье
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(value: str, low: int, high: int) -> frozenset:
+        result = set()
+        for part in value.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Недопустимое поле cron: {value!r}")
+            result.update(range(start, end + 1, step))
+        return frozenset(result)
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        weekday = (moment.isoweekday() % 7) in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday  # как в cron: ограничены оба поля — достаточно одного
+
+    def next_after(self, last_run: Optional[datetime], now: datetime) -> Optional[datetime]:
+        moment = (last_run or now).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 4)
+        while moment < limit:
+            if moment.month not in self.months:
+                year, month = divmod(moment.month, 12)
+                moment = moment.replace(year=moment.year + year, month=month + 1, day=1, hour=0, minute=0)
+            elif not self._day_matches(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        return None
+
+    def describe(self) -> str:
+        return f"cron {self.expression}"
+
+
+# ========== ЗАДАЧИ ==========
+@dataclass
+class Job:
+    name: str
+    func: Callable
+    trigger: object
+    description: str = ""
+    next_run: Optional[datetime] = None
+    last_run: Optional[datetime] = None
+    last_duration: Optional[float] = None
+    last_error: Optional[str] = None
+    runs: int = 0
+    failures: int = 0
+    skipped: int = 0
+    total_duration: float = 0.0
+    max_duration: float = 0.0
+    running: bool = False
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def avg_duration(self) -> float:
+        return self.total_duration / self.runs if self.runs else 0.0
+
+
+_jobs = {}
+_loop = None
+_wakeup = None
+_worker = None
+
+
+def add_job(name: str, func: Callable, trigger, description: str = "") -> Job:
+    job = Job(name, func, trigger, description)
+    _jobs[name] = job
+    if _loop is not None:
+        _schedule(job, datetime.now())
+        _wake()
+    return job
+
+def get_jobs() -> list:
+    return sorted(_jobs.values(), key=lambda job: (job.next_run is None, job.next_run or datetime.max))
+
+def snapshot() -> list:
+    """Состояние задач простыми словарями (для /jobs, в том числе из процесса кластера)."""
+    def moment(value):
+        return value.strftime('%d.%m %H:%M:%S') if value else None
+    return [{
+        'name': job.name, 'description': job.description, 'schedule': job.trigger.describe(),
+        'next_run': moment(job.next_run), 'last_run': moment(job.last_run),
+        'last_duration': job.last_duration, 'last_error': job.last_error, 'running': job.running,
+        'runs': job.runs, 'failures': job.failures, 'skipped': job.skipped,
+        'avg_duration': job.avg_duration, 'max_duration': job.max_duration,
+    } for job in get_jobs()]
+
+def _schedule(job: Job, now: datetime, after: Optional[datetime] = None):
+    next_run = job.trigger.next_after(after, now)
+    if next_run is not None:
+        if next_run < now:
+            next_run = now  # пропущенный за время простоя запуск выполняем сразу
+        if job.trigger.jitter:
+            next_run += timedelta(seconds=random.uniform(0, job.trigger.jitter))
+    job.next_run = next_run
+
+def run_now(name: str) -> bool:
+    """Ставит задачу на немедленный запуск. False — нет такой задачи."""
+    job = _jobs.get(name)
+    if job is None:
+        return False
+    job.next_run = datetime.now()
+    _wake()
+    return True
+
+# ========== ВЫПОЛНЕНИЕ ==========
+async def _execute(job: Job):
+    import database_async as adb
+    started_at = datetime.now()
+    started = time.monotonic()
+    error = None
+    try:
+        if inspect.iscoroutinefunction(job.func):
+            await job.func()
+        else:
+            await adb.run_sync(job.func)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        logger.exception(f"Задача {job.name} завершилась с ошибкой")
+    finally:
+        job.running = False
+    duration = time.monotonic() - started
+    job.last_run = started_at
+    job.last_duration = duration
+    job.last_error = error
+    job.runs += 1
+    job.failures += error is not None
+    job.total_duration += duration
+    job.max_duration = max(job.max_duration, duration)
+    try:
+        await adb.record_job_run(job.name, started_at, duration, error)
+    except Exception as e:
+        logger.error(f"Не удалось сохранить запуск задачи {job.name}: {e}")
+
+def _start_due(now: datetime):
+    for job in _jobs.values():
+        if job.next_run is None or job.next_run > now:
+            continue
+        if job.running:
+            job.skipped += 1
+            logger.warning(f"Задача {job.name} ещё выполняется, запуск пропущен")
+        else:
+            job.running = True
+            job.task = asyncio.create_task(_execute(job))
+        # Следующий слот считаем от текущего, а не от окончания запуска
+        _schedule(job, now, after=now)
+
+async def _scheduler_worker():
+    import database_async as adb
+    history = await adb.get_job_runs()
+    now = datetime.now()
+    for job in _jobs.values():
+        saved = history.get(job.name)
+        if saved:
+            job.last_run = saved['last_run_at']
+            job.last_duration = saved['last_duration']
+            job.last_error = saved['last_error']
+        _schedule(job, now, after=job.last_run)
+    while True:
+        _start_due(datetime.now())
+        pending = [job.next_run for job in _jobs.values() if job.next_run is not None]
+        timeout = max(0.0, (min(pending) - datetime.now()).total_seconds()) if pending else None
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+def _wake():
+    if _loop is not None and _wakeup is not None:
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+def start():
+    """Запускает планировщик в текущем event loop."""
+    global _loop, _wakeup, _worker
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    _worker = asyncio.create_task(_scheduler_worker())
+    return _worker
+
+async def stop():
+    global _worker, _loop, _wakeup
+    tasks = [job.task for job in _jobs.values() if job.task is not None and not job.task.done()]
+    if _worker is not None:
+        tasks.append(_worker)
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    _worker = _loop = _wakeup = None
@@ -0,0 +1,163 @@
+# FILE: settings.py
+"""
+Снимок настроек из таблицы settings.
+
+Строится одним SELECT key, value, все значения разбираются сразу: числа,
+флаги, уровни реферальной программы (отсортированы для bisect), акции с
+датами. Снимок неизменяемый; set_setting собирает новый и подменяет ссылку,
+поэтому читатели никогда не ходят в БД и не парсят строки.
+"""
+import json
+import logging
+import threading
+from bisect import bisect_right
+from dataclasses import dataclass
+from datetime import datetime
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+
+from config import (
+    STAR_RATE, MIN_STARS, WITHDRAW_COMMISSION, EXCHANGE_COMMISSION, WITHDRAW_MIN_REAL,
+    REAL_TO_VIRTUAL_RATE, VIRTUAL_TO_REAL_RATE, REAL_TO_VIRTUAL_MIN, VIRTUAL_TO_REAL_COMMISSION
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFERRAL_LEVELS = [
+    {"min": 0, "max": 5, "percent": 5, "name": "Бронзовый"},
+    {"min": 5, "max": 20, "percent": 7, "name": "Серебряный"},
+    {"min": 20, "max": 999999, "percent": 10, "name": "Золотой"}
+]
+
+
+@dataclass(frozen=True)
+class Sale:
+    data: Mapping           # исходный словарь акции (только чтение)
+    start: Optional[datetime]
+    end: Optional[datetime]
+
+
+@dataclass(frozen=True)
+class Settings:
+    raw: Mapping[str, str]
+    star_rate: float
+    min_stars: int
+    withdraw_commission: float
+    exchange_commission: float
+    withdraw_min_real: int
+    real_to_virtual_rate: float
+    virtual_to_real_rate: float
+    real_to_virtual_min: int
+    virtual_to_real_commission: float
+    rounding_enabled: bool
+    maintenance_mode: bool
+    maintenance_reason: str
+    maintenance_until: Optional[datetime]
+    referral_levels: Tuple[Mapping, ...]
+    referral_level_mins: Tuple[int, ...]
+    sales: Tuple[Sale, ...]
+
+    def get(self, key: str, default=None):
+        return self.raw.get(key, default)
+
+    def referral_level(self, referrals_count: int) -> dict:
+        index = bisect_right(self.referral_level_mins, referrals_count) - 1
+        if index >= 0 and referrals_count < self.referral_levels[index]["max"]:
+            return dict(self.referral_levels[index])
+        return dict(self.referral_levels[0])
+
+
+# ========== РАЗБОР ==========
+def _number(raw: dict, key: str, cast, default):
+    try:
+        return cast(raw.get(key, default))
+    except (TypeError, ValueError):
+        logger.error(f"Некорректное значение настройки {key}: {raw.get(key)!r}")
+        return cast(default)
+
+def _datetime(value) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+def _referral_levels(value) -> list:
+    try:
+        levels = json.loads(value) if value else []
+    except ValueError:
+        levels = []
+    return sorted(levels or DEFAULT_REFERRAL_LEVELS, key=lambda level: level["min"])
+
+def _sales(value) -> tuple:
+    try:
+        sales = json.loads(value) if value else []
+    except ValueError:
+        sales = []
+    return tuple(
+        Sale(MappingProxyType(dict(sale)), _datetime(sale.get('start')), _datetime(sale.get('end')))
+        for sale in sales
+    )
+
+def build(raw: dict) -> Settings:
+    levels = _referral_levels(raw.get('referral_levels'))
+    return Settings(
+        raw=MappingProxyType(dict(raw)),
+        star_rate=_number(raw, 'star_rate', float, STAR_RATE),
+        min_stars=_number(raw, 'min_stars', int, MIN_STARS),
+        withdraw_commission=_number(raw, 'withdraw_commission', float, WITHDRAW_COMMISSION),
+        exchange_commission=_number(raw, 'exchange_commission', float, EXCHANGE_COMMISSION),
+        withdraw_min_real=_number(raw, 'withdraw_min_real', int, WITHDRAW_MIN_REAL),
+        real_to_virtual_rate=_number(raw, 'real_to_virtual_rate', float, REAL_TO_VIRTUAL_RATE),
+        virtual_to_real_rate=_number(raw, 'virtual_to_real_rate', float, VIRTUAL_TO_REAL_RATE),
+        real_to_virtual_min=_number(raw, 'real_to_virtual_min', int, REAL_TO_VIRTUAL_MIN),
+        virtual_to_real_commission=_number(raw, 'virtual_to_real_commission', float, VIRTUAL_TO_REAL_COMMISSION),
+        rounding_enabled=raw.get('rounding_enabled', '1') == '1',
+        maintenance_mode=raw.get('maintenance_mode', '0') == '1',
+        maintenance_reason=raw.get('maintenance_reason') or 'Плановые работы',
+        maintenance_until=_datetime(raw.get('maintenance_until')),
+        referral_levels=tuple(MappingProxyType(dict(level)) for level in levels),
+        referral_level_mins=tuple(level["min"] for level in levels),
+        sales=_sales(raw.get('sales')),
+    )
+
+
+# ========== ТЕКУЩИЙ СНИМОК ==========
+_current = None
+_lock = threading.Lock()
+
+def load() -> Settings:
+    """Читает все настройки одним запросом и подменяет снимок."""
+    global _current
+    from database import get_read_connection
+    conn = get_read_connection()
+    try:
+        rows = conn.execute("SELECT key, value FROM settings").fetchall()
+    finally:
+        conn.close()
+    snapshot = build(dict(rows))
+    with _lock:
+        _current = snapshot
+    return snapshot
+
+def current() -> Settings:
+    snapshot = _current
+    return snapshot if snapshot is not None else load()
+
+def apply(key: str, value: str) -> Settings:
+    """Новый снимок с изменённым ключом (после записи в БД)."""
+    global _current
+    with _lock:
+        if _current is not None:
+            raw = dict(_current.raw)
+            raw[key] = value
+            _current = build(raw)
+            return _current
+    return load()
+
+def reload():
+    """Сбрасывает снимок, следующее обращение перечитает БД."""
+    global _current
+    with _lock:
+        _current = None
@@ -0,0 +1,175 @@
+# FILE: sqltrace.py
+"""
+Трассировка SQL-запросов (включается SQL_TRACE=1).
+
+Соединения пула и aiosqlite открываются с фабрикой TracedConnection: каждый
+execute/executemany замеряется, время суммируется по нормализованному тексту
+запроса (литералы и списки IN заменены на ?), так что один и тот же запрос
+с разными параметрами — одна строка статистики. Замеряется выполнение до
+первой строки результата, выборка строк (fetchall) сюда не входит.
+
+Запросы дольше SQL_SLOW_MS пишутся в лог медленных запросов (логгер
+sql.slow, при SQL_SLOW_LOG — ещё и в файл) вместе с EXPLAIN QUERY PLAN.
+План снимается заново, если медленный запрос повторился позже
+SQL_PLAN_REFRESH секунд — после нового индекса пометка уходит сама.
+Шаги плана с полным просмотром таблицы (SCAN без индекса) помечаются —
+это кандидаты на новый индекс. Сводку отдаёт top(), в боте — /sqltop.
+"""
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from config import SQL_TRACE, SQL_SLOW_MS, SQL_SLOW_LOG, SQL_TRACE_MAX_STATEMENTS, SQL_PLAN_REFRESH
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger('sql.slow')
+if SQL_TRACE and SQL_SLOW_LOG:
+    _handler = logging.FileHandler(SQL_SLOW_LOG, encoding='utf-8')
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    slow_logger.addHandler(_handler)
+
+_EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'replace', 'with')
+
+
+# ========== НОРМАЛИЗАЦИЯ ==========
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_VALUES_RE = re.compile(r"\bVALUES\s*(\([^()]*\))(?:\s*,\s*\([^()]*\))+", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(sql: str) -> str:
+    """Текст запроса без параметров: ключ агрегации."""
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _SPACE_RE.sub(' ', sql).strip()
+    sql = _IN_LIST_RE.sub('IN (...)', sql)
+    return _VALUES_RE.sub(r'VALUES \1, ...', sql)
+
+def _is_full_scan(detail: str) -> bool:
+    # SQLite до 3.36 пишет «SCAN TABLE t», новее — «SCAN t»
+    return detail.startswith('SCAN ') and 'USING' not in detail and 'CONSTANT ROW' not in detail
+
+
+# ========== СТАТИСТИКА ==========
+class _Statement:
+    __slots__ = ('sql', 'calls', 'total', 'max', 'slow', 'plan', 'plan_at', 'full_scan')
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.plan = None       # EXPLAIN QUERY PLAN медленного выполнения
+        self.plan_at = 0.0     # когда снят план (time.monotonic)
+        self.full_scan = False
+
+
+_statements = {}
+_lock = threading.Lock()
+_dropped = 0  # выполнения, не попавшие в статистику из-за лимита запросов
+
+
+def _record(conn: sqlite3.Connection, sql: str, params, elapsed: float):
+    global _dropped
+    key = normalize(sql)
+    with _lock:
+        stmt = _statements.get(key)
+        if stmt is None:
+            if len(_statements) >= SQL_TRACE_MAX_STATEMENTS:
+                _dropped += 1
+                return
+            stmt = _statements[key] = _Statement(key)
+        stmt.calls += 1
+        stmt.total += elapsed
+        if elapsed > stmt.max:
+            stmt.max = elapsed
+        if elapsed * 1000 < SQL_SLOW_MS:
+            return
+        stmt.slow += 1
+        now = time.monotonic()
+        need_plan = stmt.plan is None or now - stmt.plan_at >= SQL_PLAN_REFRESH
+        if need_plan:
+            stmt.plan_at = now  # параллельные медленные выполнения план не дублируют
+    if need_plan:
+        plan = _explain(conn, sql, params)
+        with _lock:
+            stmt.plan = plan
+            stmt.full_scan = any(_is_full_scan(detail) for detail in plan)
+    scan = " [SCAN TABLE]" if stmt.full_scan else ""
+    plan_text = "; ".join(stmt.plan) if stmt.plan else "—"
+    slow_logger.warning(f"Медленный запрос {elapsed * 1000:.1f} мс{scan}: {key} | план: {plan_text}")
+
+def _explain(conn: sqlite3.Connection, sql: str, params) -> list:
+    if params is None or not sql.lstrip()[:7].lower().startswith(_EXPLAINABLE):
+        return []
+    try:
+        # Обычный курсор, чтобы не трассировать сам EXPLAIN
+        cursor = sqlite3.Cursor(conn)
+        try:
+            rows = cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+        finally:
+            cursor.close()
+        return [row[3] for row in rows]
+    except sqlite3.Error as e:
+        return [f"ошибка EXPLAIN: {e}"]
+
+
+def top(limit: int = 10) -> list:
+    """Самые затратные запросы по суммарному времени."""
+    with _lock:
+        rows = sorted(_statements.values(), key=lambda s: s.total, reverse=True)[:limit]
+        return [{'sql': s.sql, 'calls': s.calls, 'total': s.total, 'avg': s.total / s.calls,
+                 'max': s.max, 'slow': s.slow, 'full_scan': s.full_scan, 'plan': s.plan}
+                for s in rows]
+
+def stats() -> dict:
+    with _lock:
+        return {'enabled': SQL_TRACE, 'statements': len(_statements), 'dropped': _dropped,
+                'calls': sum(s.calls for s in _statements.values()),
+                'total': sum(s.total for s in _statements.values())}
+
+def reset():
+    global _dropped
+    with _lock:
+        _statements.clear()
+        _dropped = 0
+
+
+# ========== ОБЁРТКИ SQLITE3 ==========
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record(self.connection, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # План по первому набору параметров недоступен (итератор уже прочитан)
+            _record(self.connection, sql, None, time.perf_counter() - started)
+
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    # Встроенные execute/executemany создают курсор в обход cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    """Фабрика для sqlite3.connect(factory=...): трассирующая при SQL_TRACE."""
+    return TracedConnection if SQL_TRACE else sqlite3.Connection
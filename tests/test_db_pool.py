@@ -0,0 +1,83 @@
+# FILE: tests/test_db_pool.py
+"""Вложенные писатели пула: хелпер внутри чужой транзакции не завершает её."""
+import pytest
+
+import database
+import db_pool
+import settings
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # DATABASE_NAME относительный — своя БД в каждом тесте
+    database.init_db()
+    settings.load()
+    yield db_pool.get_pool(database.DATABASE_NAME)
+    db_pool.close_pool()
+
+
+def _count(pool, query, params=()):
+    conn = pool.reader()
+    try:
+        return conn.execute(query, params).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_inner_rollback_keeps_outer_transaction(db):
+    outer = db.writer()
+    try:
+        outer.execute("INSERT INTO users (user_id, username, full_name) VALUES (1, 'a', 'A')")
+        inner = db.writer()
+        try:
+            inner.execute("INSERT INTO users (user_id, username, full_name) VALUES (2, 'b', 'B')")
+            inner.rollback()
+        finally:
+            inner.close()
+        outer.commit()
+    finally:
+        outer.close()
+    assert _count(db, "SELECT COUNT(*) FROM users WHERE user_id IN (1, 2)") == 1
+
+
+def test_inner_commit_is_undone_by_outer_rollback(db):
+    outer = db.writer()
+    try:
+        outer.execute("INSERT INTO users (user_id, username, full_name) VALUES (1, 'a', 'A')")
+        inner = db.writer()
+        try:
+            inner.execute("INSERT INTO users (user_id, username, full_name) VALUES (2, 'b', 'B')")
+            inner.commit()
+        finally:
+            inner.close()
+        outer.rollback()
+    finally:
+        outer.close()
+    assert _count(db, "SELECT COUNT(*) FROM users WHERE user_id IN (1, 2)") == 0
+
+
+def test_failed_referral_reward_keeps_order_approved(db, monkeypatch):
+    database.create_user(10, 'referrer', 'Referrer')
+    database.create_user(20, 'buyer', 'Buyer')
+    database.add_referral(10, 20)
+    order_id = database.create_order(20, 100, 'buyer', 'screenshot.jpg')
+    monkeypatch.setattr(database, 'get_referral_levels', lambda: [])  # IndexError в create_referral_reward
+
+    database.update_order_status(order_id, 'approved')
+
+    assert database.get_order_status(order_id) == 'approved'
+    assert _count(db, "SELECT COUNT(*) FROM purchase_history WHERE order_id = ?", (order_id,)) == 1
+    assert _count(db, "SELECT total_spent FROM users WHERE user_id = 20") > 0
+    assert _count(db, "SELECT COUNT(*) FROM referral_rewards") == 0
+
+
+
+def test_leaked_writer_is_released_in_its_thread(db):
+    import threading
+    conn = db.writer()
+    del conn  # не закрыт — __del__ в захватившем потоке возвращает писателя
+    result = []
+    thread = threading.Thread(target=lambda: result.append(db.writer().close()))
+    thread.start()
+    thread.join(timeout=5)
+    assert result == [None]
@@ -0,0 +1,149 @@
+# FILE: webhook.py
+"""
+Приём обновлений через вебхук на встроенном сервере aiohttp.
+
+Включается BOT_MODE=webhook, по умолчанию бот работает на long polling.
+Telegram присылает обновления на WEBHOOK_URL + WEBHOOK_PATH, запрос
+проверяется по заголовку X-Telegram-Bot-Api-Secret-Token. Принятое
+обновление кладётся в очередь на WEBHOOK_QUEUE_SIZE элементов и
+обрабатывается одним из WEBHOOK_WORKERS воркеров. Когда очередь полна,
+ответ Telegram задерживается до освобождения места: всплеск нагрузки
+тормозит приём, но обновления не теряются. /healthz отдаёт состояние
+очереди для балансировщика и мониторинга.
+"""
+import asyncio
+import hmac
+import logging
+import secrets
+import signal
+import time
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+import metrics
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_DRAIN_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+_stats = {'received': 0, 'processed': 0, 'failed': 0, 'rejected': 0, 'queue_waits': 0}
+
+
+# ========== ОБРАБОТКА ==========
+async def _update_worker(queue: asyncio.Queue, process):
+    while True:
+        update = await queue.get()
+        try:
+            await process(update)
+            _stats['processed'] += 1
+        except Exception:
+            _stats['failed'] += 1
+            logger.exception(f"Ошибка обработки обновления {update.update_id}")
+        finally:
+            queue.task_done()
+
+async def _handle_update(request: web.Request) -> web.Response:
+    app = request.app
+    token = request.headers.get(SECRET_HEADER, '')
+    if not hmac.compare_digest(token.encode(), app['secret'].encode()):
+        _stats['rejected'] += 1
+        return web.Response(status=401)
+    try:
+        update = Update.model_validate(await request.json(), context={'bot': app['bot']})
+    except Exception as e:
+        logger.warning(f"Вебхук: некорректное обновление: {e}")
+        return web.Response(status=400)
+    queue = app['queue']
+    _stats['received'] += 1
+    if queue.full():
+        _stats['queue_waits'] += 1
+    await queue.put(update)  # при полной очереди ждём, Telegram повторит запрос сам
+    return web.json_response({})
+
+async def _healthz(request: web.Request) -> web.Response:
+    app = request.app
+    workers = sum(not task.done() for task in app['workers'])
+    healthy = workers == len(app['workers'])
+    return web.json_response({
+        'status': 'ok' if healthy else 'degraded',
+        'uptime': int(time.monotonic() - app['started']),
+        'queue': app['queue'].qsize(),
+        'queue_size': app['queue'].maxsize,
+        'workers': workers,
+        **_stats,
+    }, status=200 if healthy else 503)
+
+def stats() -> dict:
+    return dict(_stats)
+
+# ========== ЗАПУСК ==========
+async def run(dp: Dispatcher, bot: Bot, process=None):
+    """
+    Поднимает сервер, регистрирует вебхук и работает до SIGINT/SIGTERM.
+    process(update) — обработка принятого обновления, по умолчанию dp.feed_update
+    (в кластере — передача в процесс-обработчик).
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+    # Секрет из настроек или новый на каждый запуск — вебхук всё равно переустанавливается
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    workflow_data = {'dispatcher': dp, 'bots': [bot], **dp.workflow_data}
+    if process is None:
+        async def process(update: Update):
+            await dp.feed_update(bot, update, **workflow_data)
+
+    app = web.Application()
+    app['bot'] = bot
+    app['secret'] = secret
+    app['queue'] = queue
+    app['started'] = time.monotonic()
+    app['workers'] = [
+        asyncio.create_task(_update_worker(queue, process)) for _ in range(WEBHOOK_WORKERS)
+    ]
+    app.router.add_post(WEBHOOK_PATH, _handle_update)
+    app.router.add_get('/healthz', _healthz)
+    metrics.gauge('webhook_queue', "Обновления в очереди вебхука", lambda: {(): queue.qsize()})
+
+    await dp.emit_startup(bot=bot, **workflow_data)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=False,  # накопленное за время перезапуска обработаем
+    )
+    logger.info(f"Вебхук запущен: {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, "
+                f"очередь {WEBHOOK_QUEUE_SIZE}, воркеров {WEBHOOK_WORKERS}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows: остановка по KeyboardInterrupt
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка вебхука")
+        # Сначала перестаём принимать запросы, затем дорабатываем очередь
+        await runner.cleanup()
+        try:
+            await asyncio.wait_for(queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Вебхук: не обработано обновлений при остановке: {queue.qsize()}")
+        for task in app['workers']:
+            task.cancel()
+        await asyncio.gather(*app['workers'], return_exceptions=True)
+        await dp.emit_shutdown(bot=bot, **workflow_data)
+        await bot.session.close()